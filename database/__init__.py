@@ -1 +1,7 @@
-from .dataset import Dataset_instance, Dataset_bag, Dataset_bag_MIL, Dataset_instance_MIL, Balanced_Multimodal
+from .dataset import Dataset_instance, Dataset_bag, Dataset_bag_MIL, Dataset_instance_MIL, Dataset_bag_features, Balanced_Multimodal
+from .dataset import Bucket_batch_sampler, Resumable_sampler, pad_bags, collate_bags
+from .catalog import build_catalog, patch_cohorts, fold_split, labelled_slides, discarded_slides, patches_csv
+from .feature_store import FeatureStore, build_feature_store, view_name
+from .bag_cache import BagCache
+from .prefetch import BagPrefetcher
+from .patch_index import PatchPathIndex
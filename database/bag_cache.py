@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+import torch
+
+
+class BagCache:
+    """
+    In-memory LRU cache of the features of the WSIs (bags) as float32 tensors, pinned when
+    CUDA is available so the copy to the GPU is asynchronous. The features are read once
+    from the feature store and kept while they fit in the memory budget; the least recently
+    used bags are evicted first. With a budget of 0 every bag is read from the store.
+
+    Parameters
+    ----------
+    feature_store (FeatureStore): features of the WSIs
+    budget_gb (float): maximum memory used by the cached tensors in GB
+    pin_memory (bool): pin the cached tensors (only if CUDA is available)
+    """
+
+    def __init__(self, feature_store, budget_gb=0, pin_memory=True):
+        self.feature_store = feature_store
+        self.budget = int(budget_gb * 1024**3)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        self.bags = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, wsi_id):
+        features = torch.from_numpy(np.array(self.feature_store[wsi_id], dtype=np.float32))
+        if self.pin_memory:
+            features = features.pin_memory()
+        return features
+
+    def __getitem__(self, wsi_id):
+        with self.lock:
+            if wsi_id in self.bags:
+                self.bags.move_to_end(wsi_id)
+                self.hits += 1
+                return self.bags[wsi_id]
+            self.misses += 1
+
+        features = self.load(wsi_id)
+        nbytes = features.numel() * features.element_size()
+
+        if nbytes > self.budget:
+            return features
+
+        with self.lock:
+            if wsi_id not in self.bags:
+                while self.size + nbytes > self.budget:
+                    _, evicted = self.bags.popitem(last=False)
+                    self.size -= evicted.numel() * evicted.element_size()
+                    self.evictions += 1
+                self.bags[wsi_id] = features
+                self.size += nbytes
+
+        return features
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests > 0 else 0.0,
+                "cached_bags": len(self.bags),
+                "cached_gb": self.size / 1024**3}
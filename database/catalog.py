@@ -0,0 +1,332 @@
+from pathlib import Path
+from ast import literal_eval
+import os
+import sqlite3
+import pandas as pd
+import numpy as np
+import click
+
+thispath = Path(__file__).resolve()
+
+datadir = Path(thispath.parent.parent / "data")
+
+CATALOG = Path(datadir / "slide_catalog.db")
+
+tcgadir = Path("/mnt/nas6/data/lung_tcga")
+
+# cohort: (directory with the PyHIST outputs, metadata .csv, pattern of the filtered patches .csv,
+#          substring required in the path of the filtered patches .csv)
+# The _v1 cohorts are the same slides with the version 1 patch selection
+cohorts = {"aoec": (Path(datadir / "Mask_PyHIST_v2"),
+                    "metadata_slides_v2.csv",
+                    "*_densely_filtered_paths_v2.csv",
+                    "LungAOEC"),
+           "aoec_v1": (Path(datadir / "Mask_PyHIST_v2"),
+                       "metadata_slides.csv",
+                       "*_densely_filtered_paths.csv",
+                       "LungAOEC"),
+           "aoec_test": (Path(datadir / "Mask_PyHIST_v2" / "Lung"),
+                         "metadata_slides_v2.csv",
+                         "*_densely_filtered_paths_v2.csv",
+                         ""),
+           "aoec_test_v1": (Path(datadir / "Mask_PyHIST_v2" / "Lung"),
+                            "metadata_slides.csv",
+                            "*_densely_filtered_paths.csv",
+                            ""),
+           "rumc": (Path(datadir / "Mask_PyHIST"),
+                    "metadata_slides_v2.csv",
+                    "*_densely_filtered_paths_v2.csv",
+                    ""),
+           "tcga": (Path(tcgadir / "Mask_PyHIST_tif"),
+                    "metadata_slides_v2.csv",
+                    "*_densely_filtered_paths.csv",
+                    "")}
+
+# label set: .csv file with one row per WSI and the 4 labels (SCLC, LUAD, LUSC, NL)
+label_sets = {"aoec": Path(datadir / "manual_labels.csv"),
+              "aoec_auto": Path(datadir / "labels.csv"),
+              "aoec_test": Path(datadir / "manual_labels_test.csv"),
+              "rumc": Path(datadir / "labels_id_rumc.csv"),
+              "rumc_test": Path(datadir / "labels_test_rumc.csv"),
+              "tcga": Path(tcgadir / "labels_tcga_all.csv")}
+
+# split set: k-fold-crossvalidation .csv file created by data_splits.py
+split_sets = {"aoec": Path(datadir / "5_fold_crossvalidation_data_split.csv"),
+              "aoec_auto": Path(datadir / "5_fold_crossvalidation_data_split_autov2.csv"),
+              "rumc": Path(datadir / "5_fold_crossvalidation_data_split_rumc.csv")}
+
+schema = """
+CREATE TABLE slides (
+    wsi TEXT NOT NULL,
+    cohort TEXT NOT NULL,
+    center TEXT,
+    number_patches INTEGER,
+    number_filtered_patches INTEGER,
+    patches_csv TEXT,
+    PRIMARY KEY (cohort, wsi)
+);
+CREATE INDEX slides_wsi ON slides (wsi);
+
+CREATE TABLE labels (
+    label_set TEXT NOT NULL,
+    wsi TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sclc INTEGER, luad INTEGER, lusc INTEGER, nl INTEGER,
+    PRIMARY KEY (label_set, wsi)
+);
+
+CREATE TABLE folds (
+    split_set TEXT NOT NULL,
+    fold INTEGER NOT NULL,
+    subset TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    wsi TEXT NOT NULL,
+    sclc INTEGER, luad INTEGER, lusc INTEGER, nl INTEGER,
+    PRIMARY KEY (split_set, fold, subset, position)
+);
+"""
+
+
+def connect(catalog_file=CATALOG):
+    return sqlite3.connect(str(catalog_file))
+
+
+def to_int(value):
+    return None if pd.isna(value) else int(value)
+
+
+def insert_slides(connection, cohort, pyhistdir, metadata_name, pattern, contains):
+
+    metadata = pd.read_csv(pyhistdir / metadata_name, index_col=0, dtype={"ID wsi": str})
+
+    patches_csv = {i.parent.stem: str(i) for i in pyhistdir.rglob(pattern) if contains in str(i)}
+
+    rows = []
+    for wsi, number_patches, number_filtered, center in zip(metadata.index,
+                                                           metadata["number_patches"],
+                                                           metadata["number_filtered_patches"],
+                                                           metadata["center"]):
+        rows.append((str(wsi), cohort, str(center), to_int(number_patches), to_int(number_filtered),
+                     patches_csv.pop(str(wsi), None)))
+
+    # Slides with filtered patches but missing in the metadata
+    for wsi, path in patches_csv.items():
+        rows.append((wsi, cohort, None, None, None, path))
+
+    connection.executemany("INSERT OR REPLACE INTO slides VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    return len(rows)
+
+
+def insert_labels(connection, label_set, labels_file):
+
+    index_name = pd.read_csv(labels_file, nrows=0).columns[0]
+    labels = pd.read_csv(labels_file, index_col=0, dtype={index_name: str})
+    labels.index = labels.index.astype(str).str.replace("/", "-")
+    if "ID" in labels.columns:
+        labels = labels.drop("ID", axis=1)
+
+    rows = [(label_set, wsi, position, *[int(i) for i in values])
+            for position, (wsi, values) in enumerate(zip(labels.index, labels.values))]
+
+    connection.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    return len(rows)
+
+
+def insert_folds(connection, split_set, split_file):
+
+    data_split = pd.read_csv(split_file, index_col=0)
+
+    rows = []
+    for fold in data_split.index:
+        for subset in ["train", "validation"]:
+            images = literal_eval(data_split.loc[fold][f"images_{subset}"])
+            labels = literal_eval(data_split.loc[fold][f"labels_{subset}"])
+            rows.extend([(split_set, int(fold), subset, position, str(wsi), *[int(i) for i in label])
+                         for position, (wsi, label) in enumerate(zip(images, labels))])
+
+    connection.executemany("INSERT OR REPLACE INTO folds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    return len(rows)
+
+
+def build_catalog(catalog_file=CATALOG):
+    """
+    Builds the catalog of the dataset as a SQLite database with the slides of every cohort
+    (center, number of patches and path to the filtered patches .csv), the labels and the
+    k-fold-crossvalidation splits. The stored features are indexed by their feature store
+    (database/feature_store.py). The catalog is created from scratch and the missing sources
+    are skipped.
+
+    Parameters
+    ----------
+    catalog_file (Path from pathlib): path of the SQLite database
+    """
+    temporary_file = Path(f"{catalog_file}.tmp")
+    temporary_file.unlink(missing_ok=True)
+
+    connection = connect(temporary_file)
+    connection.executescript(schema)
+
+    for cohort, (pyhistdir, metadata_name, pattern, contains) in cohorts.items():
+        if not Path(pyhistdir / metadata_name).exists():
+            print(f"Skipping slides of {cohort}, {pyhistdir / metadata_name} not found")
+            continue
+        number = insert_slides(connection, cohort, pyhistdir, metadata_name, pattern, contains)
+        print(f"{number} slides added for {cohort}")
+
+    for label_set, labels_file in label_sets.items():
+        if not labels_file.exists():
+            print(f"Skipping labels {label_set}, {labels_file} not found")
+            continue
+        number = insert_labels(connection, label_set, labels_file)
+        print(f"{number} labels added for {label_set}")
+
+    for split_set, split_file in split_sets.items():
+        if not split_file.exists():
+            print(f"Skipping splits {split_set}, {split_file} not found")
+            continue
+        number = insert_folds(connection, split_set, split_file)
+        print(f"{number} fold assignments added for {split_set}")
+
+    connection.commit()
+    connection.close()
+
+    # Replace the previous catalog only once the new one is complete
+    os.replace(temporary_file, catalog_file)
+    print(f"Slide catalog created in {catalog_file}")
+
+
+def patch_cohorts(cohort_names, version_patch_selection="v2"):
+    """
+    Cohorts of the slides with the given version of the patch selection ('v1' or 'v2'),
+    e.g. ("aoec", "rumc") with 'v1' is ("aoec_v1", "rumc"). RUMC only has the version 2.
+    """
+    if version_patch_selection == "v2":
+        return tuple(cohort_names)
+
+    return tuple(f"{i}_v1" if f"{i}_v1" in cohorts else i for i in cohort_names)
+
+
+def fold_split(fold, split_names=("aoec", "rumc"), cohort_names=("aoec", "rumc"), min_patches=10,
+               catalog_file=CATALOG):
+    """
+    Train and validation WSIs of a fold with their labels, in the order of the data split
+    .csv files, discarding the WSIs with less than min_patches filtered patches.
+
+    Parameters
+    ----------
+    fold (int): fold of the k-fold-crossvalidation
+    split_names (tuple): split sets concatenated in this order
+    cohort_names (tuple): cohorts whose number of filtered patches is checked
+    min_patches (int): minimum number of filtered patches of a WSI
+    catalog_file (Path from pathlib): path of the SQLite database
+
+    Returns
+    -------
+    images_train (list), labels_train (list), images_validation (list), labels_validation (list)
+    """
+    query = f"""
+        SELECT f.wsi, f.sclc, f.luad, f.lusc, f.nl
+        FROM folds AS f
+        WHERE f.split_set = ? AND f.fold = ? AND f.subset = ?
+          AND NOT EXISTS (SELECT 1 FROM slides AS s
+                          WHERE s.wsi = f.wsi AND s.number_filtered_patches < ?
+                            AND s.cohort IN ({", ".join("?" * len(cohort_names))}))
+        ORDER BY f.position
+    """
+    connection = connect(catalog_file)
+    split = {}
+    for subset in ["train", "validation"]:
+        rows = []
+        for split_set in split_names:
+            rows.extend(connection.execute(query, (split_set, fold, subset, min_patches,
+                                                   *cohort_names)).fetchall())
+        split[f"images_{subset}"] = [i[0] for i in rows]
+        split[f"labels_{subset}"] = [list(i[1:]) for i in rows]
+    connection.close()
+
+    return (split["images_train"], split["labels_train"],
+            split["images_validation"], split["labels_validation"])
+
+
+def labelled_slides(label_names=("aoec_test", "rumc_test"), cohort_names=("aoec_test", "rumc"),
+                    min_patches=10, catalog_file=CATALOG):
+    """
+    WSIs of the given label sets with their labels, discarding the WSIs with less than
+    min_patches filtered patches in the given cohorts.
+
+    Returns
+    -------
+    images (numpy.ndarray), labels (numpy.ndarray) with shape (number of WSIs, 4)
+    """
+    query = f"""
+        SELECT l.wsi, l.sclc, l.luad, l.lusc, l.nl
+        FROM labels AS l
+        WHERE l.label_set = ?
+          AND NOT EXISTS (SELECT 1 FROM slides AS s
+                          WHERE s.wsi = l.wsi AND s.number_filtered_patches < ?
+                            AND s.cohort IN ({", ".join("?" * len(cohort_names))}))
+        ORDER BY l.position
+    """
+    connection = connect(catalog_file)
+    rows = []
+    for label_set in label_names:
+        rows.extend(connection.execute(query, (label_set, min_patches, *cohort_names)).fetchall())
+    connection.close()
+
+    images = np.array([i[0] for i in rows], dtype=object)
+    labels = np.array([i[1:] for i in rows], dtype=np.int64).reshape(-1, 4)
+
+    return images, labels
+
+
+def discarded_slides(label_set, cohort_names, min_patches=10, catalog_file=CATALOG):
+    """
+    WSIs of a label set with less than min_patches filtered patches in the given cohorts.
+    """
+    query = f"""
+        SELECT DISTINCT l.wsi
+        FROM labels AS l JOIN slides AS s ON s.wsi = l.wsi
+        WHERE l.label_set = ? AND s.number_filtered_patches < ?
+          AND s.cohort IN ({", ".join("?" * len(cohort_names))})
+        ORDER BY l.position
+    """
+    connection = connect(catalog_file)
+    rows = connection.execute(query, (label_set, min_patches, *cohort_names)).fetchall()
+    connection.close()
+
+    return [i[0] for i in rows]
+
+
+def patches_csv(wsis, cohort_names, catalog_file=CATALOG):
+    """
+    Path of the filtered patches .csv file of the given WSIs, only from the given cohorts
+    (e.g. ("aoec", "rumc") for the training slides with the version 2 patch selection).
+    """
+    query = f"""
+        SELECT wsi, patches_csv FROM slides
+        WHERE patches_csv IS NOT NULL AND cohort IN ({", ".join("?" * len(cohort_names))})
+    """
+    connection = connect(catalog_file)
+    rows = connection.execute(query, tuple(cohort_names)).fetchall()
+    connection.close()
+
+    paths = dict(rows)
+
+    return {i: paths[i] for i in wsis if i in paths}
+
+
+@click.command()
+@click.option(
+    "--catalog_file",
+    default=str(CATALOG),
+    help="Path of the SQLite database to create",
+)
+def main(catalog_file):
+    build_catalog(Path(catalog_file))
+
+
+if __name__ == "__main__":
+    main()
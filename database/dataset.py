@@ -1,3 +1,4 @@
+import random
 import torch
 from torch.utils.data import Dataset
 from pathlib import Path
@@ -5,17 +6,22 @@ import pyspng
 from PIL import Image
 import numpy as np
 import cv2 as cv
+from database.feature_store import view_name
+from database.patch_index import patch_path
   
 thispath = Path(__file__).resolve()
 
 
 class Dataset_instance(Dataset):
 
-    def __init__(self, wsi_path_patches, transform=None, preprocess=None):
+    def __init__(self, wsi_path_patches, transform=None, preprocess=None, seed=None):
 
         self.wsi_path_patches = wsi_path_patches
         self.transform = transform
         self.preprocess = preprocess
+        # With a seed the augmentation of every patch only depends on (seed, index),
+        # not on the worker or the order in which the patches are loaded
+        self.seed = seed
 
 
     def __len__(self):
@@ -28,10 +34,14 @@ class Dataset_instance(Dataset):
         #     key =  pyspng.load(fin.read())
         # open method used to open different extension image file
         # key = np.array(Image.open(self.wsi_path_patches[index][0]))
-        key = cv.imread(self.wsi_path_patches[index][0])
+        key = cv.imread(patch_path(self.wsi_path_patches, index))
         key = cv.cvtColor(key, cv.COLOR_BGR2RGB)
 
         if self.transform:
+            if self.seed is not None:
+                sample_seed = np.random.SeedSequence([self.seed, index]).generate_state(1)[0]
+                random.seed(int(sample_seed))
+                np.random.seed(sample_seed)
             query = self.transform(image=key)['image']
         else:
             query = key
@@ -70,7 +80,7 @@ class Dataset_instance_MIL(Dataset):
 
     def __getitem__(self, index):
         # Select sample
-        wsi_id = self.wsi_path_patches[index][0]
+        wsi_id = patch_path(self.wsi_path_patches, index)
         # Load data and get label
         with open(wsi_id, 'rb') as fin:
             input_tensor = pyspng.load(fin.read())
@@ -102,6 +112,179 @@ class Dataset_bag_MIL(Dataset):
         return self.list_IDs[index], self.labels[index]
 
 
+class Dataset_bag_features(Dataset):
+    """
+    Bags of the MIL with their features. Returns the WSI ID, the features (float32 tensor
+    from the bag cache, None if load_features is False) and the labels (float tensor).
+    With num_views > 0 the bag cache holds precomputed augmented views of the features
+    (<wsi>_view<k>) and a random view is returned every time a bag is loaded.
+    """
+
+    def __init__(self, list_IDs, labels, bag_cache, load_features=True, num_views=0):
+        self.list_IDs = list_IDs
+        self.labels = labels
+        self.bag_cache = bag_cache
+        self.load_features = load_features
+        self.num_views = num_views
+
+    def __len__(self):
+
+        return len(self.list_IDs)
+
+    def __getitem__(self, index):
+        wsi_id = self.list_IDs[index]
+        labels = torch.tensor(np.asarray(self.labels[index]), dtype=torch.float)
+
+        if self.load_features and self.num_views > 0:
+            features = self.bag_cache[view_name(wsi_id, np.random.randint(self.num_views))]
+        elif self.load_features:
+            features = self.bag_cache[wsi_id]
+        else:
+            features = None
+
+        return wsi_id, features, labels
+
+
+def pad_bags(bags):
+    """
+    Pads a list of bags (N_i, D) with zeros into a tensor (B, N_max, D) and a bool mask
+    (B, N_max) that is True for the instances and False for the padding.
+    """
+    n_max = max(bag.shape[0] for bag in bags)
+    features = torch.zeros((len(bags), n_max, bags[0].shape[1]), dtype=bags[0].dtype)
+    mask = torch.zeros((len(bags), n_max), dtype=torch.bool)
+    for i, bag in enumerate(bags):
+        features[i, :bag.shape[0]] = bag
+        mask[i, :bag.shape[0]] = True
+
+    return features, mask
+
+
+def collate_bags(items):
+    """
+    Collates the items of Dataset_bag_features into the WSI IDs (list), the padded features
+    (B, N_max, D) with their mask (B, N_max) and the labels (B, num_classes).
+    """
+    wsi_ids, bags, labels = zip(*items)
+
+    if bags[0] is None:
+        features, mask = None, None
+    else:
+        features, mask = pad_bags(bags)
+
+    return list(wsi_ids), features, mask, torch.stack(labels)
+
+
+class Bucket_batch_sampler(torch.utils.data.sampler.Sampler):
+    """
+    Batches of bags of similar size, to limit the padding of the batches. The bags are
+    shuffled, split in buckets of bucket_size batches, sorted by size inside every bucket
+    and grouped in batches, and the order of the batches is shuffled. Without shuffle the
+    batches follow the order of the dataset.
+
+    Parameters
+    ----------
+    lengths (list): number of instances of every bag
+    batch_size (int): number of bags per batch
+    shuffle (bool): new random batches in every iteration
+    bucket_size (int): number of batches per bucket
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        n = len(self.lengths)
+
+        if not self.shuffle:
+            return iter([list(range(i, min(i + self.batch_size, n))) for i in range(0, n, self.batch_size)])
+
+        indices = torch.randperm(n).tolist()
+        bucket_length = self.batch_size * self.bucket_size
+
+        batches = []
+        for start in range(0, n, bucket_length):
+            bucket = sorted(indices[start:start + bucket_length], key=lambda i: self.lengths[i])
+            batches.extend([bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)])
+
+        return iter([batches[i] for i in torch.randperm(len(batches)).tolist()])
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class Resumable_sampler(torch.utils.data.sampler.Sampler):
+    """
+    Random order of the samples that can be resumed in the middle of an epoch. The
+    permutation only depends on the seed and the epoch, and the position (number of samples
+    already used in the epoch, updated with advance) is saved in the state dict, so a resumed
+    run continues with the same samples in the same order. With several processes every
+    process takes its shard of the permutation, of the same length for all of them.
+
+    Parameters
+    ----------
+    num_samples (int): number of samples of the dataset
+    seed (int): seed of the permutations
+    rank (int): index of this process
+    world_size (int): number of processes
+    """
+
+    def __init__(self, num_samples, seed=0, rank=0, world_size=1):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples_rank = num_samples // world_size
+        self.epoch = 0
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        # A new epoch starts from the beginning, the restored epoch from its position
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+
+    def advance(self, n):
+        self.position = self.position + n
+
+    def augmentation_seed(self):
+        """
+        Seed of the augmentations of this epoch, for Dataset_instance.
+        """
+        return int(np.random.SeedSequence([self.seed, self.epoch]).generate_state(1)[0])
+
+    def permutation(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_samples, generator=generator)
+
+        return indices[:self.num_samples_rank * self.world_size][self.rank::self.world_size]
+
+    def __iter__(self):
+        return iter(self.permutation()[self.position:].tolist())
+
+    def __len__(self):
+        return self.num_samples_rank - self.position
+
+    def state_dict(self):
+        return {"num_samples": self.num_samples,
+                "seed": self.seed,
+                "world_size": self.world_size,
+                "epoch": self.epoch,
+                "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        if (state_dict["num_samples"] != self.num_samples or state_dict["world_size"] != self.world_size):
+            raise ValueError(f"Sampler state of {state_dict['num_samples']} samples and {state_dict['world_size']} processes, "
+                             f"got {self.num_samples} samples and {self.world_size} processes")
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+
+
 class Balanced_Multimodal(torch.utils.data.sampler.Sampler):
 
     def __init__(self, dataset, indices=None, num_samples=None, alpha = 0.5):
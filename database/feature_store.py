@@ -0,0 +1,325 @@
+from pathlib import Path
+import os
+import zlib
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+from tqdm import tqdm
+import click
+
+thispath = Path(__file__).resolve()
+
+datadir = Path(thispath.parent.parent / "data")
+
+STORE_NAME = "feature_store"
+
+# bfloat16 has no numpy dtype, it is stored as the upper 16 bits of the float32 in uint16
+storage_dtypes = {"float32": np.dtype(np.float32),
+                  "float16": np.dtype(np.float16),
+                  "bfloat16": np.dtype(np.uint16)}
+
+
+def store_dir(featuresdir, store_name=STORE_NAME):
+    return Path(featuresdir / store_name)
+
+
+def view_name(wsi_id, view):
+    """
+    Name of the features of an augmented view of a WSI.
+    """
+    return f"{wsi_id}_view{view}"
+
+
+def to_bfloat16(features):
+    """
+    Rounds float32 features to bfloat16 (round to nearest even) and returns their bits as uint16.
+    """
+    bits = np.ascontiguousarray(features, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(stored):
+    return (stored.astype(np.uint32) << 16).view(np.float32)
+
+
+def encode_features(features, storage):
+    if storage == "bfloat16":
+        return to_bfloat16(features)
+    return np.ascontiguousarray(features, dtype=storage_dtypes[storage])
+
+
+def decode_features(stored, storage):
+    """
+    Features as float32. float32 stores are returned without copy.
+    """
+    if storage == "bfloat16":
+        return from_bfloat16(stored)
+    if storage == "float32":
+        return stored
+    return stored.astype(np.float32)
+
+
+def next_generation(storedir):
+    """
+    Generation of a new store, after the ones of the arrays in storedir (features_g<n>_<k>).
+    """
+    generations = [0]
+    for store_file in storedir.glob("features_g*_*"):
+        generation = store_file.name.split("_")[1][1:]
+        if generation.isdigit():
+            generations.append(int(generation))
+
+    return max(generations) + 1
+
+
+def build_feature_store(featuresdir, shard_size_gb=4, storage="float32", compression=None,
+                        store_name=STORE_NAME):
+    """
+    Consolidates the per-WSI .npy files of a features directory into a few contiguous
+    .npy arrays (features_g<n>_<k>.npy) saved in <featuresdir>/<store_name>, together with an
+    index.csv with the file, offset (first row), length (number of patches) and dim of every
+    WSI. Every build writes its arrays with the names of a new generation n and the index is
+    replaced last, so a store is only used once it is complete and a reader of the previous
+    index never sees the new arrays. The arrays of the previous generation are deleted after
+    the index is replaced.
+
+    The features can be stored in half precision (float16 or bfloat16). With compression
+    'zlib' the features of every WSI are compressed as a block and appended to
+    features_g<n>_<k>.bin, and the offset and nbytes of the index are in bytes.
+
+    Parameters
+    ----------
+    featuresdir (Path from pathlib): directory with the features of every WSI (<wsi>.npy)
+    shard_size_gb (float): maximum size of every consolidated array in GB (uncompressed)
+    storage (str): dtype of the stored features, 'float32', 'float16' or 'bfloat16'
+    compression (str): None or 'zlib'
+    store_name (str): name of the store directory inside featuresdir
+    """
+    if storage not in storage_dtypes:
+        raise ValueError(f"Storage {storage} not supported, use one of {list(storage_dtypes)}")
+    if compression not in (None, "zlib"):
+        raise ValueError(f"Compression {compression} not supported, use None or 'zlib'")
+
+    storedir = store_dir(featuresdir, store_name)
+    storedir.mkdir(exist_ok=True, parents=True)
+
+    features_files = natsorted([i for i in featuresdir.glob("*.npy")], key=lambda x: x.stem)
+    if len(features_files) == 0:
+        raise FileNotFoundError(f"No features .npy files found in {featuresdir}")
+
+    # Only the headers are read to plan the consolidated arrays
+    shapes = {}
+    for features_file in features_files:
+        shapes[features_file.stem] = np.load(features_file, mmap_mode="r").shape
+
+    dims = set(shape[1] for shape in shapes.values())
+    if len(dims) > 1:
+        raise ValueError(f"The features in {featuresdir} have different dims {dims}")
+    dim = dims.pop()
+    dtype = storage_dtypes[storage]
+
+    max_rows = max(1, int(shard_size_gb * 1024**3 // (dim * dtype.itemsize)))
+
+    # Assign the WSIs in order to the consolidated arrays
+    groups = [[]]
+    rows = 0
+    for features_file in features_files:
+        length = shapes[features_file.stem][0]
+        if rows + length > max_rows and len(groups[-1]) > 0:
+            groups.append([])
+            rows = 0
+        groups[-1].append(features_file)
+        rows += length
+
+    generation = next_generation(storedir)
+
+    index = []
+    for k, group in enumerate(groups):
+        if compression is None:
+            filename = f"features_g{generation}_{k}.npy"
+            index.extend(write_array(storedir, filename, group, shapes, dim, storage))
+        else:
+            filename = f"features_g{generation}_{k}.bin"
+            index.extend(write_compressed(storedir, filename, group, shapes, dim, storage))
+
+    index = pd.DataFrame(index, columns=["wsi", "file", "offset", "length", "dim", "nbytes"])
+    index["storage"] = storage
+    index["compression"] = compression if compression is not None else "none"
+    index.to_csv(Path(storedir / "index.csv.tmp"), index=False)
+    os.replace(Path(storedir / "index.csv.tmp"), Path(storedir / "index.csv"))
+
+    # Arrays of the previous generations, not referenced by the new index
+    store_files = set(index["file"])
+    for old_file in storedir.glob("features_*"):
+        if old_file.suffix in (".npy", ".bin") and old_file.name not in store_files:
+            old_file.unlink()
+
+    original_size = sum(i.stat().st_size for i in features_files)
+    store_size = sum(Path(storedir / i).stat().st_size for i in store_files)
+    print(f"Feature store with {len(index)} WSI in {len(groups)} arrays created in {storedir}")
+    print(f"Size {store_size / 1024**3:.2f} GB ({storage}, compression {compression}), "
+          f"{original_size / max(store_size, 1):.2f}x smaller than the .npy files")
+
+
+def write_array(storedir, filename, group, shapes, dim, storage):
+    """
+    Writes the features of a group of WSIs into a single .npy array. Returns the index rows.
+    """
+    total_rows = sum(shapes[i.stem][0] for i in group)
+    dtype = storage_dtypes[storage]
+
+    temporary_path = Path(storedir / f"{filename}.tmp")
+    consolidated = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=dtype,
+                                             shape=(total_rows, dim))
+    index = []
+    offset = 0
+    for features_file in tqdm(group, desc=f"Writing {filename}"):
+        length = shapes[features_file.stem][0]
+        consolidated[offset:offset + length] = encode_features(np.load(features_file, mmap_mode="r"), storage)
+        index.append((features_file.stem, filename, offset, length, dim, length * dim * dtype.itemsize))
+        offset += length
+    consolidated.flush()
+    del consolidated
+
+    os.replace(temporary_path, Path(storedir / filename))
+
+    return index
+
+
+def write_compressed(storedir, filename, group, shapes, dim, storage):
+    """
+    Appends the zlib compressed features of every WSI of a group to a single .bin file.
+    Returns the index rows, with the offset in bytes.
+    """
+    temporary_path = Path(storedir / f"{filename}.tmp")
+    index = []
+    offset = 0
+    with open(temporary_path, "wb") as f:
+        for features_file in tqdm(group, desc=f"Writing {filename}"):
+            length = shapes[features_file.stem][0]
+            stored = encode_features(np.load(features_file, mmap_mode="r"), storage)
+            block = zlib.compress(stored.tobytes(), 6)
+            f.write(block)
+            index.append((features_file.stem, filename, offset, length, dim, len(block)))
+            offset += len(block)
+
+    os.replace(temporary_path, Path(storedir / filename))
+
+    return index
+
+
+class FeatureStore:
+    """
+    Features of the WSIs of a features directory, always returned as float32. If the
+    directory has a consolidated float32 store (build_feature_store) the features of a WSI
+    are a read-only view of a memory-mapped array, so they are not copied and the pages are
+    shared through the page cache by every process and fold reading the same store. Half
+    precision stores are upcast and compressed stores are decompressed on read. WSIs not in
+    the store are read from their <wsi>.npy file.
+
+    Parameters
+    ----------
+    featuresdir (Path from pathlib): directory with the features of every WSI
+    store_name (str): name of the store directory inside featuresdir
+    """
+
+    def __init__(self, featuresdir, store_name=STORE_NAME):
+        self.featuresdir = Path(featuresdir)
+        self.storedir = store_dir(self.featuresdir, store_name)
+        self.index = {}
+        self.arrays = {}
+        self.storage = "float32"
+        self.compression = "none"
+
+        index_file = Path(self.storedir / "index.csv")
+        if index_file.exists():
+            index = pd.read_csv(index_file, dtype={"wsi": str, "file": str})
+            self.index = {wsi: (file, offset, length, dim, nbytes)
+                          for wsi, file, offset, length, dim, nbytes in zip(index["wsi"],
+                                                                            index["file"],
+                                                                            index["offset"],
+                                                                            index["length"],
+                                                                            index["dim"],
+                                                                            index["nbytes"])}
+            if len(index) > 0:
+                self.storage = index["storage"].iloc[0]
+                self.compression = index["compression"].iloc[0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, wsi_id):
+        return wsi_id in self.index or Path(self.featuresdir / f"{wsi_id}.npy").exists()
+
+    def length(self, wsi_id):
+        """
+        Number of patches of a WSI, without reading its features.
+        """
+        if wsi_id in self.index:
+            return int(self.index[wsi_id][2])
+        return np.load(Path(self.featuresdir / f"{wsi_id}.npy"), mmap_mode="r").shape[0]
+
+    def array(self, filename):
+        if filename not in self.arrays:
+            if self.compression == "none":
+                self.arrays[filename] = np.load(Path(self.storedir / filename), mmap_mode="r")
+            else:
+                self.arrays[filename] = np.memmap(Path(self.storedir / filename), dtype=np.uint8, mode="r")
+        return self.arrays[filename]
+
+    def __getitem__(self, wsi_id):
+        if wsi_id not in self.index:
+            return np.load(Path(self.featuresdir / f"{wsi_id}.npy"), mmap_mode="r").astype(np.float32, copy=False)
+
+        filename, offset, length, dim, nbytes = self.index[wsi_id]
+
+        if self.compression == "none":
+            stored = self.array(filename)[offset:offset + length]
+        else:
+            block = zlib.decompress(self.array(filename)[offset:offset + nbytes])
+            stored = np.frombuffer(block, dtype=storage_dtypes[self.storage]).reshape(length, dim)
+
+        return decode_features(stored, self.storage)
+
+
+@click.command()
+@click.option(
+    "--featuresdir",
+    default="Features_resnet34_v2_NoChannel",
+    prompt="Features directory inside data/Saved_features",
+    help="Features directory inside data/Saved_features (e.g. tcga/Features_resnet34_v2_NoChannel)",
+)
+@click.option(
+    "--shard_size_gb",
+    default=4.0,
+    help="Maximum size in GB of every consolidated array",
+)
+@click.option(
+    "--storage",
+    default="float32",
+    type=click.Choice(list(storage_dtypes)),
+    help="Dtype of the stored features",
+)
+@click.option(
+    "--compression",
+    default="none",
+    type=click.Choice(["none", "zlib"]),
+    help="Block compression of the features of every WSI",
+)
+@click.option(
+    "--store_name",
+    default=STORE_NAME,
+    help="Name of the store directory inside the features directory",
+)
+def main(featuresdir, shard_size_gb, storage, compression, store_name):
+    build_feature_store(Path(datadir / "Saved_features" / featuresdir),
+                        shard_size_gb,
+                        storage,
+                        None if compression == "none" else compression,
+                        store_name)
+
+
+if __name__ == "__main__":
+    main()
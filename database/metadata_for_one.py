@@ -6,12 +6,12 @@ import openslide
 from tqdm import tqdm
 import cv2 as cv
 import click
-from utils import available_magnifications
+from utils import available_magnifications, masked_slide_statistics
 
 thispath = Path(__file__).resolve()
 
 
-def metadata_one(image_index):
+def metadata_one(image_index, level=0):
 
 
     datadir = Path("/mnt/nas4/datasets/ToReadme/ExaMode_Dataset1/AOEC")
@@ -44,19 +44,16 @@ def metadata_one(image_index):
     level_downsamples = slide.level_downsamples
     mags = available_magnifications(mpp, level_downsamples)
 
-    binary_mask = cv.imread(str(resultdir / f"binary_{svs_file.stem}.png"))
+    mask_file = Path(resultdir / f"binary_{svs_file.stem}.png")
+    binary_mask = cv.imread(str(mask_file))
+    if binary_mask is None:
+        raise FileNotFoundError(f"Binary mask of the slide {svs_file.stem} not found or unreadable: {mask_file}")
     binary_mask[binary_mask == 255] = 1
 
-    thumbnail = slide.get_thumbnail(level_dimensions[0])
-
-    thumbnail_data = np.array(thumbnail)
-    thumbnail_shape = thumbnail_data.shape
-
-    binary_mask = cv.resize(binary_mask, (thumbnail_shape[1], thumbnail_shape[0]))
-
-    thumb_data_masked = np.ma.array(thumbnail_data, mask=np.logical_not(binary_mask))
-    mean_thumb_data = np.mean(thumb_data_masked, axis=(0, 1))
-    std_thumb_data = np.std(thumb_data_masked, axis=(0, 1))
+    # Stream the slide tile by tile instead of loading the whole level in memory
+    mean_thumb_data, std_thumb_data, thumbnail_shape = masked_slide_statistics(slide,
+                                                                               binary_mask,
+                                                                               level=level)
 
     metadata.loc[svs_file.stem] = [level_dimensions, level_downsamples, mags,
                                     mpp, number_patches, patch_shape, center,
@@ -73,8 +70,13 @@ def metadata_one(image_index):
     prompt="Image index",
     help="Image index",
 )
-def main(image_index):
-	metadata_one(image_index)
+@click.option(
+    "--level",
+    default=0,
+    help="Level of the WSI used to compute the mean and std within the mask",
+)
+def main(image_index, level):
+	metadata_one(image_index, level)
 	
 if __name__ == "__main__":
     main()
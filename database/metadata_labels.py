@@ -1,14 +1,19 @@
 from pathlib import Path
+import csv
 import json
 import pandas as pd
 import numpy as np
-from utils import csv_writer
 
 thispath = Path(__file__).resolve()
 
 
 def labels_from_json_he():
-
+    """
+    Creates labels.csv and labels_test.csv from the JSON files with the automatic labels.
+    Every JSON file is parsed once: membership is checked against sets of the image IDs and
+    the repeated IDs are collected in the same pass. If there are repeated IDs they are
+    saved in repeated_in_json.csv and the labels are not created.
+    """
     datadir = Path(thispath.parent.parent / "data")
     jsondir = Path(datadir / "csv_folder" / "lung_autolabels_v2")
     # Opening JSON file
@@ -16,64 +21,50 @@ def labels_from_json_he():
 
     he_csv = np.squeeze(pd.read_csv(Path(datadir / "lung_data" / "he_images.csv")).to_numpy())
     test_csv = np.squeeze(pd.read_csv(Path(datadir / "lung_data" / "test_images.csv")).to_numpy())
-    
-    clean_he_csv = [i[4:-4] for i in he_csv]
-    clean_test_csv = [i[:-4].replace("-", "/") for i in test_csv]
 
-    he_json = []
-    test_json = []
+    # Image ID (without prefix and extension) -> name of the image without extension.
+    # The first image of he_images.csv wins if an ID is repeated.
+    he_names = {}
+    for name in he_csv:
+        he_names.setdefault(name[4:-4], name.split(".")[0])
+    clean_test_csv = set(i[:-4].replace("-", "/") for i in test_csv)
+
+    number_he_json = 0
+    seen_he_json = set()
+    repeated_he_json = []
+    labels_he = {}
+    labels_test = {}
     for file in json_files:
-        f = open(file)
-        data =json.load(f)
-        matches = [i for i in data.keys() if i.split("_")[0] in clean_he_csv]
-        matches_test = [i for i in data.keys() if i in clean_test_csv]
-        he_json.extend(matches)
-        test_json.extend(matches_test)
-        f.close()
-
-    if len(he_json) > len(clean_he_csv):
-        he_json = np.array(he_json)
-        m = np.zeros_like(he_json, dtype=bool)
-        m[np.unique(he_json, return_index=True)[1]] = True
-
+        with open(file) as f:
+            data = json.load(f)
+        for num, labels in data.items():
+            if num.split("_")[0] in he_names:
+                number_he_json += 1
+                if num in seen_he_json:
+                    repeated_he_json.append(num)
+                seen_he_json.add(num)
+                labels_he[num] = labels
+            if num in clean_test_csv:
+                labels_test[num] = labels
+
+    if number_he_json > len(he_csv):
         header = ["This images are repeated in JSON files"]
-        csv_writer(datadir, "repeated_in_json.csv", "w", header)
-        for a, num in zip(m, he_json):
-            if a == False:
-                csv_writer(datadir, "repeated_in_json.csv", "a", [num])
+        with open(Path(datadir / "repeated_in_json.csv"), "w", encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows([num] for num in repeated_he_json)
         print(f"Found repeated values in JSON files. Saved in .csv file in {datadir}")
 
     else:
         print("Not repeated values found on the JSON files")
 
-        # Eliminate images repeated between JSON files
-        he_json = np.unique(he_json)
-        test_json = np.unique(test_json)
-
-        # Obtain levels from JSON files from images contained in the he_images.csv
-        labels_he = {}
-        labels_test = {}
-        for file in json_files:
-            f = open(file)
-            data =json.load(f)
-            for num, labels in zip(data, data.values()):
-                if num in he_json:
-                    labels_he[num] = labels
-                if num in test_json:
-                    labels_test[num] = labels     
-            f.close()
-
-        labels_df = pd.DataFrame.from_dict(labels_he, orient="index") 
+        labels_df = pd.DataFrame.from_dict(labels_he, orient="index")
         labels_df.sort_index(inplace=True)
-        for col, _ in labels_df.iterrows():
-            for name in he_csv:
-                if col.split("_")[0] in name:
-                    name = name.split(".")[0]
-                    labels_df.rename(index={col: name}, inplace=True)
+        labels_df.index = labels_df.index.map(lambda num: he_names[num.split("_")[0]])
         labels_df.drop("cancer_nscc_large", inplace=True, axis=1)
         labels_df.to_csv(Path(datadir / "labels.csv"), header=True, index_label="image_num")
 
-        labels_df_test = pd.DataFrame.from_dict(labels_test, orient="index") 
+        labels_df_test = pd.DataFrame.from_dict(labels_test, orient="index")
         labels_df_test.sort_index(inplace=True)
         labels_df_test.drop("cancer_nscc_large", inplace=True, axis=1)
         labels_df_test.to_csv(Path(datadir / "labels_test.csv"), header=True, index_label="image_num")
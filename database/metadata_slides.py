@@ -6,54 +6,137 @@ import openslide
 from tqdm import tqdm
 import cv2 as cv
 from natsort import natsorted
-from utils import available_magnifications
+from concurrent.futures import ThreadPoolExecutor
+from utils import masked_slide_statistics
+from utils.slide_headers import slide_headers, is_up_to_date
 
 thispath = Path(__file__).resolve()
 
 
-def metadata_slides_csv():
+def slide_metadata(svs_file, maskdir, header, stats_downsample):
+    """
+    Collects the metadata of one WSI from the PyHIST outputs and the cached header of the slide.
+
+    Parameters
+    ----------
+    svs_file (Path from pathlib): path to the WSI
+    maskdir (Path from pathlib): directory with the PyHIST outputs
+    header (pandas.Series): cached header of the WSI (see utils.slide_headers)
+    stats_downsample (int): downsample of the level used to compute the stain statistics
+
+    Returns
+    -------
+    metadata (dict): row of the metadata .csv file
+    """
+    patchdir = Path(maskdir / svs_file.parent.stem / svs_file.stem / f"{svs_file.stem}_tiles")
+    resultdir = Path(maskdir / svs_file.parent.stem / svs_file.stem)
+
+    with os.scandir(patchdir) as entries:
+        number_patches = sum(1 for _ in entries)
+
+    patches_metadata = pd.read_csv(Path(resultdir / "tile_selection.tsv"), sep='\t', nrows=1)
+    patch_shape = patches_metadata.iloc[0]["Width"]
+
+    center = svs_file.parent.parent.stem
+
+    # Stain statistics streamed from a downsampled level to keep memory bounded
+    mask_file = Path(resultdir / f"binary_{svs_file.stem}.png")
+    binary_mask = cv.imread(str(mask_file), cv.IMREAD_GRAYSCALE)
+    if binary_mask is None:
+        raise FileNotFoundError(f"Binary mask of the slide {svs_file.stem} not found or unreadable: {mask_file}")
+    binary_mask[binary_mask == 255] = 1
+    slide = openslide.OpenSlide(str(svs_file))
+    level_stats = slide.get_best_level_for_downsample(stats_downsample)
+    mean, std, _ = masked_slide_statistics(slide, binary_mask, level=level_stats)
+    slide.close()
+
+    df_csv = pd.read_csv(Path(resultdir / f"{svs_file.stem}_densely_filtered_metadata.csv"))
+    filtered_patches = df_csv["patch_name"].count()
+
+    return {"level_dimensions": header["level_dimensions"],
+            "level_downsamples": header["level_downsamples"],
+            "mpp": header["mpp"],
+            "number_patches": number_patches,
+            "number_filtered_patches": filtered_patches,
+            "patch_shape": patch_shape,
+            "center": center,
+            "mean": mean,
+            "std": std}
+
+
+def outputs_mtime(svs_file, maskdir):
+    """
+    Latest modification time (integer nanoseconds, exact through the .csv file) among the WSI
+    and the PyHIST outputs used for its metadata. A slide whose value changed since the last
+    run has to be processed again.
+    """
+    resultdir = Path(maskdir / svs_file.parent.stem / svs_file.stem)
+    sources = [svs_file,
+               Path(resultdir / "tile_selection.tsv"),
+               Path(resultdir / f"binary_{svs_file.stem}.png"),
+               Path(resultdir / f"{svs_file.stem}_densely_filtered_metadata.csv")]
+
+    return max(os.stat(i).st_mtime_ns for i in sources)
+
+
+def metadata_slides_csv(stats_downsample=16, num_workers=8):
+    """
+    Creates (or updates) the metadata_slides_v2.csv catalog. Only the slides that are new or
+    whose PyHIST outputs changed since the last run are processed, in parallel with a thread
+    pool, and the catalog is written once at the end.
+
+    Parameters
+    ----------
+    stats_downsample (int): downsample of the level used to compute the stain statistics
+    num_workers (int): number of threads used to process the slides
+    """
     datadir = Path("/mnt/nas6/data/lung_tcga/data")
     maskdir = Path(datadir.parent / "Mask_PyHIST_tif")
+    catalog_file = Path(maskdir / "metadata_slides_v2.csv")
 
     svs_files = natsorted([i for i in datadir.rglob("*.tif")], key=str)
 
-    subdirs = natsorted([e for e in maskdir.iterdir() if e.is_dir()])
-    list_dirs = []
-    for dir in subdirs:
-        list_dirs += [i for i in dir.iterdir() if i.is_dir()]
-
     print(f"Number of svs files for the metadata: {len(svs_files)}")
 
-    header = ["level_dimensions", "level_downsamples", "number_patches",
-              "number_filtered_patches", "patch_shape", "center"]
-
-    metadata = pd.DataFrame(columns=header)
+    headers = slide_headers(svs_files, num_workers=num_workers)
+
+    if catalog_file.exists():
+        previous = pd.read_csv(catalog_file, index_col=0, dtype={"ID wsi": str, "source_mtime_ns": "Int64"})
+    else:
+        previous = pd.DataFrame(columns=["source_mtime_ns"])
+
+    rows = {}
+    to_process = []
+    for svs_file in svs_files:
+        try:
+            mtime = outputs_mtime(svs_file, maskdir)
+        except FileNotFoundError as error:
+            print(f"Skipping the slide {svs_file.stem}, missing PyHIST output: {error.filename}")
+            continue
+        # Catalogs without source_mtime_ns (older versions) are processed again
+        if is_up_to_date(previous, svs_file.stem, "source_mtime_ns", mtime):
+            rows[svs_file.stem] = previous.loc[svs_file.stem].to_dict()
+        else:
+            to_process.append((svs_file, mtime))
+
+    print(f"{len(rows)} slides up to date, {len(to_process)} new or changed slides to process")
+
+    def process(item):
+        svs_file, mtime = item
+        metadata = slide_metadata(svs_file, maskdir, headers.loc[str(svs_file)], stats_downsample)
+        metadata["source_mtime_ns"] = mtime
+        return svs_file.stem, metadata
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for name, metadata in tqdm(executor.map(process, to_process),
+                                   total=len(to_process),
+                                   desc="Metadata .csv file in progress"):
+            rows[name] = metadata
+
+    metadata = pd.DataFrame.from_dict(rows, orient="index")
     metadata.index.name = "ID wsi"
-
-    for svs_file in tqdm(svs_files, desc="Metadata .csv file in progress"):
-        patchdir = Path(maskdir / svs_file.parent.stem / svs_file.stem / f"{svs_file.stem}_tiles")
-        resultdir = Path(maskdir / svs_file.parent.stem / svs_file.stem)
-
-        number_patches = len(os.listdir(patchdir))
-
-        patches_metadata = pd.read_csv(Path(resultdir / "tile_selection.tsv"), sep='\t').set_index("Tile")
-        patch_shape = patches_metadata.iloc[0]["Width"]
-
-        center = svs_file.parent.parent.stem
-
-        slide = openslide.OpenSlide(str(svs_file))
-
-        level_dimensions = slide.level_dimensions
-        level_downsamples = slide.level_downsamples
-
-        df_csv = pd.read_csv(Path(resultdir / f"{svs_file.stem}_densely_filtered_metadata.csv"))
-        filtered_patches = df_csv["patch_name"].count()
-
-        metadata.loc[svs_file.stem] = [level_dimensions, level_downsamples, number_patches, filtered_patches,
-                                       patch_shape, center]
-
     metadata.sort_index(axis=0, ascending=True, inplace=True)
-    metadata.to_csv(Path(maskdir / "metadata_slides_v2.csv"))
+    metadata.to_csv(catalog_file)
     print(f"metadata_slides.csv created in {maskdir}")
 
 
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+class PatchPathIndex:
+    """
+    Compact index of the paths of the patches: every path encoded in a single bytes blob
+    (uint8 array) with the offset of every path (int64 array). It has no Python object per
+    patch, so the DataLoader workers forked from the main process share its memory (no
+    refcount updates, no copy on write) and the memory does not grow with the number of
+    workers. Indexing returns the path as a str.
+
+    Parameters
+    ----------
+    blob (numpy.ndarray): uint8 array with the utf-8 encoded paths one after the other
+    offsets (numpy.ndarray): int64 array (N + 1) with the start of every path and the end
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_paths(cls, paths):
+        encoded = [str(path).encode() for path in paths]
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.fromiter((len(i) for i in encoded), dtype=np.int64, count=len(encoded)))
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        return cls(blob, offsets)
+
+    @classmethod
+    def from_csv_files(cls, csv_files):
+        """
+        Index of the patches of the filtered patches .csv files (path in the first column) of
+        every WSI, one file at a time.
+        """
+        blobs = []
+        lengths = []
+        for csv_file in tqdm(csv_files, desc="Indexing patches"):
+            encoded = [str(path).encode() for path in pd.read_csv(csv_file).iloc[:, 0]]
+            blobs.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            lengths.append(np.fromiter((len(i) for i in encoded), dtype=np.int64, count=len(encoded)))
+
+        lengths = np.concatenate(lengths) if len(lengths) > 0 else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        blob = np.concatenate(blobs) if len(blobs) > 0 else np.zeros(0, dtype=np.uint8)
+
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes().decode()
+
+    def nbytes(self):
+        return self.blob.nbytes + self.offsets.nbytes
+
+
+def patch_path(wsi_path_patches, index):
+    """
+    Path of a patch from a PatchPathIndex or from an array of the filtered patches .csv (N, 1).
+    """
+    if isinstance(wsi_path_patches, PatchPathIndex):
+        return wsi_path_patches[index]
+    return wsi_path_patches[index][0]
@@ -0,0 +1,77 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+def pin_bag(item):
+    return tuple(i.pin_memory() if torch.is_tensor(i) and not i.is_pinned() else i for i in item)
+
+
+class BagPrefetcher:
+    """
+    Iterates over a bag dataset (e.g. Dataset_bag_features) loading the next bags in
+    background threads while the current one is used, so the training loop does not wait
+    for the features. Threads are used instead of processes so every worker shares the
+    same bag cache.
+
+    Parameters
+    ----------
+    dataset (torch.utils.data.Dataset): dataset of bags
+    shuffle (bool): new random order of the bags in every iteration
+    depth (int): number of bags loaded ahead
+    num_workers (int): number of threads loading bags
+    pin_memory (bool): pin the features of the bags (only if CUDA is available)
+    batch_sampler (torch.utils.data.Sampler): yields the indices of every batch (e.g.
+        Bucket_batch_sampler), replaces shuffle
+    collate_fn (function): merges the bags of a batch (e.g. collate_bags)
+    """
+
+    def __init__(self, dataset, shuffle=False, depth=4, num_workers=2, pin_memory=True,
+                 batch_sampler=None, collate_fn=None):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.depth = max(1, depth)
+        self.num_workers = max(1, num_workers)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return len(self.dataset)
+
+    def order(self):
+        if self.batch_sampler is not None:
+            return list(self.batch_sampler)
+        if self.shuffle:
+            return torch.randperm(len(self.dataset)).tolist()
+        return list(range(len(self.dataset)))
+
+    def load(self, index):
+        if self.batch_sampler is not None:
+            item = self.collate_fn([self.dataset[i] for i in index])
+        else:
+            item = self.dataset[index]
+        if self.pin_memory:
+            item = pin_bag(item)
+        return item
+
+    def __iter__(self):
+        indices = iter(self.order())
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = deque()
+        try:
+            for index in indices:
+                pending.append(executor.submit(self.load, index))
+                if len(pending) >= self.depth:
+                    break
+
+            while pending:
+                item = pending.popleft().result()
+                for index in indices:
+                    pending.append(executor.submit(self.load, index))
+                    break
+                yield item
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
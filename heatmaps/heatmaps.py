@@ -12,7 +12,7 @@ import cv2 as cv
 import seaborn as sns
 import scipy.ndimage as ndimage
 from natsort import natsorted
-from training import ModelOption, yaml_load
+from training import ModelOption, load_checkpoint, yaml_load
 from utils import available_magnifications
 from database import Dataset_instance_MIL
 import pylab
@@ -277,14 +277,15 @@ def main(wsi_name, sigma):
                     num_freezed_layers=cfg.model.num_frozen_layers,
                     dropout=cfg.model.dropout,
                     embedding_bool=cfg.model.embedding_bool,
-                    pool_algorithm=cfg.model.pool_algorithm
+                    pool_algorithm=cfg.model.pool_algorithm,
+                    pretrained=False
                     )
 
     hidden_space_len = cfg.model.hidden_space_len
 
     net = MIL_model(model, hidden_space_len, cfg)
 
-    net.load_state_dict(checkpoint["model_state_dict"], strict=False)
+    load_checkpoint(net, checkpoint["model_state_dict"])
     net.to(device)
     net.eval()
 
@@ -0,0 +1,251 @@
+from pathlib import Path
+import json
+import os
+import logging
+import numpy as np
+import torch
+from tqdm import tqdm
+from training.utils_trainig import get_generator_instances
+from training.augmentation import generate_transformer
+from database.feature_store import view_name
+
+
+def parse_shard(shard):
+    """
+    Parses a shard given as 'i/N' (shard i of N, starting at 0).
+
+    Returns
+    -------
+    shard_index (int), num_shards (int)
+    """
+    shard_index, num_shards = [int(i) for i in shard.split("/")]
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+
+    return shard_index, num_shards
+
+
+def select_shard(names, shard_index, num_shards):
+    """
+    WSIs assigned to a shard. The assignment only depends on the position of the WSI in the
+    (sorted) list, so every machine running a different shard gets a disjoint subset.
+    """
+    return [name for i, name in enumerate(names) if i % num_shards == shard_index]
+
+
+def manifest_path(outputdir, shard_index, num_shards):
+    return Path(outputdir / f"manifest_shard{shard_index}of{num_shards}.jsonl")
+
+
+def finished_slides(outputdir):
+    """
+    WSIs whose features are complete, read from the manifests of every shard. A WSI only
+    counts as finished if its .npy file is still in the output directory.
+    """
+    finished = set()
+    for manifest in outputdir.glob("manifest_shard*.jsonl"):
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                # A job killed while writing leaves an incomplete last line
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if Path(outputdir / f"{entry['wsi']}.npy").exists():
+                    finished.add(entry["wsi"])
+
+    return finished
+
+
+def mark_finished(manifest, wsi_id, features):
+    with open(manifest, "a") as f:
+        f.write(json.dumps({"wsi": wsi_id,
+                            "number_patches": int(features.shape[0]),
+                            "dim": int(features.shape[1])}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_features(outputdir, wsi_id, features):
+    """
+    Saves the features of a WSI as <wsi_id>.npy. The array is written to a temporary file
+    first and renamed, so an interrupted job never leaves a truncated .npy behind.
+    """
+    outputpath = Path(outputdir / f"{wsi_id}.npy")
+    temporary_path = Path(outputdir / f"{wsi_id}.npy.tmp")
+    with open(temporary_path, "wb") as f:
+        np.save(f, features)
+    os.replace(temporary_path, outputpath)
+
+
+def slide_features(net, generator, n_elems, device):
+    """
+    Features of the patches of a WSI, written batch by batch into a preallocated array
+    (one row per patch, in the order of the patches .csv file).
+    """
+    features = np.empty((n_elems, net.fc_input_features), dtype=np.float32)
+
+    offset = 0
+    with torch.no_grad():
+        for instances in generator:
+            instances = instances.to(device, non_blocking=True)
+
+            feats = net.conv_layers(instances)
+            feats = feats.view(-1, net.fc_input_features)
+
+            features[offset:offset + feats.shape[0]] = feats.cpu().numpy()
+            offset += feats.shape[0]
+
+    return features
+
+
+def extract_features(net, patches_path, preprocess, outputdir, cfg, device, shard="0/1"):
+    """
+    Extracts and saves the features of every WSI of a shard. Finished WSIs are recorded in
+    the manifest of the shard and skipped when the job is restarted.
+
+    Parameters
+    ----------
+    net (MIL_model): model whose conv_layers extract the features
+    patches_path (dict): paths of the filtered patches (numpy.ndarray) of every WSI
+    preprocess (torchvision.transforms.Compose): preprocessing of the patches
+    outputdir (Path from pathlib): directory where the features are saved
+    cfg (EasyDict): configuration of the feature extraction
+    device (torch.device): device of the model
+    shard (str): 'i/N' to extract the shard i of N
+    """
+    shard_index, num_shards = parse_shard(shard)
+
+    wsi_shard = select_shard(list(patches_path.keys()), shard_index, num_shards)
+    finished = finished_slides(outputdir)
+    pending = [wsi_id for wsi_id in wsi_shard if wsi_id not in finished]
+
+    logging.info(f"Shard {shard_index}/{num_shards}: {len(wsi_shard)} WSI, "
+                 f"{len(wsi_shard) - len(pending)} already extracted, {len(pending)} pending")
+
+    manifest = manifest_path(outputdir, shard_index, num_shards)
+
+    net.eval()
+    if cfg.dataloader.get("cross_slide", False):
+        extract_features_cross_slide(net, patches_path, pending, preprocess, outputdir, manifest,
+                                     cfg, device)
+        return
+
+    for wsi_id in tqdm(pending):
+
+        training_generator_instance = get_generator_instances(patches_path[wsi_id],
+                                                              preprocess,
+                                                              cfg.dataloader.batch_size,
+                                                              None,
+                                                              cfg.dataloader.num_workers,
+                                                              shuffle=False)
+
+        features = slide_features(net, training_generator_instance, len(patches_path[wsi_id]), device)
+
+        save_features(outputdir, wsi_id, features)
+        mark_finished(manifest, wsi_id, features)
+
+
+def extract_augmented_views(net, patches_path, preprocess, outputdir, cfg, device, num_views, shard="0/1"):
+    """
+    Extracts and saves num_views augmented views of the features of every WSI of a shard, as
+    <wsi>_view<k>.npy. Every view uses a new random pipeline of generate_transformer, as the
+    online data augmentation of the MIL training. Finished views are recorded in the manifest
+    of the shard and skipped when the job is restarted.
+
+    Parameters
+    ----------
+    num_views (int): number of augmented views per WSI
+    The rest as in extract_features
+    """
+    shard_index, num_shards = parse_shard(shard)
+
+    wsi_shard = select_shard(list(patches_path.keys()), shard_index, num_shards)
+    finished = finished_slides(outputdir)
+    pending = [(wsi_id, view) for wsi_id in wsi_shard for view in range(num_views)
+               if view_name(wsi_id, view) not in finished]
+
+    logging.info(f"Shard {shard_index}/{num_shards}: {len(wsi_shard)} WSI x {num_views} views, "
+                 f"{len(wsi_shard) * num_views - len(pending)} already extracted, {len(pending)} pending")
+
+    manifest = manifest_path(outputdir, shard_index, num_shards)
+
+    net.eval()
+    for wsi_id, view in tqdm(pending):
+
+        pipeline_transform = generate_transformer(cfg.data_augmentation.prob)
+
+        training_generator_instance = get_generator_instances(patches_path[wsi_id],
+                                                              preprocess,
+                                                              cfg.dataloader.batch_size,
+                                                              pipeline_transform,
+                                                              cfg.dataloader.num_workers,
+                                                              shuffle=False)
+
+        features = slide_features(net, training_generator_instance, len(patches_path[wsi_id]), device)
+
+        save_features(outputdir, view_name(wsi_id, view), features)
+        mark_finished(manifest, view_name(wsi_id, view), features)
+
+
+def extract_features_cross_slide(net, patches_path, pending, preprocess, outputdir, manifest, cfg, device):
+    """
+    Extracts the features of the pending WSIs through a single DataLoader over the patches of
+    all of them, concatenated in order. Batches are full and span slide boundaries, and the
+    workers are spawned once. The rows of each batch are split into the WSIs with the offsets
+    of the slides, and every WSI is saved (and marked as finished) as soon as it is complete.
+    """
+    dim = net.fc_input_features
+
+    # WSIs without patches are saved directly
+    for wsi_id in [i for i in pending if len(patches_path[i]) == 0]:
+        features = np.empty((0, dim), dtype=np.float32)
+        save_features(outputdir, wsi_id, features)
+        mark_finished(manifest, wsi_id, features)
+    pending = [i for i in pending if len(patches_path[i]) > 0]
+
+    if len(pending) == 0:
+        return
+
+    offsets = np.cumsum([0] + [len(patches_path[i]) for i in pending])
+
+    generator = get_generator_instances(np.concatenate([patches_path[i] for i in pending]),
+                                        preprocess,
+                                        cfg.dataloader.batch_size,
+                                        None,
+                                        cfg.dataloader.num_workers,
+                                        shuffle=False)
+
+    slide = 0
+    features = np.empty((offsets[1], dim), dtype=np.float32)
+    position = 0
+    progress = tqdm(total=len(pending))
+
+    with torch.no_grad():
+        for instances in generator:
+            instances = instances.to(device, non_blocking=True)
+
+            feats = net.conv_layers(instances)
+            feats = feats.view(-1, dim).cpu().numpy()
+
+            start = 0
+            while start < feats.shape[0]:
+                n_rows = min(feats.shape[0] - start, offsets[slide + 1] - position)
+                row = position - offsets[slide]
+                features[row:row + n_rows] = feats[start:start + n_rows]
+                start += n_rows
+                position += n_rows
+
+                if position == offsets[slide + 1]:
+                    save_features(outputdir, pending[slide], features)
+                    mark_finished(manifest, pending[slide], features)
+                    progress.update(1)
+
+                    slide += 1
+                    if slide < len(pending):
+                        features = np.empty((offsets[slide + 1] - offsets[slide], dim), dtype=np.float32)
+
+    progress.close()
@@ -8,6 +8,7 @@ from natsort import natsorted
 import openslide
 import time
 from preprocessing import eval_histogram_threshold, get_histogram
+from utils import load_binary_mask
 
 thispath = Path(__file__).resolve()
 
@@ -17,9 +18,8 @@ datadir = Path("/mnt/nas6/data/ExaMode_data/Radboudumc")
 def filter_patches(list_dirs, maskdir):
 
     for filename in tqdm(list_dirs, desc="Filtering patches from PyHIST"):
-        binary_mask = cv.imread(str(Path(maskdir / filename.stem /
-                                         f"binary_{filename.stem}.png")))
-        binary_mask[binary_mask == 255] = 1
+        # Binarized in memory from the PyHIST mask, no need of the binary_*.png file
+        binary_mask = load_binary_mask(filename)
         mask_shape = binary_mask.shape
         binary_mask = cv.resize(binary_mask, (int(mask_shape[1]*0.125), int(mask_shape[0]*0.125)))
         mask_shape = binary_mask.shape
@@ -8,6 +8,7 @@ from natsort import natsorted
 import openslide
 import time
 from preprocessing import eval_histogram_threshold, get_histogram
+from utils import load_binary_mask
 
 thispath = Path(__file__).resolve()
 
@@ -20,9 +21,8 @@ def filter_patches(list_dirs, maskdir):
 
     for filename in tqdm(list_dirs, desc="Filtering patches from PyHIST"):
 
-        binary_mask = cv.imread(str(Path(maskdir / filename.parent.stem / f"{filename.stem}" / 
-                                         f"binary_{filename.stem}.png")))
-        binary_mask[binary_mask == 255] = 1
+        # Binarized in memory from the PyHIST mask, no need of the binary_*.png file
+        binary_mask = load_binary_mask(filename)
         mask_shape = binary_mask.shape
         binary_mask = cv.resize(binary_mask, (int(mask_shape[1]*0.5), int(mask_shape[0]*0.5)))
         mask_shape = binary_mask.shape
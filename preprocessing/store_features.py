@@ -7,8 +7,9 @@ from torchvision import transforms
 import numpy as np
 import pandas as pd
 from training.mil import MIL_model
-from training.models import ModelOption
-from training.utils_trainig import yaml_load, edict2dict, get_generator_instances
+from training.models import ModelOption, load_checkpoint
+from training.utils_trainig import yaml_load, edict2dict
+from preprocessing.feature_extraction import extract_features
 import logging
 import yaml
 import click
@@ -35,7 +36,12 @@ device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     prompt="Name of the MoCo experiment",
     help="Name of the MoCo experiment",
 )
-def main(config_file, exp_name_moco):
+@click.option(
+    "--shard",
+    default="0/1",
+    help="Shard i/N of the WSI to extract, to split the extraction across machines",
+)
+def main(config_file, exp_name_moco, shard):
 	# Seed for reproducibility
 	seed = 33
 	torch.manual_seed(seed)
@@ -91,7 +97,8 @@ def main(config_file, exp_name_moco):
 				num_freezed_layers=cfg.model.num_frozen_layers,
 				dropout=cfg.model.dropout,
 				embedding_bool=cfg.model.embedding_bool,
-				pool_algorithm=cfg.model.pool_algorithm
+				pool_algorithm=cfg.model.pool_algorithm,
+				pretrained=False
 				)
 
 
@@ -106,7 +113,7 @@ def main(config_file, exp_name_moco):
 	hidden_space_len = cfg.model.hidden_space_len
 
 	net = MIL_model(model, hidden_space_len, cfg)
-	net.load_state_dict(checkpoint_moco["encoder_state_dict"], strict=False)
+	load_checkpoint(net, checkpoint_moco["encoder_state_dict"])
 	net.to(device)
 	net.eval()
 
@@ -126,33 +133,7 @@ def main(config_file, exp_name_moco):
 	logging.info(f"Total number of WSI for train/validation {len(patches_path)}")
 
 
-	for wsi_id, path_for_patches in tqdm(patches_path.items()):
-
-		n_elems = len(path_for_patches)
-
-		training_generator_instance = get_generator_instances(patches_path[wsi_id], 
-                                                              preprocess,
-                                                              cfg.dataloader.batch_size, 
-                                                              None,
-                                                              cfg.dataloader.num_workers)
-
-		features = []
-		with torch.no_grad():
-			for instances in training_generator_instance:
-				instances = instances.to(device, non_blocking=True)
-
-				# forward + backward + optimize
-				feats = net.conv_layers(instances)
-				feats = feats.view(-1, net.fc_input_features)
-				feats_np = feats.cpu().data.numpy()
-
-				features = np.append(features,feats_np)
-
-				#del instances
-			#del instances
-		features_np = np.reshape(features, (n_elems, net.fc_input_features))
-
-		np.save(outputdir / f"{wsi_id}.npy", features_np)
+	extract_features(net, patches_path, preprocess, outputdir, cfg, device, shard)
 
 
 if __name__ == '__main__':
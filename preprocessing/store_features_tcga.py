@@ -8,7 +8,8 @@ import numpy as np
 import pandas as pd
 from training.mil import MIL_model
 from training.models import ModelOption
-from training.utils_trainig import yaml_load, edict2dict, get_generator_instances
+from training.utils_trainig import yaml_load, edict2dict
+from preprocessing.feature_extraction import extract_features
 import logging
 import yaml
 import click
@@ -35,7 +36,12 @@ device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     prompt="Name of the MoCo experiment",
     help="Name of the MoCo experiment",
 )
-def main(config_file, exp_name_moco):
+@click.option(
+    "--shard",
+    default="0/1",
+    help="Shard i/N of the WSI to extract, to split the extraction across machines",
+)
+def main(config_file, exp_name_moco, shard):
 	# Seed for reproducibility
 	seed = 33
 	torch.manual_seed(seed)
@@ -130,34 +136,7 @@ def main(config_file, exp_name_moco):
 	logging.info(f"Total number of WSI for train/validation {len(patches_path)}")
 
 
-	for wsi_id, path_for_patches in tqdm(patches_path.items()):
-
-		n_elems = len(path_for_patches)
-
-		training_generator_instance = get_generator_instances(patches_path[wsi_id], 
-                                                              preprocess,
-                                                              cfg.dataloader.batch_size, 
-                                                              None,
-                                                              cfg.dataloader.num_workers)
-
-		net.eval()
-		features = []
-		with torch.no_grad():
-			for instances in training_generator_instance:
-				instances = instances.to(device, non_blocking=True)
-
-				# forward + backward + optimize
-				feats = net.conv_layers(instances)
-				feats = feats.view(-1, net.fc_input_features)
-				feats_np = feats.cpu().data.numpy()
-
-				features = np.append(features,feats_np)
-
-				#del instances
-			#del instances
-		features_np = np.reshape(features, (n_elems, net.fc_input_features))
-
-		np.save(outputdir / f"{wsi_id}.npy", features_np)
+	extract_features(net, patches_path, preprocess, outputdir, cfg, device, shard)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,34 @@
+import pytest
+import numpy as np
+import cv2 as cv
+from utils.binarization_pyhist import binary_mask_pyhist, binary_path, load_binary_mask
+
+
+def test_overwrite_rewrites_existing_masks(tmp_path):
+    resultdir = tmp_path / "center" / "wsi"
+    resultdir.mkdir(parents=True)
+
+    # Background in the corners, tissue in the middle
+    color_mask = np.zeros((16, 16, 3), dtype=np.uint8)
+    color_mask[4:12, 4:12] = (0, 0, 255)
+    mask = resultdir / "segmented_wsi.ppm"
+    cv.imwrite(str(mask), color_mask)
+
+    outputpath = binary_path(mask)
+    cv.imwrite(str(outputpath), np.zeros((16, 16), dtype=np.uint8))
+
+    binary_mask_pyhist(tmp_path, num_workers=1, overwrite=False)
+    assert cv.imread(str(outputpath), cv.IMREAD_GRAYSCALE).max() == 0
+
+    binary_mask_pyhist(tmp_path, num_workers=1, overwrite=True)
+    binary_mask = cv.imread(str(outputpath), cv.IMREAD_GRAYSCALE)
+    assert binary_mask[8, 8] > 0
+    assert binary_mask[0, 0] == 0
+
+
+def test_missing_masks_name_the_slide(tmp_path):
+    resultdir = tmp_path / "center" / "wsi_missing"
+    resultdir.mkdir(parents=True)
+
+    with pytest.raises(FileNotFoundError, match="wsi_missing"):
+        load_binary_mask(resultdir)
@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("wandb")
+pytest.importorskip("sklearn")
+from training.utils_trainig import contrastive_loss
+
+
+def reference_infonce(q, k, queue, temperature):
+    # MoCo: cross entropy of [l_pos, l_neg] / T with the positive key as label 0
+    l_pos = torch.einsum("nc,nc->n", q, k).unsqueeze(-1)
+    l_neg = torch.einsum("nc,kc->nk", q, queue)
+    logits = torch.cat([l_pos, l_neg], dim=1) / temperature
+    labels = torch.zeros(logits.shape[0], dtype=torch.long)
+
+    return torch.nn.functional.cross_entropy(logits, labels)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 100, 37])
+@pytest.mark.parametrize("temperature", [0.07, 0.2])
+def test_contrastive_loss_matches_reference(chunk_size, temperature):
+    torch.manual_seed(0)
+    q = torch.nn.functional.normalize(torch.randn(16, 128, dtype=torch.float64), dim=1).float()
+    k = torch.nn.functional.normalize(torch.randn(16, 128, dtype=torch.float64), dim=1).float()
+    queue = torch.nn.functional.normalize(torch.randn(1000, 128, dtype=torch.float64), dim=1).float()
+
+    q_loss = q.clone().requires_grad_()
+    loss = contrastive_loss(q_loss, k, queue, temperature, chunk_size)
+    loss.backward()
+
+    q_reference = q.double().requires_grad_()
+    reference = reference_infonce(q_reference, k.double(), queue.double(), temperature)
+    reference.backward()
+
+    assert abs(loss.item() - reference.item()) < 1e-5
+    assert torch.allclose(q_loss.grad.double(), q_reference.grad, atol=1e-6)
@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+
+pytest.importorskip("pyspng")
+pytest.importorskip("torch")
+from database.feature_store import build_feature_store, FeatureStore, store_dir, from_bfloat16, to_bfloat16
+
+
+def save_features(featuresdir, lengths, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    features = {f"wsi_{i}": rng.standard_normal((length, dim)).astype(np.float32)
+                for i, length in enumerate(lengths)}
+    for wsi, array in features.items():
+        np.save(featuresdir / f"{wsi}.npy", array)
+
+    return features
+
+
+# Shards of about 40 rows of 8 float32
+shard_size_gb = 40 * 8 * 4 / 1024**3
+
+
+@pytest.mark.parametrize("storage, compression", [("float32", None),
+                                                  ("float16", None),
+                                                  ("bfloat16", None),
+                                                  ("float32", "zlib"),
+                                                  ("bfloat16", "zlib")])
+def test_round_trip(tmp_path, storage, compression):
+    features = save_features(tmp_path, [10, 25, 7, 31, 12])
+    build_feature_store(tmp_path, shard_size_gb, storage, compression)
+
+    store = FeatureStore(tmp_path)
+    assert len(store) == len(features)
+    assert len(set(i[0] for i in store.index.values())) > 1
+
+    for wsi, expected in features.items():
+        loaded = store[wsi]
+        assert loaded.dtype == np.float32
+        assert store.length(wsi) == len(expected)
+        if storage == "float32":
+            np.testing.assert_array_equal(loaded, expected)
+        elif storage == "float16":
+            np.testing.assert_array_equal(loaded, expected.astype(np.float16).astype(np.float32))
+        else:
+            np.testing.assert_array_equal(loaded, from_bfloat16(to_bfloat16(expected)))
+            np.testing.assert_allclose(loaded, expected, rtol=2**-8)
+
+
+def test_float32_is_a_memmap_view(tmp_path):
+    save_features(tmp_path, [10, 25])
+    build_feature_store(tmp_path)
+
+    store = FeatureStore(tmp_path)
+    filename = store.index["wsi_1"][0]
+    loaded = store["wsi_1"]
+
+    assert np.shares_memory(loaded, store.array(filename))
+    assert isinstance(loaded.base, np.memmap) or isinstance(loaded, np.memmap)
+    assert not loaded.flags.writeable
+
+
+def test_rebuild_replaces_the_previous_generation(tmp_path):
+    features = save_features(tmp_path, [10, 25, 7])
+    build_feature_store(tmp_path, shard_size_gb)
+    old_store = FeatureStore(tmp_path)
+    old_features = old_store["wsi_1"]
+    old_files = set(i.name for i in store_dir(tmp_path).glob("features_*"))
+
+    features = save_features(tmp_path, [10, 25, 7], seed=1)
+    build_feature_store(tmp_path, shard_size_gb, compression="zlib")
+    new_files = set(i.name for i in store_dir(tmp_path).glob("features_*"))
+
+    assert old_files.isdisjoint(new_files)
+    assert all(i.startswith("features_g2_") and i.endswith(".bin") for i in new_files)
+    assert set(i.name for i in store_dir(tmp_path).iterdir()) == new_files | {"index.csv"}
+
+    np.testing.assert_array_equal(FeatureStore(tmp_path)["wsi_1"], features["wsi_1"])
+    # Arrays already mapped by a reader of the previous index stay valid
+    assert old_features.shape == (25, 8)
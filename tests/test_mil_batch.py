@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("wandb")
+from easydict import EasyDict as edict
+from training.models import ModelOption
+from training.mil import MIL_model
+
+
+bag_sizes = [7, 1, 12, 4]
+
+
+def mil_model(featuresdir):
+    model = ModelOption("resnet34",
+                        4,
+                        embedding_bool=True,
+                        pool_algorithm="attention",
+                        build_backbone=False,
+                        pretrained=False)
+    cfg = edict({"data_augmentation": {"featuresdir": featuresdir}})
+
+    return MIL_model(model, 128, cfg).eval()
+
+
+def padded_batch(bags):
+    """Pads the bags to the largest one with big values, which only the mask keeps out of the attention"""
+    n_max = max(len(bag) for bag in bags)
+    features = torch.full((len(bags), n_max, bags[0].shape[1]), 1e4)
+    mask = torch.zeros(len(bags), n_max, dtype=torch.bool)
+    for i, bag in enumerate(bags):
+        features[i, :len(bag)] = bag
+        mask[i, :len(bag)] = True
+
+    return features, mask
+
+
+@pytest.mark.parametrize("featuresdir", ["Features_resnet34_NoChannel", "Features_resnet34_AChannel"])
+def test_padded_batch_matches_single_bags(featuresdir):
+    torch.manual_seed(0)
+    net = mil_model(featuresdir)
+    bags = [torch.randn(n, net.fc_input_features) for n in bag_sizes]
+    features, mask = padded_batch(bags)
+
+    with torch.no_grad():
+        logits, features_image = net(None, features, mask)
+        for i, bag in enumerate(bags):
+            logits_bag, features_image_bag = net(None, bag)
+            assert torch.allclose(logits[i], logits_bag, rtol=1e-4, atol=1e-5)
+            assert torch.allclose(features_image[i], features_image_bag.squeeze(0), rtol=1e-4, atol=1e-5)
+
+
+def test_padded_batch_matches_single_bags_under_bf16_autocast():
+    torch.manual_seed(0)
+    net = mil_model("Features_resnet34_NoChannel")
+    bags = [torch.randn(n, net.fc_input_features) for n in bag_sizes]
+    features, mask = padded_batch(bags)
+
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        logits, _ = net(None, features, mask)
+        logits_bags = torch.stack([net(None, bag)[0] for bag in bags])
+
+    assert torch.isfinite(logits).all()
+    assert torch.allclose(logits.float(), logits_bags.float(), rtol=2e-2, atol=2e-2)
@@ -0,0 +1,88 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("wandb")
+from easydict import EasyDict as edict
+from training.models import ModelOption, load_checkpoint, backbone_state_dict
+from training.mil import MIL_model
+
+
+cfg = edict({"data_augmentation": {"featuresdir": "Features_resnet34_NoChannel"}})
+
+
+def mil_model(build_backbone):
+    model = ModelOption("resnet34",
+                        4,
+                        embedding_bool=True,
+                        pool_algorithm="attention",
+                        build_backbone=build_backbone,
+                        pretrained=False)
+
+    return MIL_model(model, 128, cfg)
+
+
+def test_head_only_checkpoint_loads_with_backbone(tmp_path):
+    torch.manual_seed(0)
+
+    # Encoder of MoCo, the backbone of the MIL models
+    moco = mil_model(build_backbone=True).eval()
+    encoder_state_dict = moco.state_dict()
+
+    # Head-only training on stored features, saved as train_MIL_k_fold_rumc does
+    head = mil_model(build_backbone=False)
+    load_checkpoint(head, encoder_state_dict)
+    optimizer = torch.optim.SGD(head.parameters(), lr=0.1)
+    features = torch.randn(20, head.fc_input_features)
+    head(None, features)[0].sum().backward()
+    optimizer.step()
+
+    checkpoint_file = tmp_path / "MIL.pt"
+    torch.save({"model_state_dict": {**backbone_state_dict(encoder_state_dict), **head.state_dict()}},
+               checkpoint_file)
+
+    # Loaded as heatmaps.py and test_MIL_k_fold_rumc.py do, running the backbone on patches
+    net = mil_model(build_backbone=True)
+    load_checkpoint(net, torch.load(checkpoint_file)["model_state_dict"])
+    net.eval()
+    head.eval()
+
+    patches = torch.rand(3, 3, 64, 64)
+    with torch.no_grad():
+        features_patches = moco.conv_layers(patches).view(-1, net.fc_input_features)
+        assert torch.equal(net.conv_layers(patches).view(-1, net.fc_input_features), features_patches)
+        assert torch.allclose(net(patches, None)[0], head(None, features_patches)[0])
+
+
+@pytest.mark.parametrize("wrap_checkpoint, wrap_net", [(True, False), (False, True), (True, True)])
+def test_checkpoint_loads_with_other_data_parallel_wrapping(wrap_checkpoint, wrap_net):
+    torch.manual_seed(0)
+
+    # MIL_model and Encoder wrap conv_layers in DataParallel with more than one GPU
+    saved = mil_model(build_backbone=True)
+    if wrap_checkpoint:
+        saved.conv_layers = torch.nn.DataParallel(saved.conv_layers)
+    state_dict = saved.state_dict()
+
+    net = mil_model(build_backbone=True)
+    if wrap_net:
+        net.conv_layers = torch.nn.DataParallel(net.conv_layers)
+    keys = load_checkpoint(net, state_dict)
+    assert keys.missing_keys == [] and keys.unexpected_keys == []
+
+    backbone_saved = saved.conv_layers.module if wrap_checkpoint else saved.conv_layers
+    backbone_net = net.conv_layers.module if wrap_net else net.conv_layers
+    for weight_saved, weight_net in zip(backbone_saved.state_dict().values(), backbone_net.state_dict().values()):
+        assert torch.equal(weight_saved, weight_net)
+
+    assert all(key.startswith("conv_layers.") and not key.startswith("conv_layers.module.")
+               for key in backbone_state_dict(state_dict))
+
+
+def test_checkpoint_without_backbone_raises():
+    net = mil_model(build_backbone=True)
+    net.conv_layers = torch.nn.DataParallel(net.conv_layers)
+    head = mil_model(build_backbone=False)
+
+    with pytest.raises(KeyError):
+        load_checkpoint(net, head.state_dict())
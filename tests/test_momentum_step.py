@@ -0,0 +1,74 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("wandb")
+pytest.importorskip("sklearn")
+from training.utils_trainig import momentum_step
+
+
+def reference_momentum_step(encoder, momentum_encoder, m=1):
+    # Update of every entry of the state dict, loaded back with load_state_dict
+    params_q = encoder.state_dict()
+    params_k = momentum_encoder.state_dict()
+
+    dict_params_k = dict(params_k)
+
+    for name in params_q:
+        theta_k = dict_params_k[name]
+        theta_q = params_q[name].data
+        dict_params_k[name].data.copy_(m * theta_k + (1-m) * theta_q)
+
+    momentum_encoder.load_state_dict(dict_params_k)
+
+
+class Encoder(torch.nn.Module):
+    """Small encoder with BN, sharing its backbone between net and conv_layers as Encoder does"""
+    def __init__(self):
+        super().__init__()
+        self.net = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3),
+                                       torch.nn.BatchNorm2d(8),
+                                       torch.nn.ReLU(),
+                                       torch.nn.AdaptiveAvgPool2d(1),
+                                       torch.nn.Flatten(),
+                                       torch.nn.Linear(8, 8))
+        self.conv_layers = torch.nn.Sequential(*list(self.net.children())[:-1])
+        self.bn = torch.nn.BatchNorm1d(8)
+        self.fc = torch.nn.Linear(8, 4)
+
+    def forward(self, x):
+        return self.fc(self.bn(self.conv_layers(x)))
+
+
+def train_steps(encoder, steps):
+    optimizer = torch.optim.SGD(encoder.parameters(), lr=0.1)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        encoder(torch.randn(4, 3, 8, 8)).pow(2).mean().backward()
+        optimizer.step()
+
+
+@pytest.mark.parametrize("m", [0.999, 0.9, 0.5])
+def test_momentum_step_matches_state_dict_update(m):
+    torch.manual_seed(0)
+    encoder = Encoder().train()
+    momentum_encoder = copy.deepcopy(encoder)
+    reference_encoder = copy.deepcopy(encoder)
+
+    # The momentum encoder also runs BN in training, so its buffers differ from the encoder
+    train_steps(momentum_encoder, 3)
+    reference_encoder.load_state_dict(momentum_encoder.state_dict())
+
+    for _ in range(5):
+        train_steps(encoder, 2)
+        momentum_step(encoder, momentum_encoder, m)
+        reference_momentum_step(encoder, reference_encoder, m)
+
+        state_dict = momentum_encoder.state_dict()
+        reference_state_dict = reference_encoder.state_dict()
+        assert state_dict.keys() == reference_state_dict.keys()
+        assert any(name.endswith("num_batches_tracked") for name in state_dict)
+        for name in state_dict:
+            assert state_dict[name].dtype == reference_state_dict[name].dtype, name
+            assert torch.equal(state_dict[name], reference_state_dict[name]), name
@@ -1,5 +1,6 @@
-from .models import ModelOption
+from .models import ModelOption, load_checkpoint, load_head_checkpoint, backbone_state_dict
 from .encoder import Encoder
 from .utils_trainig import generate_list_instances, contrastive_loss, momentum_step, update_queue
 from .utils_trainig import yaml_load, initialize_wandb, edict2dict, cosine_similarity
 from .mil import MIL_model
+from .moco_queue import KeyQueue
@@ -0,0 +1,357 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+import albumentations as A
+
+
+def select_parameters_colour():
+    hue_min = -15
+    hue_max = 8
+
+    sat_min = -20
+    sat_max = 10
+
+    val_min = -8
+    val_max = 8
+
+
+    p1 = np.random.uniform(hue_min,hue_max,1)
+    p2 = np.random.uniform(sat_min,sat_max,1)
+    p3 = np.random.uniform(val_min,val_max,1)
+
+    return p1[0],p2[0],p3[0]
+
+def select_rgb_shift():
+    r_min = -10
+    r_max = 10
+
+    g_min = -10
+    g_max = 10
+
+    b_min = -10
+    b_max = 10
+
+
+    p1 = np.random.uniform(r_min,r_max,1)
+    p2 = np.random.uniform(g_min,g_max,1)
+    p3 = np.random.uniform(b_min,b_max,1)
+
+    return p1[0],p2[0],p3[0]
+
+def select_elastic_distorsion():
+    sigma_min = 0
+    sigma_max = 20
+
+    alpha_affine_min = -20
+    alpha_affine_max = 20
+
+    p1 = np.random.uniform(sigma_min,sigma_max,1)
+    p2 = np.random.uniform(alpha_affine_min,alpha_affine_max,1)
+
+    return p1[0],p2[0]
+
+def select_scale_distorsion():
+    scale_min = 0.8
+    scale_max = 1.0
+
+    p1 = np.random.uniform(scale_min,scale_max,1)
+
+    return p1[0]
+
+def select_grid_distorsion():
+    dist_min = 0
+    dist_max = 0.2
+
+    p1 = np.random.uniform(dist_min,dist_max,1)
+
+    return p1[0]
+
+def generate_transformer(prob = 0.5):
+    list_operations = []
+    probas = np.random.rand(7)
+
+    if (probas[0]>prob):
+        #print("VerticalFlip")
+        list_operations.append(A.VerticalFlip(always_apply=True))
+    if (probas[1]>prob):
+        #print("HorizontalFlip")
+        list_operations.append(A.HorizontalFlip(always_apply=True))
+    #"""
+    if (probas[2]>prob):
+        #print("RandomRotate90")
+        #list_operations.append(A.RandomRotate90(always_apply=True))
+
+        p_rot = np.random.rand(1)[0]
+        if (p_rot<=0.33):
+            lim_rot = 90
+        elif (p_rot>0.33 and p_rot<=0.66):
+            lim_rot = 180
+        else:
+            lim_rot = 270
+        list_operations.append(A.SafeRotate(always_apply=True, limit=(lim_rot,lim_rot+1e-4), interpolation=1, border_mode=4))
+
+    if (probas[3]>prob):
+        #print("HueSaturationValue")
+        p1, p2, p3 = select_parameters_colour()
+        list_operations.append(A.HueSaturationValue(always_apply=True,hue_shift_limit=(p1,p1+1e-4),sat_shift_limit=(p2,p2+1e-4),val_shift_limit=(p3,p3+1e-4)))
+
+    if (probas[4]>prob):
+        p1 = select_scale_distorsion()
+        list_operations.append(A.RandomResizedCrop(height=224, width=224, scale=(p1,p1+1e-4), always_apply=True))
+        #print(p1,p2,p3)
+
+    if (probas[5]>prob):
+        #p1, p2 = select_elastic_distorsion()
+        list_operations.append(A.ElasticTransform(alpha=1,border_mode=4, sigma=5, alpha_affine=5,always_apply=True))
+        #print(p1,p2)
+
+    if (probas[6]>prob):
+        p1 = select_grid_distorsion()
+        list_operations.append(A.GridDistortion(num_steps=3, distort_limit=p1, interpolation=1, border_mode=4, always_apply=True))
+        #print(p1)
+    pipeline_transform = A.Compose(list_operations)
+
+    return pipeline_transform
+
+
+def to_float_batch(images):
+    """
+    Batch of uint8 patches (B, H, W, 3) to float (B, 3, H, W) in [0, 1].
+    """
+    return images.permute(0, 3, 1, 2).float().div_(255)
+
+
+def normalize_batch(images, mean, std, size=None):
+    """
+    Batched equivalent of the preprocess of the patches (ToTensor, Normalize, Resize). Takes
+    uint8 patches (B, H, W, 3) or float patches (B, 3, H, W) in [0, 1].
+    """
+    if images.dtype == torch.uint8:
+        images = to_float_batch(images)
+
+    mean = torch.as_tensor(mean, dtype=images.dtype, device=images.device)[None, :, None, None]
+    std = torch.as_tensor(std, dtype=images.dtype, device=images.device)[None, :, None, None]
+    images = (images - mean) / std
+
+    if size is not None and tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode="bilinear", align_corners=False, antialias=True)
+
+    return images
+
+
+def rgb_to_hsv(images):
+    """
+    RGB (B, 3, H, W) in [0, 1] to HSV, with the hue in [0, 1).
+    """
+    r, g, b = images[:, 0], images[:, 1], images[:, 2]
+    maxc, _ = images.max(dim=1)
+    minc, _ = images.min(dim=1)
+    delta = maxc - minc
+    delta_safe = torch.where(delta > 0, delta, torch.ones_like(delta))
+
+    hue = torch.where(maxc == r, ((g - b) / delta_safe) % 6,
+                      torch.where(maxc == g, (b - r) / delta_safe + 2, (r - g) / delta_safe + 4))
+    hue = torch.where(delta > 0, hue / 6, torch.zeros_like(hue)) % 1.0
+    saturation = torch.where(maxc > 0, delta / torch.where(maxc > 0, maxc, torch.ones_like(maxc)),
+                             torch.zeros_like(maxc))
+
+    return torch.stack([hue, saturation, maxc], dim=1)
+
+
+def hsv_to_rgb(images):
+    """
+    HSV (B, 3, H, W), with the hue in [0, 1), to RGB in [0, 1].
+    """
+    hue, saturation, value = images[:, 0], images[:, 1], images[:, 2]
+    sector = torch.floor(hue * 6)
+    f = hue * 6 - sector
+    sector = sector.long() % 6
+
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * f)
+    t = value * (1 - saturation * (1 - f))
+
+    # (r, g, b) of every sector of the hue
+    candidates = torch.stack([torch.stack([value, t, p], dim=1),
+                              torch.stack([q, value, p], dim=1),
+                              torch.stack([p, value, t], dim=1),
+                              torch.stack([p, q, value], dim=1),
+                              torch.stack([t, p, value], dim=1),
+                              torch.stack([value, p, q], dim=1)], dim=1)
+    index = sector[:, None, None].expand(-1, 1, 3, -1, -1)
+
+    return torch.gather(candidates, 1, index)[:, 0]
+
+
+def grayscale(images):
+    return (0.299 * images[:, 0:1] + 0.587 * images[:, 1:2] + 0.114 * images[:, 2:3]).expand_as(images)
+
+
+def equalize(images):
+    """
+    Histogram equalization of every channel of every patch as cv2.equalizeHist (Equalize of
+    albumentations), on the patches quantized to uint8.
+    """
+    batch_size, channels, height, width = images.shape
+    values = (images * 255).round_().clamp_(0, 255).long().view(batch_size * channels, -1)
+
+    histogram = torch.zeros((batch_size * channels, 256), dtype=torch.float32, device=images.device)
+    histogram.scatter_add_(1, values, torch.ones_like(values, dtype=torch.float32))
+    cdf = histogram.cumsum(dim=1)
+
+    # First non zero value of the cdf
+    cdf_min = torch.where(histogram > 0, cdf, torch.full_like(cdf, float(height * width))).min(dim=1, keepdim=True)[0]
+    scale = (height * width - cdf_min).clamp_(min=1)
+    lut = ((cdf - cdf_min) * 255 / scale).round_().clamp_(0, 255)
+
+    # Channels with a single value are not changed
+    lut = torch.where(cdf_min == height * width, torch.arange(256, device=images.device, dtype=torch.float32)[None], lut)
+
+    return (torch.gather(lut, 1, values) / 255).view(batch_size, channels, height, width)
+
+
+class BatchAugmentation:
+    """
+    Augmentation of the MoCo queries applied to whole batches of patches (B, 3, H, W) in [0, 1]
+    on the device, with random parameters for every patch. Equivalent to the albumentations
+    pipeline of train_MoCo: RandomResizedCrop, vertical and horizontal flips and RandomRotate90
+    (one affine resampling), HueSaturationValue, ColorJitter, Equalize and ToGray. The costly
+    distortions (ElasticTransform, GridDistortion, GlassBlur, OpticalDistortion) are not
+    applied. ColorJitter applies brightness, contrast, saturation and hue in this order
+    instead of a random order.
+
+    Parameters
+    ----------
+    prob (float): probability of every augmentation (except HueSaturationValue, always applied)
+    crop_scale (tuple): range of the area of the resized crops
+    hue_shift, sat_shift, val_shift (tuple): ranges of HueSaturationValue (OpenCV uint8 units)
+    brightness, contrast, saturation, hue (float): ranges of ColorJitter
+    equalize_images (bool): apply the histogram equalization
+    gray_prob (float): probability of ToGray
+    """
+
+    def __init__(self, prob=0.5, crop_scale=(0.8, 1.0), hue_shift=(-25, 15), sat_shift=(-20, 30),
+                 val_shift=(-15, 15), brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1,
+                 equalize_images=True, gray_prob=0.2):
+        self.prob = prob
+        self.crop_scale = crop_scale
+        self.hue_shift = hue_shift
+        self.sat_shift = sat_shift
+        self.val_shift = val_shift
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.equalize_images = equalize_images
+        self.gray_prob = gray_prob
+
+    def uniform(self, low, high, batch_size, device):
+        return torch.empty(batch_size, device=device).uniform_(low, high)
+
+    def apply(self, batch_size, device, prob=None):
+        prob = self.prob if prob is None else prob
+        return torch.rand(batch_size, device=device) < prob
+
+    def geometry(self, images):
+        """
+        RandomResizedCrop, VerticalFlip, HorizontalFlip and RandomRotate90 as a single affine
+        grid per patch (the normalized coordinates of the output mapped to the input).
+        """
+        batch_size, _, height, width = images.shape
+        device = images.device
+
+        # Resized crop, area in crop_scale and aspect ratio in [3/4, 4/3]
+        area = self.uniform(*self.crop_scale, batch_size, device)
+        log_ratio = self.uniform(math.log(3 / 4), math.log(4 / 3), batch_size, device)
+        ratio = torch.exp(log_ratio)
+        crop_width = torch.sqrt(area * ratio).clamp(max=1.0)
+        crop_height = torch.sqrt(area / ratio).clamp(max=1.0)
+        crop = self.apply(batch_size, device)
+        crop_width = torch.where(crop, crop_width, torch.ones_like(crop_width))
+        crop_height = torch.where(crop, crop_height, torch.ones_like(crop_height))
+        center_x = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_width)
+        center_y = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_height)
+
+        # Flips, -1 flips the axis
+        flip_y = torch.where(self.apply(batch_size, device), -1.0, 1.0)
+        flip_x = torch.where(self.apply(batch_size, device), -1.0, 1.0)
+
+        # Rotations by k * 90 degrees
+        k = torch.randint(0, 4, (batch_size,), device=device)
+        k = torch.where(self.apply(batch_size, device), k, torch.zeros_like(k))
+        angle = k.float() * (math.pi / 2)
+        cos = torch.cos(angle).round()
+        sin = torch.sin(angle).round()
+
+        # output -> rotation^-1 -> flips -> crop -> input
+        rotation = torch.stack([torch.stack([cos, sin], dim=1),
+                                torch.stack([-sin, cos], dim=1)], dim=1)
+        scale = torch.stack([torch.stack([crop_width * flip_x, torch.zeros_like(cos)], dim=1),
+                             torch.stack([torch.zeros_like(cos), crop_height * flip_y], dim=1)], dim=1)
+        theta = torch.cat([torch.bmm(scale, rotation),
+                           torch.stack([center_x, center_y], dim=1)[:, :, None]], dim=2)
+
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+
+        return F.grid_sample(images, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+
+    def hue_saturation_value(self, images):
+        batch_size, device = images.shape[0], images.device
+
+        hsv = rgb_to_hsv(images)
+        hue_shift = self.uniform(*self.hue_shift, batch_size, device) / 180
+        sat_shift = self.uniform(*self.sat_shift, batch_size, device) / 255
+        val_shift = self.uniform(*self.val_shift, batch_size, device) / 255
+
+        hsv = torch.stack([(hsv[:, 0] + hue_shift[:, None, None]) % 1.0,
+                           (hsv[:, 1] + sat_shift[:, None, None]).clamp(0, 1),
+                           (hsv[:, 2] + val_shift[:, None, None]).clamp(0, 1)], dim=1)
+
+        return hsv_to_rgb(hsv)
+
+    def color_jitter(self, images):
+        batch_size, device = images.shape[0], images.device
+        jitter = self.apply(batch_size, device)[:, None, None, None]
+
+        brightness = self.uniform(1 - self.brightness, 1 + self.brightness, batch_size, device)[:, None, None, None]
+        contrast = self.uniform(1 - self.contrast, 1 + self.contrast, batch_size, device)[:, None, None, None]
+        saturation = self.uniform(1 - self.saturation, 1 + self.saturation, batch_size, device)[:, None, None, None]
+        hue = self.uniform(-self.hue, self.hue, batch_size, device)[:, None, None]
+
+        jittered = (images * brightness).clamp(0, 1)
+
+        mean = grayscale(jittered).mean(dim=(1, 2, 3), keepdim=True)
+        jittered = ((jittered - mean) * contrast + mean).clamp(0, 1)
+
+        gray = grayscale(jittered)
+        jittered = ((jittered - gray) * saturation + gray).clamp(0, 1)
+
+        hsv = rgb_to_hsv(jittered)
+        hsv = torch.stack([(hsv[:, 0] + hue) % 1.0, hsv[:, 1], hsv[:, 2]], dim=1)
+        jittered = hsv_to_rgb(hsv)
+
+        return torch.where(jitter, jittered, images)
+
+    @torch.no_grad()
+    def __call__(self, images):
+        """
+        Augmented batch (B, 3, H, W) in [0, 1] from a float batch in [0, 1] (or uint8 (B, H, W, 3)).
+        """
+        if images.dtype == torch.uint8:
+            images = to_float_batch(images)
+
+        batch_size, device = images.shape[0], images.device
+
+        images = self.geometry(images)
+        images = self.hue_saturation_value(images)
+        images = self.color_jitter(images)
+
+        if self.equalize_images:
+            equalized = equalize(images)
+            images = torch.where(self.apply(batch_size, device)[:, None, None, None], equalized, images)
+
+        gray = self.apply(batch_size, device, self.gray_prob)[:, None, None, None]
+        images = torch.where(gray, grayscale(images), images)
+
+        return images.clamp_(0, 1)
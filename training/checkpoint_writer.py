@@ -0,0 +1,98 @@
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+import torch
+
+
+def to_cpu(state):
+    """
+    Copy of a (nested) state dict with every tensor copied to CPU memory, so the snapshot
+    does not change when training continues.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, to_cpu(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def save_checkpoint(state, path):
+    """
+    torch.save with the legacy format, with the default format if it fails.
+    """
+    try:
+        torch.save(state, path, _use_new_zipfile_serialization=False)
+    except Exception:
+        torch.save(state, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints and .csv files on a background thread so the training loop does not
+    wait for the disk (or NAS). The state dicts are copied to CPU memory when saved, and
+    every file is written to a temporary file and renamed, so a checkpoint on disk is never
+    half written. A snapshot is skipped if a newer one of the same file is waiting, and when
+    max_in_flight snapshots are waiting the training waits for the oldest one.
+
+    Parameters
+    ----------
+    max_in_flight (int): maximum number of snapshots waiting to be written
+    """
+
+    def __init__(self, max_in_flight=2):
+        self.max_in_flight = max(1, max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def save(self, state, path):
+        """
+        Saves a checkpoint (dict of state dicts and values) as torch.save.
+        """
+        snapshot = to_cpu(state)
+        self.submit(path, lambda temporary_path: save_checkpoint(snapshot, temporary_path))
+
+    def save_csv(self, df, path, **kwargs):
+        """
+        Saves a pandas DataFrame as df.to_csv(path, **kwargs).
+        """
+        snapshot = df.copy()
+        self.submit(path, lambda temporary_path: snapshot.to_csv(temporary_path, **kwargs))
+
+    def submit(self, path, write):
+        path = Path(path)
+        with self.lock:
+            version = self.versions.get(path, 0) + 1
+            self.versions[path] = version
+
+        while len(self.pending) > 0 and self.pending[0].done():
+            self.pending.popleft().result()
+        while len(self.pending) >= self.max_in_flight:
+            self.pending.popleft().result()
+
+        self.pending.append(self.executor.submit(self.write, path, version, write))
+
+    def write(self, path, version, write):
+        with self.lock:
+            if self.versions[path] != version:
+                return
+
+        temporary_path = path.with_name(f"{path.name}.tmp")
+        write(temporary_path)
+        os.replace(temporary_path, path)
+
+    def wait(self):
+        """
+        Waits until every snapshot is written, raising the errors of the writes.
+        """
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
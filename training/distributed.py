@@ -0,0 +1,126 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend=None):
+    """
+    Initializes the process group when the script is launched with torchrun (WORLD_SIZE > 1),
+    with NCCL if CUDA is available and gloo otherwise (e.g. several processes on a multi-core
+    CPU server).
+
+    Returns
+    -------
+    rank (int), world_size (int), device (torch.device): device of this process
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{local_rank}" if world_size > 1 else "cuda:0")
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+
+    if world_size > 1 and not dist.is_initialized():
+        if backend is None:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+    return rank, world_size, device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+@torch.no_grad()
+def concat_all_gather(tensor):
+    """
+    Concatenation of the tensor of every process (in rank order), without gradient.
+    """
+    if not is_distributed():
+        return tensor
+
+    tensors_gather = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(tensors_gather, tensor.contiguous())
+
+    return torch.cat(tensors_gather, dim=0)
+
+
+def all_gather_object(obj):
+    """
+    List with the object (picklable) of every process, in rank order.
+    """
+    if not is_distributed():
+        return [obj]
+
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+
+    return objects
+
+
+def reduce_mean(value):
+    """
+    Mean of a float over all the processes, so every process takes the same decisions
+    (best model, early stopping).
+    """
+    if not is_distributed():
+        return value
+
+    tensor = torch.tensor([value], dtype=torch.float64)
+    if dist.get_backend() == "nccl":
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+
+    return tensor.item() / get_world_size()
+
+
+@torch.no_grad()
+def batch_shuffle_ddp(x):
+    """
+    Shuffled BN across processes (MoCo Section 3.3): the batches of all the processes are
+    gathered, shuffled with the same permutation (broadcast from rank 0) and every process
+    takes its slice. Returns the shuffled batch of this process and the indices to unshuffle.
+    """
+    batch_size = x.shape[0]
+    x_gather = concat_all_gather(x)
+
+    idx_shuffle = torch.randperm(x_gather.shape[0], device=x.device)
+    dist.broadcast(idx_shuffle, src=0)
+
+    idx_unshuffle = torch.argsort(idx_shuffle)
+    idx_this = idx_shuffle.view(get_world_size(), -1)[get_rank()]
+
+    return x_gather[idx_this], idx_unshuffle.view(get_world_size(), batch_size)[get_rank()]
+
+
+@torch.no_grad()
+def batch_unshuffle_ddp(x, idx_unshuffle):
+    """
+    Undoes batch_shuffle_ddp: gathers the outputs of all the processes and returns the ones
+    of the original batch of this process.
+    """
+    x_gather = concat_all_gather(x)
+
+    return x_gather[idx_unshuffle.to(x.device)]
+
+
+def unwrap_model(model):
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
@@ -17,7 +17,8 @@ class Encoder(torch.nn.Module):
 
         self.conv_layers = torch.nn.Sequential(*list(self.net.children())[:-1])
 
-        if (torch.cuda.device_count()>1):
+        # DistributedDataParallel (torchrun) uses one GPU per process instead
+        if (torch.cuda.device_count()>1 and not torch.distributed.is_initialized()):
             # 0 para GPU buena
             self.conv_layers = torch.nn.DataParallel(self.conv_layers, device_ids=[0])
 
@@ -13,9 +13,14 @@ class MIL_model(torch.nn.Module):
         self.net = self.model.net
         self.cfg = cfg
 
-        self.conv_layers = torch.nn.Sequential(*list(self.net.children())[:-1])
+        # Head only model (ModelOption with build_backbone=False), it only takes features
+        if self.net is None:
+            self.conv_layers = None
 
-        if (torch.cuda.device_count()>1):
+        else:
+            self.conv_layers = torch.nn.Sequential(*list(self.net.children())[:-1])
+
+        if (torch.cuda.device_count()>1) and self.conv_layers is not None:
             # 0 para GPU buena
             self.conv_layers = torch.nn.DataParallel(self.conv_layers, device_ids=[0])
 
@@ -90,13 +95,19 @@ class MIL_model(torch.nn.Module):
         # self.activation = self.tanh
         self.activation = self.relu 
 
-    def forward(self, x, conv_layers_out):
+    def forward(self, x, conv_layers_out, mask=None):
+
+        # Padded batch of bags (B, N_max, fc_input_features)
+        if x is None and conv_layers_out.dim() == 3:
+            return self.forward_batch(conv_layers_out, mask)
 
         #if used attention pooling
         A = None
         #m = torch.nn.Softmax(dim=1)
 
         if x is not None:
+            if self.conv_layers is None:
+                raise ValueError("Head only MIL model without backbone, use the features of the patches as input")
             #print(x.shape)
             conv_layers_out=self.conv_layers(x)
             #print(x.shape)
@@ -121,7 +132,8 @@ class MIL_model(torch.nn.Module):
 
         A = torch.transpose(A, 1, 0)
         #print("A ante soft: " + str(A))
-        A = F.softmax(A, dim=1)
+        # Softmax of the attention in fp32, also under bf16 autocast
+        A = F.softmax(A.float(), dim=1)
 
         wsi_embedding = torch.mm(A, features_to_return)
 
@@ -137,7 +149,7 @@ class MIL_model(torch.nn.Module):
 
             attention_channel = torch.transpose(attention_channel, 1, 0)
 
-            attention_channel = F.softmax(attention_channel, dim=1)
+            attention_channel = F.softmax(attention_channel.float(), dim=1)
 
             cls_img = torch.mm(attention_channel, wsi_embedding)
 
@@ -154,3 +166,65 @@ class MIL_model(torch.nn.Module):
         Y_prob = torch.squeeze(Y_prob)
 
         return Y_prob, features_image
+
+    def forward_batch(self, conv_layers_out, mask=None):
+        """
+        Forward of a padded batch of bags. The attention of the padded instances is set to
+        -inf before the softmax, so they get zero weight and every bag gives the same output
+        as its own forward with a single bag.
+
+        Parameters
+        ----------
+        conv_layers_out (torch.Tensor): features of the bags (B, N_max, fc_input_features)
+        mask (torch.Tensor): bool (B, N_max), True for the instances and False for padding
+
+        Returns
+        -------
+        Y_prob (torch.Tensor): logits (B, num_classes), features_image (torch.Tensor): (B, E)
+        """
+        batch_size = conv_layers_out.shape[0]
+
+        if self.model.embedding_bool:
+            embedding_layer = self.embedding(conv_layers_out)
+            features_to_return = embedding_layer
+            embedding_layer = self.dropout(embedding_layer)
+
+        else:
+            embedding_layer = conv_layers_out
+            features_to_return = embedding_layer
+
+        # (B, N_max, K) -> (B, K, N_max)
+        A = self.attention(features_to_return)
+        A = torch.transpose(A, 2, 1)
+
+        if mask is not None:
+            A = A.masked_fill(~mask[:, None, :], float("-inf"))
+
+        # Softmax of the attention in fp32, also under bf16 autocast
+        A = F.softmax(A.float(), dim=2)
+
+        wsi_embedding = torch.bmm(A, features_to_return)
+
+        if "NoChannel" in self.cfg.data_augmentation.featuresdir:
+            wsi_embedding = wsi_embedding.reshape(batch_size, self.E * self.K)
+
+            cls_img = self.embedding_before_fc(wsi_embedding)
+
+        elif "AChannel" in self.cfg.data_augmentation.featuresdir:
+            attention_channel = self.attention_channel(wsi_embedding)
+
+            attention_channel = torch.transpose(attention_channel, 2, 1)
+
+            attention_channel = F.softmax(attention_channel.float(), dim=2)
+
+            cls_img = torch.bmm(attention_channel, wsi_embedding).squeeze(1)
+
+        cls_img = self.activation(cls_img)
+
+        features_image = cls_img
+
+        cls_img = self.dropout(cls_img)
+
+        Y_prob = self.embedding_fc(cls_img)
+
+        return Y_prob, features_image
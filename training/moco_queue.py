@@ -0,0 +1,92 @@
+import torch
+
+
+class KeyQueue:
+    """
+    Queue of the keys of the momentum encoder used as negatives by MoCo, stored in a
+    preallocated ring buffer. The new keys overwrite the oldest ones at the write pointer,
+    so enqueuing a batch only copies it into the buffer instead of reallocating the queue.
+    The order of the keys in the buffer is not the order of arrival, which does not matter
+    for the contrastive loss.
+
+    Parameters
+    ----------
+    num_keys (int): maximum number of keys in the queue
+    dim (int): dimension of the keys
+    device (torch.device): device of the buffer
+    dtype (torch.dtype): dtype of the buffer
+    """
+
+    def __init__(self, num_keys, dim, device="cpu", dtype=torch.float32):
+        self.num_keys = num_keys
+        self.keys = torch.zeros((num_keys, dim), dtype=dtype, device=device)
+        self.ptr = 0
+        self.num_filled = 0
+
+    def __len__(self):
+        return self.num_filled
+
+    def is_full(self):
+        return self.num_filled == self.num_keys
+
+    def reset(self):
+        self.ptr = 0
+        self.num_filled = 0
+
+    def queue(self):
+        """
+        Keys in the queue (num_filled, dim), a view of the buffer.
+        """
+        if self.is_full():
+            return self.keys
+        return self.keys[:self.num_filled]
+
+    @torch.no_grad()
+    def enqueue(self, k):
+        """
+        Writes the keys k (N, dim) in the buffer replacing the oldest ones.
+        """
+        k = k.detach()
+        n = k.shape[0]
+
+        if n >= self.num_keys:
+            self.keys.copy_(k[n - self.num_keys:])
+            self.ptr = 0
+            self.num_filled = self.num_keys
+            return
+
+        end = self.ptr + n
+        if end <= self.num_keys:
+            self.keys[self.ptr:end].copy_(k)
+        else:
+            first = self.num_keys - self.ptr
+            self.keys[self.ptr:].copy_(k[:first])
+            self.keys[:n - first].copy_(k[first:])
+
+        self.ptr = end % self.num_keys
+        self.num_filled = min(self.num_keys, self.num_filled + n)
+
+    def state_dict(self):
+        return {"keys": self.keys,
+                "ptr": self.ptr,
+                "num_filled": self.num_filled}
+
+    def load_state_dict(self, state_dict):
+        self.keys.copy_(state_dict["keys"])
+        self.ptr = state_dict["ptr"]
+        self.num_filled = state_dict["num_filled"]
+
+
+def shuffle_batch(x):
+    """
+    Random permutation of a batch for the shuffled BN of MoCo (Section 3.3). Returns the
+    shuffled batch and the indices to unshuffle it (inverse permutation).
+    """
+    idx_shuffle = torch.randperm(x.shape[0], device=x.device)
+    idx_unshuffle = torch.argsort(idx_shuffle)
+
+    return x[idx_shuffle], idx_unshuffle
+
+
+def unshuffle_batch(x, idx_unshuffle):
+    return x[idx_unshuffle.to(x.device)]
@@ -1,15 +1,131 @@
 from torch import nn
 import torchvision.models as models
 
+# Number of features of the output of the backbones (input of their classifier)
+backbone_features = {"resnet50": 2048,
+                     "resnet34": 512,
+                     "resnet101": 2048,
+                     "convnext": 768,
+                     "swin": 768,
+                     "efficient": 1280}
+
+
+def match_backbone_wrapping(net, state_dict):
+    """
+    Renames the weights of the backbone of a checkpoint to the DataParallel wrapping of the
+    backbone of the model. MIL_model and Encoder wrap conv_layers in DataParallel with more
+    than one GPU (conv_layers.module.*), but not in single GPU or DistributedDataParallel
+    runs (conv_layers.*), and a checkpoint can come from either.
+
+    Parameters
+    ----------
+    net (torch.nn.Module): model with a backbone in conv_layers (e.g. MIL_model, Encoder)
+    state_dict (dict): weights of the checkpoint
+
+    Returns
+    -------
+    state_dict (dict): weights of the checkpoint with the keys of the backbone of the model
+    """
+    wrapped = isinstance(getattr(net, "conv_layers", None), nn.DataParallel)
+
+    state_dict_net = {}
+    for key, value in state_dict.items():
+        key = unwrap_backbone_key(key)
+        if wrapped and key.startswith("conv_layers."):
+            key = "conv_layers.module." + key[len("conv_layers."):]
+        state_dict_net[key] = value
+
+    return state_dict_net
+
+
+def unwrap_backbone_key(key):
+    """Key of a weight of the backbone without the DataParallel wrapping (conv_layers.module.* -> conv_layers.*)"""
+    if key.startswith("conv_layers.module."):
+        return "conv_layers." + key[len("conv_layers.module."):]
+
+    return key
+
+
+def load_checkpoint(net, state_dict):
+    """
+    Loads the weights of a checkpoint into a model with strict=False, as the heads of the
+    models (MoCo, MIL) are different, but checks that every weight of the backbone
+    (conv_layers) is in the checkpoint, so a backbone built without pretrained weights is
+    never used with random weights.
+
+    Parameters
+    ----------
+    net (torch.nn.Module): model with a backbone in conv_layers (e.g. MIL_model, Encoder)
+    state_dict (dict): weights of the checkpoint
+
+    Returns
+    -------
+    keys (NamedTuple): missing_keys and unexpected_keys of load_state_dict
+    """
+    keys = net.load_state_dict(match_backbone_wrapping(net, state_dict), strict=False)
+
+    missing_backbone = [key for key in keys.missing_keys if key.startswith("conv_layers.")]
+    if len(missing_backbone) > 0:
+        raise KeyError(f"{len(missing_backbone)} weights of the backbone are not in the checkpoint, "
+                       f"e.g. {missing_backbone[:5]}")
+
+    return keys
+
+
+def backbone_state_dict(state_dict):
+    """
+    Weights of the backbone (conv_layers) of a checkpoint, on CPU and without the DataParallel
+    wrapping (see match_backbone_wrapping). A head-only model saves them with its own weights,
+    so its checkpoints also work with the models that run the backbone on the patches
+    (e.g. heatmaps, test_MIL_k_fold_rumc).
+    """
+    return {unwrap_backbone_key(key): value.detach().cpu() for key, value in state_dict.items()
+            if key.startswith("conv_layers.")}
+
+
+def load_head_checkpoint(net, state_dict):
+    """
+    Loads the weights of a checkpoint into a model without backbone (build_backbone=False),
+    ignoring only the weights of the backbone (conv_layers). Any other missing or unexpected
+    weight raises KeyError, so a head is never used with random weights.
+
+    Parameters
+    ----------
+    net (torch.nn.Module): model without backbone (e.g. MIL_model)
+    state_dict (dict): weights of the checkpoint
+
+    Returns
+    -------
+    keys (NamedTuple): missing_keys and unexpected_keys of load_state_dict
+    """
+    keys = net.load_state_dict(match_backbone_wrapping(net, state_dict), strict=False)
+
+    missing_head = [key for key in keys.missing_keys if not key.startswith("conv_layers.")]
+    unexpected_head = [key for key in keys.unexpected_keys if not key.startswith("conv_layers.")]
+    if len(missing_head) > 0 or len(unexpected_head) > 0:
+        raise KeyError(f"Weights of the head do not match the checkpoint, missing {missing_head[:5]}, "
+                       f"unexpected {unexpected_head[:5]}")
+
+    return keys
+
 
 class ModelOption():
+    """
+    Backbone of the models. With build_backbone=False the torchvision network is not built
+    (net is None) and only the size of its features is set, for the models that only use
+    stored features (e.g. the MIL head on the feature store). With pretrained=False the
+    backbone is built without the ImageNet weights (no download), for the models that load
+    all their weights from a checkpoint (see load_checkpoint).
+    """
     def __init__(self, model_name: str,
                  num_classes: int,
                  freeze=False,
                  num_freezed_layers=0,
                  dropout=0.0, 
                  embedding_bool=False,
-                 pool_algorithm=None
+                 pool_algorithm=None,
+                 build_backbone=True,
+                 pretrained=True
                  ):
 
         self.model_name = model_name
@@ -19,9 +135,17 @@ class ModelOption():
         self.embedding_bool = embedding_bool
         self.pool_algorithm = pool_algorithm
 
-        if self.model_name.lower() == "resnet50":
+        if not build_backbone and self.model_name.lower() in backbone_features:
+            """ Head only, without backbone """
+            self.net = None
+
+            self.input_features = backbone_features[self.model_name.lower()]
+
+            self.resize_param = 224
+
+        elif self.model_name.lower() == "resnet50":
             """ ResNet50 """
-            self.net = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
+            self.net = models.resnet50(weights=models.ResNet50_Weights.DEFAULT if pretrained else None)
 
             self.input_features = self.net.fc.in_features  # 2048
             
@@ -41,7 +165,7 @@ class ModelOption():
 
         elif self.model_name.lower() == "resnet34":
             """ ResNet34 """
-            self.net = models.resnet34(weights=models.ResNet34_Weights.DEFAULT)
+            self.net = models.resnet34(weights=models.ResNet34_Weights.DEFAULT if pretrained else None)
 
             self.input_features = self.net.fc.in_features  # 2048
             
@@ -61,7 +185,7 @@ class ModelOption():
 
         elif self.model_name.lower() == "resnet101":
             """ ResNet101 """
-            self.net = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
+            self.net = models.resnet101(weights=models.ResNet101_Weights.DEFAULT if pretrained else None)
 
             self.input_features = self.net.fc.in_features  # 2048
             
@@ -81,7 +205,7 @@ class ModelOption():
 
         elif self.model_name.lower() == "convnext":
             """ ConvNeXt small """
-            self.net = models.convnext_small(weights='DEFAULT')
+            self.net = models.convnext_small(weights='DEFAULT' if pretrained else None)
 
 
             self.input_features = self.net.classifier[2].in_features  # 768
@@ -101,7 +225,7 @@ class ModelOption():
 
         elif self.model_name.lower() == "swin":
             """ Swin Transformer V2 -T """
-            self.net = models.swin_v2_t(weights=models.Swin_V2_T_Weights.DEFAULT)
+            self.net = models.swin_v2_t(weights=models.Swin_V2_T_Weights.DEFAULT if pretrained else None)
 
             self.input_features = self.net.head.in_features  # 768
             # self.net.head = nn.Sequential(nn.Dropout(p=self.dropout),
@@ -120,7 +244,7 @@ class ModelOption():
 
         elif self.model_name.lower() == "efficient":
             """ EfficientNet b0 """
-            self.net = models.efficientnet_b0(weights='DEFAULT')
+            self.net = models.efficientnet_b0(weights='DEFAULT' if pretrained else None)
 
             self.input_features = self.net.classifier[1].in_features  # 1200
             # self.net.classifier = nn.Sequential(nn.Dropout(p=self.dropout),
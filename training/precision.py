@@ -0,0 +1,51 @@
+import copy
+import time
+import torch
+
+
+def use_bf16(cfg):
+    return cfg.training.get("precision", "fp32") == "bf16"
+
+
+def precision_autocast(cfg, device):
+    """
+    bfloat16 autocast (CPU or CUDA) if training.precision is 'bf16', otherwise a disabled
+    autocast and everything runs in fp32. The weights stay in fp32, so the checkpoints are
+    the same in both modes.
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16(cfg))
+
+
+def benchmark_precision(model, forward, iterations=5):
+    """
+    Throughput of forward + backward of a copy of the model in fp32 and in bf16 autocast,
+    so the training itself (weights, BN statistics) is not changed.
+
+    Parameters
+    ----------
+    model (torch.nn.Module): model to benchmark
+    forward (function): takes the model and returns a scalar loss
+    iterations (int): number of timed iterations per precision, after one warm-up iteration
+
+    Returns
+    -------
+    throughput (dict): iterations per second for 'fp32' and 'bf16'
+    """
+    model = copy.deepcopy(model)
+    model.train()
+    device_type = next(model.parameters()).device.type
+
+    throughput = {}
+    for precision in ("fp32", "bf16"):
+        for i in range(iterations + 1):
+            if i == 1:
+                start = time.perf_counter()
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+                loss = forward(model)
+            loss.float().backward()
+            model.zero_grad(set_to_none=True)
+        throughput[precision] = iterations / (time.perf_counter() - start)
+
+    del model
+
+    return throughput
@@ -7,9 +7,9 @@ import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
 import torch.nn.functional as F
-from database import Dataset_bag_MIL
+from database import Dataset_bag_MIL, patch_cohorts, labelled_slides, discarded_slides, patches_csv
 from training.mil import MIL_model
-from training.models import ModelOption
+from training.models import ModelOption, load_checkpoint
 from training.utils_trainig import yaml_load, get_generator_instances
 from sklearn.metrics import accuracy_score, balanced_accuracy_score, cohen_kappa_score
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score
@@ -29,6 +29,110 @@ datadir = Path(thispath.parent.parent / "data")
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 
+def load_test_split_csv(version_patch_selection):
+      """
+      Test WSIs of AOEC and RUMC with their labels and patches from the metadata, labels and
+      filtered patches .csv files, discarding the WSIs with less than 10 patches.
+
+      Returns
+      -------
+      test_dataset (numpy.ndarray), test_labels (numpy.ndarray), patches_test (dict),
+      discard_rumc (list): RUMC test WSIs discarded
+      """
+      # Loading Data Split
+      pyhistdir = Path(datadir / "Mask_PyHIST_v2")
+      pyhistdir_rumc = Path(datadir / "Mask_PyHIST")
+
+      # Discard WSI with less than 10 patches
+      testdir = Path(pyhistdir / "Lung")
+      if version_patch_selection == "v2":
+            metadata_test = pd.read_csv(testdir / "metadata_slides_v2.csv", index_col=0)
+      elif version_patch_selection == "v1":
+            metadata_test = pd.read_csv(testdir / "metadata_slides.csv", index_col=0)
+
+      metadata_rumc = pd.read_csv(pyhistdir_rumc / "metadata_slides_v2.csv", index_col=0)
+
+      discard_wsi_test = []
+      if (metadata_test['number_filtered_patches'] < 10).any():
+            for index, row in metadata_test.iterrows():
+                  if row['number_filtered_patches'] < 10:
+                        discard_wsi_test.append(index)
+
+            logging.info(f"There is {len(discard_wsi_test)} WSI discarded in test, <10 patches")
+            logging.info(discard_wsi_test)
+
+      # Load Test Dataset and Labels
+      test_csv = pd.read_csv(Path(datadir / f"manual_labels_test.csv"), index_col=0)
+      test_csv.index = test_csv.index.str.replace("/", '-')
+      test_csv.drop(discard_wsi_test, inplace=True)
+
+      test_csv_rumc = pd.read_csv(Path(datadir / f"labels_test_rumc.csv"), index_col=0)
+
+      discard_rumc = []
+      if (metadata_rumc['number_filtered_patches'] < 10).any():
+            for index, row in metadata_rumc.iterrows():
+                  if row['number_filtered_patches'] < 10 and index in test_csv_rumc.index:
+                        discard_rumc.append(index)
+      test_csv_rumc.drop(discard_rumc, inplace=True)
+
+      test_dataset_rumc = test_csv_rumc.index
+      test_labels_rumc = test_csv_rumc.values
+
+      test_dataset_aoec = test_csv.index
+      test_labels_aoec = test_csv.values
+
+      test_dataset = np.append(test_dataset_aoec, test_dataset_rumc)
+      test_labels = np.concatenate([test_labels_aoec, test_labels_rumc])
+
+      # Load Test patches
+      if version_patch_selection == "v2":
+            dataset_path = natsorted([i for i in testdir.rglob("*_densely_filtered_paths_v2.csv")])
+      elif version_patch_selection == "v1":
+            dataset_path = natsorted([i for i in testdir.rglob("*_densely_filtered_paths.csv")])
+
+      dataset_path_rumc = natsorted([i for i in pyhistdir_rumc.rglob("*_densely_filtered_paths_v2.csv")])
+
+      dataset_path = dataset_path + dataset_path_rumc
+
+      patches_test = {}
+      for wsi_patches_path in tqdm(dataset_path, desc="Selecting patches: "):
+
+            csv_patch_path = pd.read_csv(wsi_patches_path).to_numpy()
+
+            name = wsi_patches_path.parent.stem
+            patches_test[name] = csv_patch_path
+
+      for discard_wsi in discard_wsi_test:
+            patches_test.pop(discard_wsi, None)
+
+      for discard_wsi in discard_rumc:
+            patches_test.pop(discard_wsi, None)
+
+      return test_dataset, test_labels, patches_test, discard_rumc
+
+
+def load_test_split_catalog(catalog_file, version_patch_selection):
+      """
+      Same test split as load_test_split_csv from the slide catalog (database/catalog.py),
+      with the patches of the test WSIs only.
+      """
+      testdir_cohort = patch_cohorts(("aoec_test",), version_patch_selection)[0]
+      cohort_names = (testdir_cohort, "rumc")
+
+      test_dataset, test_labels = labelled_slides(("aoec_test", "rumc_test"),
+                                                  cohort_names,
+                                                  min_patches=10,
+                                                  catalog_file=catalog_file)
+      discard_rumc = discarded_slides("rumc_test", ("rumc",), min_patches=10, catalog_file=catalog_file)
+
+      patches_test = {}
+      for name, wsi_patches_path in tqdm(patches_csv(test_dataset, cohort_names, catalog_file=catalog_file).items(),
+                                         desc="Selecting patches: "):
+            patches_test[name] = pd.read_csv(wsi_patches_path).to_numpy()
+
+      return test_dataset, test_labels, patches_test, discard_rumc
+
+
 @click.command()
 @click.option(
     "--experiment_name",
@@ -106,85 +210,27 @@ def main(experiment_name, version_patch_selection):
                         num_freezed_layers=cfg.model.num_frozen_layers,
                         dropout=cfg.model.dropout,
                         embedding_bool=cfg.model.embedding_bool,
-                        pool_algorithm=cfg.model.pool_algorithm
+                        pool_algorithm=cfg.model.pool_algorithm,
+                        pretrained=False
                         )
 
             hidden_space_len = cfg.model.hidden_space_len
 
             net = MIL_model(model, hidden_space_len, cfg)
 
-            net.load_state_dict(checkpoint["model_state_dict"], strict=False)
+            load_checkpoint(net, checkpoint["model_state_dict"])
             net.to(device)
             net.eval()
 
-            # Loading Data Split
-            pyhistdir = Path(datadir / "Mask_PyHIST_v2")
-            pyhistdir_rumc = Path(datadir / "Mask_PyHIST")
-            
-            # Discard WSI with less than 10 patches
-            testdir = Path(pyhistdir / "Lung")
-            if version_patch_selection == "v2":
-                  metadata_test = pd.read_csv(testdir / "metadata_slides_v2.csv", index_col=0)
-            elif version_patch_selection == "v1":
-                  metadata_test = pd.read_csv(testdir / "metadata_slides.csv", index_col=0)
-
-            metadata_rumc = pd.read_csv(pyhistdir_rumc / "metadata_slides_v2.csv", index_col=0)
-
-            discard_wsi_test = []
-            if (metadata_test['number_filtered_patches'] < 10).any():
-                  for index, row in metadata_test.iterrows():
-                        if row['number_filtered_patches'] < 10:
-                              discard_wsi_test.append(index)
-
-                  logging.info(f"There is {len(discard_wsi_test)} WSI discarded in test, <10 patches")
-                  logging.info(discard_wsi_test)
-
-            # Load Test Dataset and Labels
-            test_csv = pd.read_csv(Path(datadir / f"manual_labels_test.csv"), index_col=0)
-            test_csv.index = test_csv.index.str.replace("/", '-')
-            test_csv.drop(discard_wsi_test, inplace=True)
-
-            test_csv_rumc = pd.read_csv(Path(datadir / f"labels_test_rumc.csv"), index_col=0)
+            # Loading Data Split, from the slide catalog if it was built
+            catalog_file = Path(datadir / "slide_catalog.db")
+            if catalog_file.exists():
+                  logging.info(f"== Loading test split from the slide catalog {catalog_file} ==")
+                  test_split = load_test_split_catalog(catalog_file, version_patch_selection)
+            else:
+                  test_split = load_test_split_csv(version_patch_selection)
 
-            discard_rumc = []
-            if (metadata_rumc['number_filtered_patches'] < 10).any():
-                  for index, row in metadata_rumc.iterrows():
-                        if row['number_filtered_patches'] < 10 and index in test_csv_rumc.index:
-                              discard_rumc.append(index)
-            test_csv_rumc.drop(discard_rumc, inplace=True)
-
-            test_dataset_rumc = test_csv_rumc.index
-            test_labels_rumc = test_csv_rumc.values
-
-            test_dataset_aoec = test_csv.index
-            test_labels_aoec = test_csv.values
-
-            test_dataset = np.append(test_dataset_aoec, test_dataset_rumc)
-            test_labels = np.concatenate([test_labels_aoec, test_labels_rumc])
-
-            # Load Test patches
-            if version_patch_selection == "v2":
-                  dataset_path = natsorted([i for i in testdir.rglob("*_densely_filtered_paths_v2.csv")])
-            elif version_patch_selection == "v1":
-                  dataset_path = natsorted([i for i in testdir.rglob("*_densely_filtered_paths.csv")])
-
-            dataset_path_rumc = natsorted([i for i in pyhistdir_rumc.rglob("*_densely_filtered_paths_v2.csv")])
-
-            dataset_path = dataset_path + dataset_path_rumc
-
-            patches_test = {}
-            for wsi_patches_path in tqdm(dataset_path, desc="Selecting patches: "):
-
-                  csv_patch_path = pd.read_csv(wsi_patches_path).to_numpy()
-                  
-                  name = wsi_patches_path.parent.stem
-                  patches_test[name] = csv_patch_path
-
-            for discard_wsi in discard_wsi_test:
-                  patches_test.pop(discard_wsi, None)
-            
-            for discard_wsi in discard_rumc:
-                  patches_test.pop(discard_wsi, None)
+            test_dataset, test_labels, patches_test, discard_rumc = test_split
 
             logging.info(f"Total number of WSI for test {len(patches_test)}")
             logging.info("")
@@ -9,7 +9,7 @@ from torchvision import transforms
 import torch.nn.functional as F
 from database import Dataset_bag_MIL
 from training.mil import MIL_model
-from training.models import ModelOption
+from training.models import ModelOption, load_checkpoint
 from training.utils_trainig import yaml_load, get_generator_instances
 from sklearn.metrics import accuracy_score, balanced_accuracy_score, cohen_kappa_score
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score
@@ -73,14 +73,15 @@ def main(experiment_name):
                   num_freezed_layers=cfg.model.num_frozen_layers,
                   dropout=cfg.model.dropout,
                   embedding_bool=cfg.model.embedding_bool,
-                  pool_algorithm=cfg.model.pool_algorithm
+                  pool_algorithm=cfg.model.pool_algorithm,
+                  pretrained=False
                   )
 
       hidden_space_len = cfg.model.hidden_space_len
 
       net = MIL_model(model, hidden_space_len, cfg)
 
-      net.load_state_dict(checkpoint["model_state_dict"], strict=False)
+      load_checkpoint(net, checkpoint["model_state_dict"])
       net.to(device)
       net.eval()
 
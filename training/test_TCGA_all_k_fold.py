@@ -7,9 +7,9 @@ import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
 import torch.nn.functional as F
-from database import Dataset_bag_MIL
+from database import Dataset_bag_MIL, FeatureStore
 from training.mil import MIL_model
-from training.models import ModelOption
+from training.models import ModelOption, load_head_checkpoint
 from training.utils_trainig import yaml_load, get_generator_instances
 from sklearn.metrics import accuracy_score, balanced_accuracy_score, cohen_kappa_score
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score
@@ -105,6 +105,11 @@ def main(experiment_name):
       test_set_bag = Dataset_bag_MIL(test_dataset, test_labels)
       test_generator_bag = DataLoader(test_set_bag, **params_test_bag)
 
+      # Features of every WSI, shared by all the folds
+      feature_store = FeatureStore(Path(datadir / "Saved_features" / "tcga" /
+                                        cfg.data_augmentation.featuresdir),
+                                   cfg.data_augmentation.get("store_name", "feature_store"))
+
       auc_sclc_fold_test = []
       auc_luad_fold_test = []
       auc_lusc_fold_test = []
@@ -138,14 +143,15 @@ def main(experiment_name):
                         num_freezed_layers=cfg.model.num_frozen_layers,
                         dropout=cfg.model.dropout,
                         embedding_bool=cfg.model.embedding_bool,
-                        pool_algorithm=cfg.model.pool_algorithm
+                        pool_algorithm=cfg.model.pool_algorithm,
+                        build_backbone=False
                         )
 
             hidden_space_len = cfg.model.hidden_space_len
 
             net = MIL_model(model, hidden_space_len, cfg)
 
-            net.load_state_dict(checkpoint["model_state_dict"], strict=False)
+            load_head_checkpoint(net, checkpoint["model_state_dict"])
             net.to(device)
             net.eval()
 
@@ -177,8 +183,7 @@ def main(experiment_name):
                         
                         labels_np = labels.cpu().numpy().flatten()
 
-                        features_np = np.load(datadir / "Saved_features/tcga" /  
-                                          cfg.data_augmentation.featuresdir / f"{wsi_id}.npy")
+                        features_np = feature_store[wsi_id]
 
                         inputs = torch.tensor(features_np).float().to(device, non_blocking=True)
                         
@@ -3,7 +3,6 @@ import torch
 from torch.utils.data import DataLoader
 import numpy as np
 import pandas as pd
-import albumentations as A
 import time
 from tqdm import tqdm
 import torch.nn.functional as F
@@ -16,10 +15,14 @@ import seaborn as sns
 import os
 from natsort import natsorted
 from ast import literal_eval
-from database import Dataset_bag_MIL, Balanced_Multimodal
+from database import Dataset_bag_features, Balanced_Multimodal, FeatureStore, BagCache, BagPrefetcher
+from database import Bucket_batch_sampler, pad_bags, collate_bags, patch_cohorts, fold_split, patches_csv
 from training.mil import MIL_model
-from training.models import ModelOption
+from training.models import ModelOption, load_checkpoint, load_head_checkpoint, backbone_state_dict
+from training.checkpoint_writer import AsyncCheckpointWriter
+from training.precision import precision_autocast, use_bf16, benchmark_precision
 from training.utils_trainig import yaml_load, initialize_wandb, edict2dict, get_generator_instances
+from training.augmentation import generate_transformer
 import yaml
 from utils import timer
 import wandb
@@ -48,116 +51,6 @@ def focal_binary_cross_entropy(logits, targets, num_label, gamma=2):
     return loss
 
 
-def select_parameters_colour():
-    hue_min = -15
-    hue_max = 8
-
-    sat_min = -20
-    sat_max = 10
-
-    val_min = -8
-    val_max = 8
-
-
-    p1 = np.random.uniform(hue_min,hue_max,1)
-    p2 = np.random.uniform(sat_min,sat_max,1)
-    p3 = np.random.uniform(val_min,val_max,1)
-
-    return p1[0],p2[0],p3[0]
-
-def select_rgb_shift():
-    r_min = -10
-    r_max = 10
-
-    g_min = -10
-    g_max = 10
-
-    b_min = -10
-    b_max = 10
-
-
-    p1 = np.random.uniform(r_min,r_max,1)
-    p2 = np.random.uniform(g_min,g_max,1)
-    p3 = np.random.uniform(b_min,b_max,1)
-
-    return p1[0],p2[0],p3[0]
-
-def select_elastic_distorsion():
-    sigma_min = 0
-    sigma_max = 20
-
-    alpha_affine_min = -20
-    alpha_affine_max = 20
-
-    p1 = np.random.uniform(sigma_min,sigma_max,1)
-    p2 = np.random.uniform(alpha_affine_min,alpha_affine_max,1)
-
-    return p1[0],p2[0]
-
-def select_scale_distorsion():
-    scale_min = 0.8
-    scale_max = 1.0
-
-    p1 = np.random.uniform(scale_min,scale_max,1)
-
-    return p1[0]
-
-def select_grid_distorsion():
-    dist_min = 0
-    dist_max = 0.2
-
-    p1 = np.random.uniform(dist_min,dist_max,1)
-
-    return p1[0]
-
-def generate_transformer(prob = 0.5):
-    list_operations = []
-    probas = np.random.rand(7)
-
-    if (probas[0]>prob):
-        #print("VerticalFlip")
-        list_operations.append(A.VerticalFlip(always_apply=True))
-    if (probas[1]>prob):
-        #print("HorizontalFlip")
-        list_operations.append(A.HorizontalFlip(always_apply=True))
-    #"""
-    if (probas[2]>prob):
-        #print("RandomRotate90")
-        #list_operations.append(A.RandomRotate90(always_apply=True))
-
-        p_rot = np.random.rand(1)[0]
-        if (p_rot<=0.33):
-            lim_rot = 90
-        elif (p_rot>0.33 and p_rot<=0.66):
-            lim_rot = 180
-        else:
-            lim_rot = 270
-        list_operations.append(A.SafeRotate(always_apply=True, limit=(lim_rot,lim_rot+1e-4), interpolation=1, border_mode=4))
-
-    if (probas[3]>prob):
-        #print("HueSaturationValue")
-        p1, p2, p3 = select_parameters_colour()
-        list_operations.append(A.HueSaturationValue(always_apply=True,hue_shift_limit=(p1,p1+1e-4),sat_shift_limit=(p2,p2+1e-4),val_shift_limit=(p3,p3+1e-4)))
-
-    if (probas[4]>prob):
-        p1 = select_scale_distorsion()
-        list_operations.append(A.RandomResizedCrop(height=224, width=224, scale=(p1,p1+1e-4), always_apply=True))
-        #print(p1,p2,p3)
-
-    if (probas[5]>prob):
-        #p1, p2 = select_elastic_distorsion()
-        list_operations.append(A.ElasticTransform(alpha=1,border_mode=4, sigma=5, alpha_affine=5,always_apply=True))
-        #print(p1,p2)
-
-    if (probas[6]>prob):
-        p1 = select_grid_distorsion()
-        list_operations.append(A.GridDistortion(num_steps=3, distort_limit=p1, interpolation=1, border_mode=4, always_apply=True))
-        #print(p1)
-    pipeline_transform = A.Compose(list_operations)
-
-    return pipeline_transform
-
-
 # def validation_1_epoch(cfg,
 #                        net,
 #                        criterion,
@@ -172,8 +65,7 @@ def validation_1_epoch(cfg,
                        criterion,
                        generator,
                        iterations,
-                       epoch,
-                       featuresdir):
+                       epoch):
     
     logging.info("== Validation ==")
 
@@ -197,19 +89,15 @@ def validation_1_epoch(cfg,
         for i in range(iterations):
             logging.info(f"[{epoch + 1}], {i + 1} / {iterations}")
             try:
-                wsi_id, labels = next(dataloader_iterator)
+                wsi_id, features, mask, labels = next(dataloader_iterator)
             except StopIteration:
                 dataloader_iterator = iter(generator)
-                wsi_id, labels = next(dataloader_iterator)
-                #inputs: bags, labels: labels of the bags
+                wsi_id, features, mask, labels = next(dataloader_iterator)
+                #inputs: padded batch of bags, mask of the padding, labels: labels of the bags
 
-            wsi_id = wsi_id[0]
-            labels = torch.stack(labels)
             labels_np = labels.cpu().numpy().flatten()
 
-            labels_local = labels.float().flatten().to(device, non_blocking=True)
-
-            features_np = np.load(datadir / "Saved_features" / featuresdir / f"{wsi_id}.npy")
+            labels_local = labels.float().to(device, non_blocking=True)
 
             # validation_generator_instance = get_generator_instances(patches_validation[wsi_id], 
             #                                                         preprocess,
@@ -233,9 +121,12 @@ def validation_1_epoch(cfg,
 
             # features_np = np.reshape(features,(n_elems, net.fc_input_features))
 
-            inputs = torch.tensor(features_np).float().to(device, non_blocking=True)
+            inputs = features.to(device, non_blocking=True)
+            mask = mask.to(device, non_blocking=True)
         
-            logits_img, _ = net(None, inputs)
+            with precision_autocast(cfg, device):
+                logits_img, _ = net(None, inputs, mask)
+            logits_img = logits_img.float()
 
             if cfg.training.criterion == "focal":
                 loss_img = focal_binary_cross_entropy(logits_img,
@@ -252,11 +143,11 @@ def validation_1_epoch(cfg,
             logging.info(f"pred_img_logits: {outputs_wsi_np_img}")
             logging.info(f"validation_loss: {validation_loss}")
 
-            filenames_wsis.append(wsi_id)
-            pred_scc.append(outputs_wsi_np_img[0])
-            pred_nscc_adeno.append(outputs_wsi_np_img[1])
-            pred_nscc_squamous.append(outputs_wsi_np_img[2])
-            pred_normal.append(outputs_wsi_np_img[3])
+            filenames_wsis.extend(wsi_id)
+            pred_scc.extend(outputs_wsi_np_img[:, 0])
+            pred_nscc_adeno.extend(outputs_wsi_np_img[:, 1])
+            pred_nscc_squamous.extend(outputs_wsi_np_img[:, 2])
+            pred_normal.extend(outputs_wsi_np_img[:, 3])
 
             output_norm = np.where(outputs_wsi_np_img > 0.5, 1, 0)
             logging.info(f"pred_img: {output_norm}")
@@ -324,17 +215,15 @@ def train_1_epoch(cfg,
     for i in range(iterations):
         logging.info(f"[{epoch + 1}], {i + 1} / {iterations}")
         try:
-            wsi_id, labels = next(dataloader_iterator)
+            wsi_id, features_bag, mask, labels = next(dataloader_iterator)
         except StopIteration:
             dataloader_iterator = iter(generator)
-            wsi_id, labels = next(dataloader_iterator)
-            #inputs: bags, labels: labels of the bags
+            wsi_id, features_bag, mask, labels = next(dataloader_iterator)
+            #inputs: padded batch of bags, mask of the padding, labels: labels of the bags
         
-        wsi_id = wsi_id[0]
-        labels = torch.stack(labels)
         labels_np = labels.cpu().numpy().flatten()
 
-        labels_local = labels.float().flatten().to(device, non_blocking=True)
+        labels_local = labels.float().to(device, non_blocking=True)
 
         # print("[" + str(i) + "/" + str(len(train_dataset)) + "], " + "inputs_bag: " + str(wsi_id))
         # print("labels: " + str(labels_np))
@@ -344,41 +233,45 @@ def train_1_epoch(cfg,
         pipeline_transform = generate_transformer()
 
         if data_augmentation:
-            
-            training_generator_instance = get_generator_instances(patches_train[wsi_id], 
-                                                                preprocess,
-                                                                cfg.dataloader.batch_size, 
-                                                                pipeline_transform,
-                                                                cfg.dataloader.num_workers) 
-            
-            n_elems = len(patches_train[wsi_id])                                            
-            net.eval()
 
-            features = []
-            with torch.no_grad():
-                for instances in training_generator_instance:
-                    instances = instances.to(device, non_blocking=True)
+            bags = []
+            for wsi_id_bag in wsi_id:
+                training_generator_instance = get_generator_instances(patches_train[wsi_id_bag], 
+                                                                    preprocess,
+                                                                    cfg.dataloader.batch_size, 
+                                                                    pipeline_transform,
+                                                                    cfg.dataloader.num_workers) 
+                
+                n_elems = len(patches_train[wsi_id_bag])                                            
+                net.eval()
 
-                    # forward + backward + optimize
-                    feats = net.conv_layers(instances)
-                    feats = feats.view(-1, net.fc_input_features)
-                    feats_np = feats.cpu().numpy()
+                features = []
+                with torch.no_grad():
+                    for instances in training_generator_instance:
+                        instances = instances.to(device, non_blocking=True)
 
-                    features.extend(feats_np)
+                        # forward + backward + optimize
+                        feats = net.conv_layers(instances)
+                        feats = feats.view(-1, net.fc_input_features)
+                        feats_np = feats.cpu().numpy()
 
-            features_np = np.reshape(features,(n_elems, net.fc_input_features))
+                        features.extend(feats_np)
 
-        else:
-            features_np = np.load(datadir / "Saved_features" / cfg.data_augmentation.featuresdir /
-                                  f"{wsi_id}.npy")
+                features_np = np.reshape(features,(n_elems, net.fc_input_features))
+                bags.append(torch.tensor(features_np).float())
+
+            features_bag, mask = pad_bags(bags)
+
+        inputs_embedding = features_bag.to(device, non_blocking=True)
+        mask = mask.to(device, non_blocking=True)
 
         net.train()
         net.zero_grad(set_to_none=True)
 
-        inputs_embedding = torch.tensor(features_np,
-                                        requires_grad=True).float().to(device, non_blocking=True)
-
-        logits_img, cls_img = net(None, inputs_embedding)
+        # Forward in bf16 autocast with training.precision bf16, the loss in fp32
+        with precision_autocast(cfg, device):
+            logits_img, cls_img = net(None, inputs_embedding, mask)
+        logits_img = logits_img.float()
         
         if cfg.training.criterion == "focal":
             loss_img = focal_binary_cross_entropy(logits_img, labels_local, cfg.model.num_classes)
@@ -412,11 +305,11 @@ def train_1_epoch(cfg,
         logging.info(f"pred_img_logits: {outputs_wsi_np_img}")
         logging.info(f"train_loss: {train_loss}")
 
-        filenames_wsis.append(wsi_id)
-        pred_scc.append(outputs_wsi_np_img[0])
-        pred_nscc_adeno.append(outputs_wsi_np_img[1])
-        pred_nscc_squamous.append(outputs_wsi_np_img[2])
-        pred_normal.append(outputs_wsi_np_img[3])
+        filenames_wsis.extend(wsi_id)
+        pred_scc.extend(outputs_wsi_np_img[:, 0])
+        pred_nscc_adeno.extend(outputs_wsi_np_img[:, 1])
+        pred_nscc_squamous.extend(outputs_wsi_np_img[:, 2])
+        pred_normal.extend(outputs_wsi_np_img[:, 3])
 
         output_norm = np.where(outputs_wsi_np_img > 0.5, 1, 0)
         logging.info(f"pred_img: {output_norm}")
@@ -455,7 +348,10 @@ def train(cfg,
           validation_generator_bag,
           patches_validation,
           preprocess,
-          outputdir):
+          outputdir,
+          bag_cache,
+          views_cache,
+          backbone_weights):
 
     # Start Training 
     logging.info(f"== Start training {cfg.experiment_name} ==")
@@ -463,13 +359,26 @@ def train(cfg,
     early_stop = cfg.training.early_stop
     early_stop_cont = 0
 
-    iterations_train = int(len(train_dataset))
-    iterations_valid = int(len(validation_dataset))
+    # One iteration per batch of bags
+    iterations_train = int(len(training_generator_bag))
+    iterations_valid = int(len(validation_generator_bag))
 
     best_loss = 100000.0
     cont_iterations_tot = 0
     start_time = time.time()
 
+    # Checkpoints and predictions written in the background
+    checkpoint_writer = AsyncCheckpointWriter(cfg.training.get("checkpoints_in_flight", 2))
+
+    if use_bf16(cfg):
+        inputs_benchmark = torch.randn((cfg.dataloader.batch_size_bag, 1000, net.fc_input_features), device=device)
+        mask_benchmark = torch.ones(inputs_benchmark.shape[:2], dtype=torch.bool, device=device)
+        throughput = benchmark_precision(net,
+                                         lambda model: model(None, inputs_benchmark, mask_benchmark)[0].float().mean())
+        logging.info(f"== bf16 autocast: {throughput['bf16']:.1f} batches of bags/s, "
+                     f"fp32: {throughput['fp32']:.1f} batches of bags/s "
+                     f"({throughput['bf16'] / throughput['fp32']:.2f}x) ==")
+
     if cfg.training.resume_training:
         chkptdir = Path(thispath.parent.parent / 
                 "trained_models" / 
@@ -477,7 +386,10 @@ def train(cfg,
                 cfg.experiment_name)
         
         checkpoint = torch.load(chkptdir)
-        net.load_state_dict(checkpoint['model_state_dict'])
+        if net.conv_layers is None:
+            load_head_checkpoint(net, checkpoint['model_state_dict'])
+        else:
+            net.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
         epoch = checkpoint['epoch']
@@ -494,7 +406,8 @@ def train(cfg,
 
         start_time_epoch = time.time()
 
-        # Training
+        # Training, with the CNN features of augmented patches unless precomputed views are used
+        online_augmentation = cfg.data_augmentation.boolean and cfg.data_augmentation.get("views", 0) == 0
         
         y_true_tr, scores_tr, train_loss, accuracy_train, df_train = train_1_epoch(
                                                                       cfg,
@@ -508,10 +421,10 @@ def train(cfg,
                                                                       iterations_train,
                                                                       epoch,
                                                                       cont_iterations_tot,
-                                                                      cfg.data_augmentation.boolean)
+                                                                      online_augmentation)
         #save_training predictions
         filename_training_predictions = Path(outputdir / f"training_predictions_{epoch + 1}.csv")
-        df_train.to_csv(filename_training_predictions)
+        checkpoint_writer.save_csv(df_train, filename_training_predictions)
         
         arange_like_train = np.arange(len(y_true_tr))
         names = ["SCC", "NSCC Adeno", "NSCC Squamous", "No Cancer"]
@@ -628,12 +541,11 @@ def train(cfg,
                                                                   criterion,
                                                                   validation_generator_bag,
                                                                   iterations_valid,
-                                                                  epoch,
-                                                                  cfg.data_augmentation.featuresdir)
+                                                                  epoch)
         
         # Save validation predictions
         filename_validation_predictions = Path(outputdir / f"validation_predictions_{epoch + 1}.csv")
-        df_valid.to_csv(filename_validation_predictions) 
+        checkpoint_writer.save_csv(df_valid, filename_validation_predictions)
 
         arange_like_valid = np.arange(len(y_true_vd))
 
@@ -756,41 +668,31 @@ def train(cfg,
             best_loss = valid_loss
             best_epoch = epoch
 
-            try:
-                torch.save({'epoch': best_epoch,
-                            'model_state_dict': net.state_dict(),
-                            'optimizer_state_dict': optimizer.state_dict(),
-                            'scheduler_state_dict': scheduler.state_dict(),
-                            'train_loss': train_loss,
-                            'valid_loss': best_loss},
-                            model_filename,
-                            _use_new_zipfile_serialization=False)
-            except:
-                torch.save({'epoch': best_epoch,
-                            'model_state_dict': net.state_dict(),
-                            'optimizer_state_dict': optimizer.state_dict(),
-                            'scheduler_state_dict': scheduler.state_dict(),
-                            'train_loss': train_loss,
-                            'valid_loss': best_loss},
-                            model_filename)   
+            checkpoint_writer.save({'epoch': best_epoch,
+                                    'model_state_dict': {**backbone_weights, **net.state_dict()},
+                                    'optimizer_state_dict': optimizer.state_dict(),
+                                    'scheduler_state_dict': scheduler.state_dict(),
+                                    'train_loss': train_loss,
+                                    'valid_loss': best_loss},
+                                    model_filename)
             
             # Save best predictions
             best_training_predictions = Path(outputdir_results / 
                                              "training_predictions_best.csv")
-            df_train.to_csv(best_training_predictions)
+            checkpoint_writer.save_csv(df_train, best_training_predictions)
 
             best_validation_predictions = Path(outputdir_results / 
                                                "validation_predictions_best.csv")
-            df_valid.to_csv(best_validation_predictions) 
+            checkpoint_writer.save_csv(df_valid, best_validation_predictions)
 
         else:
             early_stop_cont = early_stop_cont+1
 
         model_weights_filename_checkpoint = Path(outputdir /'checkpoint.pt')
         #save checkpoint
-        torch.save({
+        checkpoint_writer.save({
             'epoch': epoch,
-            'model_state_dict': net.state_dict(),
+            'model_state_dict': {**backbone_weights, **net.state_dict()},
             'optimizer_state_dict': optimizer.state_dict(),
             'scheduler_state_dict': scheduler.state_dict(),
             'best_loss': valid_loss,
@@ -798,6 +700,16 @@ def train(cfg,
             'valid_accuracy': accuracy_valid},
             model_weights_filename_checkpoint)
 
+        caches = {"Bag cache": bag_cache}
+        if views_cache is not bag_cache:
+            caches["Views cache"] = views_cache
+        for cache_name, cache in caches.items():
+            cache_stats = cache.stats()
+            logging.info(f"{cache_name} epoch {epoch}: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                         f"({cache_stats['hit_rate']:.1%} hit rate), {cache_stats['evictions']} evictions, "
+                         f"{cache_stats['cached_bags']} bags cached in {cache_stats['cached_gb']:.2f} GB")
+            cache.reset_stats()
+
         epoch = epoch + 1
         if (early_stop_cont == early_stop):
             logging.info("======== EARLY STOPPING ========")
@@ -805,6 +717,8 @@ def train(cfg,
         message = timer(start_time_epoch, time.time())
         logging.info(f"Time to complete epoch {epoch + 1} is {message}" )
 
+    checkpoint_writer.close()
+
     message = timer(start_time, time.time())
     logging.info(f"Training complete in {message}" )
     logging.info(f"Best loss: {best_loss} at {best_epoch + 1}")
@@ -812,56 +726,12 @@ def train(cfg,
     torch.cuda.empty_cache()
 
 
-@click.command()
-@click.option(
-    "--config_file",
-    default="config_MIL_best",
-    prompt="Name of the config file without extension",
-    help="Name of the config file without extension",
-)
-@click.option(
-    "--exp_name_moco",
-    default="MoCo_resnet101_v2",
-    prompt="Name of the MoCo experiment",
-    help="Name of the MoCo experiment",
-)
-def main(config_file, exp_name_moco):
-    # Read the configuration file
-    configdir = Path(thispath.parent / f"{config_file}.yml")
-    cfg = yaml_load(configdir)
-
-    # Create directory to save the resuls
-    outputdir = Path(thispath.parent.parent / "trained_models" / "MIL" / f"{cfg.experiment_name}")
-    Path(outputdir).mkdir(exist_ok=True, parents=True)
-
-    # Save config parameters for experiment
-    with open(Path(f"{outputdir}/config_{cfg.experiment_name}.yml"), 'w') as yaml_file:
-        yaml.dump(edict2dict(cfg), yaml_file, default_flow_style=False)
-    # wandb login
-
-    # For logging
-    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s',
-                        encoding='utf-8',
-                        level=logging.INFO,
-                        handlers=[
-                            logging.FileHandler(outputdir / "debug.log"),
-                            logging.StreamHandler()
-                        ],
-                        datefmt='%m/%d/%Y %I:%M:%S %p')
-    
-    logging.info(f"CUDA current device {torch.device('cuda:0')}")
-    logging.info(f"CUDA devices available {torch.cuda.device_count()}")
-
-    # Seed for reproducibility
-    seed = 33
-    torch.manual_seed(seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed_all(seed)
-    np.random.seed(seed)
-
-    # Loading Data Split
-    k = 5
-
+def data_split_from_csv(k, exp_name_moco):
+    """
+    Reads the k-fold-crossvalidation splits of AOEC and RUMC from the data split .csv files,
+    the WSI to discard (<10 patches) from the metadata .csv files and the patches of every
+    WSI from the filtered patches .csv files.
+    """
     data_split = pd.read_csv(Path(datadir / f"{k}_fold_crossvalidation_data_split.csv"), index_col=0)
     train_dataset_k = []
     validation_dataset_k = []
@@ -935,7 +805,135 @@ def main(config_file, exp_name_moco):
 
         name = wsi_patches_path.parent.stem
         patches_path[name] = csv_patch_path
- 
+
+    return (train_dataset_k, validation_dataset_k, train_labels_k, validation_labels_k,
+            discard_wsi_dataset, patches_path)
+
+
+def data_split_from_catalog(k, exp_name_moco, catalog_file, load_patches):
+    """
+    Same data split as data_split_from_csv from a single indexed query per fold to the
+    slide catalog (database/catalog.py). WSI with <10 patches are discarded by the query and
+    the filtered patches .csv files are only read when the patches are needed (load_patches).
+    As in data_split_from_csv, the AOEC slides use the version 1 patch selection unless
+    exp_name_moco is a v2 experiment.
+    """
+    train_dataset_k = []
+    validation_dataset_k = []
+    train_labels_k = []
+    validation_labels_k = []
+
+    version_patch_selection = "v2" if "v2" in exp_name_moco else "v1"
+    logging.info(f"== Version {version_patch_selection[1]} filter patches ==")
+    cohort_names = patch_cohorts(("aoec", "rumc"), version_patch_selection)
+
+    for fold in range(k):
+        train_wsi, labels_train, validation_wsi, labels_validation = fold_split(fold,
+                                                                               ("aoec", "rumc"),
+                                                                               cohort_names,
+                                                                               min_patches=10,
+                                                                               catalog_file=catalog_file)
+        train_dataset_k.append(train_wsi)
+        validation_dataset_k.append(validation_wsi)
+        train_labels_k.append(labels_train)
+        validation_labels_k.append(labels_validation)
+
+    patches_path = {}
+    if load_patches:
+        # Only the slides of the folds, from the training cohorts
+        wsis = dict.fromkeys(i for fold in train_dataset_k + validation_dataset_k for i in fold)
+        for name, wsi_patches_path in tqdm(patches_csv(wsis, cohort_names, catalog_file=catalog_file).items(),
+                                           desc="Selecting patches: "):
+            patches_path[name] = pd.read_csv(wsi_patches_path).to_numpy()
+
+    return (train_dataset_k, validation_dataset_k, train_labels_k, validation_labels_k,
+            [], patches_path)
+
+
+@click.command()
+@click.option(
+    "--config_file",
+    default="config_MIL_best",
+    prompt="Name of the config file without extension",
+    help="Name of the config file without extension",
+)
+@click.option(
+    "--exp_name_moco",
+    default="MoCo_resnet101_v2",
+    prompt="Name of the MoCo experiment",
+    help="Name of the MoCo experiment",
+)
+def main(config_file, exp_name_moco):
+    # Read the configuration file
+    configdir = Path(thispath.parent / f"{config_file}.yml")
+    cfg = yaml_load(configdir)
+
+    # Create directory to save the resuls
+    outputdir = Path(thispath.parent.parent / "trained_models" / "MIL" / f"{cfg.experiment_name}")
+    Path(outputdir).mkdir(exist_ok=True, parents=True)
+
+    # Save config parameters for experiment
+    with open(Path(f"{outputdir}/config_{cfg.experiment_name}.yml"), 'w') as yaml_file:
+        yaml.dump(edict2dict(cfg), yaml_file, default_flow_style=False)
+    # wandb login
+
+    # For logging
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s',
+                        encoding='utf-8',
+                        level=logging.INFO,
+                        handlers=[
+                            logging.FileHandler(outputdir / "debug.log"),
+                            logging.StreamHandler()
+                        ],
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    
+    logging.info(f"CUDA current device {torch.device('cuda:0')}")
+    logging.info(f"CUDA devices available {torch.cuda.device_count()}")
+
+    # Seed for reproducibility
+    seed = 33
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+
+    # Loading Data Split
+    k = 5
+
+    # Augmented views of the features precomputed with preprocessing.store_augmented_features
+    num_views = cfg.data_augmentation.get("views", 0) if cfg.data_augmentation.boolean else 0
+
+    # The backbone is only needed to compute the features of augmented patches every iteration
+    online_augmentation = cfg.data_augmentation.boolean and num_views == 0
+
+    catalog_file = Path(datadir / "slide_catalog.db")
+    if catalog_file.exists():
+        logging.info(f"== Loading data split from the slide catalog {catalog_file} ==")
+        data_split = data_split_from_catalog(k, exp_name_moco, catalog_file, online_augmentation)
+    else:
+        data_split = data_split_from_csv(k, exp_name_moco)
+
+    (train_dataset_k, validation_dataset_k, train_labels_k, validation_labels_k,
+     discard_wsi_dataset, patches_path) = data_split
+
+    # Features of every WSI, shared by all the folds
+    feature_store = FeatureStore(Path(datadir / "Saved_features" / cfg.data_augmentation.featuresdir),
+                                 cfg.data_augmentation.get("store_name", "feature_store"))
+    logging.info(f"== Feature store with {len(feature_store)} WSI consolidated ==")
+
+    # Features loaded once as float32 tensors and kept in RAM within the budget
+    bag_cache = BagCache(feature_store, cfg.dataloader.get("bag_cache_gb", 0))
+    logging.info(f"== Bag cache of {cfg.dataloader.get('bag_cache_gb', 0)} GB ==")
+
+    if num_views > 0:
+        augmenteddir = cfg.data_augmentation.get("augmenteddir", f"{cfg.data_augmentation.featuresdir}_augmented")
+        views_store = FeatureStore(Path(datadir / "Saved_features" / augmenteddir),
+                                   cfg.data_augmentation.get("store_name", "feature_store"))
+        views_cache = BagCache(views_store, cfg.dataloader.get("views_cache_gb", 0))
+        logging.info(f"== Training with {num_views} augmented views of the features from {augmenteddir} ==")
+    else:
+        views_cache = bag_cache
+
     # Train for k folds
     for i in range(k):
         
@@ -976,23 +974,34 @@ def main(config_file, exp_name_moco):
         logging.info(f"Total number of WSI for train {len(patches_train.values())}")
         logging.info(f"Total number of WSI for validation {len(patches_validation.values())}")
 
-        # Load datasets
-        batch_size_bag = cfg.dataloader.batch_size_bag
-
-        # params_train_bag = {'batch_size': batch_size_bag,
-        #     'sampler': sampler(train_data_labels, alpha=0.25)}
-
-        params_train_bag = {'batch_size': batch_size_bag,
-                            'shuffle': True}
-
-        params_valid_bag = {'batch_size': batch_size_bag, # len(validation_dataset),
-                            'shuffle': False}
+        # Load datasets, bags with their features loaded ahead by background threads
+        params_prefetch = {'depth': cfg.dataloader.get('prefetch_bags', 4),
+                           'num_workers': cfg.dataloader.get('prefetch_workers', 2),
+                           'pin_memory': cfg.dataloader.get('pin_memory', True)}
 
-        training_set_bag = Dataset_bag_MIL(train_dataset, train_labels)
-        training_generator_bag = DataLoader(training_set_bag, **params_train_bag)
+        training_set_bag = Dataset_bag_features(train_dataset, train_labels, views_cache,
+                                                load_features=not cfg.data_augmentation.boolean or num_views > 0,
+                                                num_views=num_views)
 
-        validation_set_bag = Dataset_bag_MIL(validation_dataset, validation_labels)
-        validation_generator_bag = DataLoader(validation_set_bag, **params_valid_bag)
+        # Batches of batch_size_bag bags of similar size, padded and masked
+        batch_size_bag = cfg.dataloader.batch_size_bag
+        train_lengths = [len(patches_train[wsi]) if wsi in patches_train else feature_store.length(wsi)
+                         for wsi in train_dataset]
+        validation_lengths = [feature_store.length(wsi) for wsi in validation_dataset]
+        training_generator_bag = BagPrefetcher(training_set_bag,
+                                               batch_sampler=Bucket_batch_sampler(train_lengths,
+                                                                                  batch_size_bag,
+                                                                                  shuffle=True),
+                                               collate_fn=collate_bags,
+                                               **params_prefetch)
+
+        validation_set_bag = Dataset_bag_features(validation_dataset, validation_labels, bag_cache)
+        validation_generator_bag = BagPrefetcher(validation_set_bag,
+                                                 batch_sampler=Bucket_batch_sampler(validation_lengths,
+                                                                                    batch_size_bag,
+                                                                                    shuffle=False),
+                                                 collate_fn=collate_bags,
+                                                 **params_prefetch)
 
         # Load features from MoCo model
         experiment_name = exp_name_moco
@@ -1019,20 +1028,28 @@ def main(config_file, exp_name_moco):
                     num_freezed_layers=cfg.model.num_frozen_layers,
                     dropout=cfg.model.dropout,
                     embedding_bool=cfg.model.embedding_bool,
-                    pool_algorithm=cfg.model.pool_algorithm
+                    pool_algorithm=cfg.model.pool_algorithm,
+                    build_backbone=online_augmentation,
+                    pretrained=False
                     )
 
         hidden_space_len = cfg.model.hidden_space_len
 
         net = MIL_model(model, hidden_space_len, cfg)
 
-        net.load_state_dict(checkpoint_moco["encoder_state_dict"], strict=False)
+        load_checkpoint(net, checkpoint_moco["encoder_state_dict"])
         net.to(device)
+
+        # Backbone of MoCo saved in the checkpoints of a head-only model
+        backbone_weights = {}
+        if net.conv_layers is None:
+            backbone_weights = backbone_state_dict(checkpoint_moco["encoder_state_dict"])
         net.eval()
 
-        for name, param in net.conv_layers.named_parameters():
-            #if '10' in name or '11' in name: 
-            param.requires_grad = False
+        if net.conv_layers is not None:
+            for name, param in net.conv_layers.named_parameters():
+                #if '10' in name or '11' in name: 
+                param.requires_grad = False
 
         total_params = sum(p.numel() for p in net.parameters())
         logging.info(f'{total_params:,} total parameters.')
@@ -1103,7 +1120,10 @@ def main(config_file, exp_name_moco):
             validation_generator_bag,
             patches_validation,
             preprocess,
-            outputdir_kmodel)
+            outputdir_kmodel,
+            bag_cache,
+            views_cache,
+            backbone_weights)
 
         if cfg.wandb.enable:
             wandb.finish()
@@ -8,13 +8,20 @@ from tqdm import tqdm
 import click
 from natsort import natsorted
 import torch
-from database import Dataset_instance
+from database import Dataset_instance, PatchPathIndex, Resumable_sampler
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 import albumentations as A
 from torchvision import transforms
 from training.encoder import Encoder
 from training.models import ModelOption
-from training.utils_trainig import momentum_step, contrastive_loss, update_queue
+from training.utils_trainig import momentum_step, contrastive_loss, rng_state, set_rng_state
+from training.moco_queue import KeyQueue, shuffle_batch, unshuffle_batch
+from training.checkpoint_writer import AsyncCheckpointWriter
+from training.distributed import init_distributed, is_distributed, is_main_process, get_rank, get_world_size, unwrap_model
+from training.distributed import concat_all_gather, all_gather_object, reduce_mean, batch_shuffle_ddp, batch_unshuffle_ddp
+from training.precision import precision_autocast, use_bf16, benchmark_precision
+from training.augmentation import BatchAugmentation, normalize_batch
 from training.utils_trainig import yaml_load, initialize_wandb, edict2dict
 from utils import timer
 import wandb 
@@ -26,6 +33,19 @@ datadir = Path(thispath.parent.parent / "data")
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 
+def checkpoint_paths(outputdir, cfg):
+    """
+    Best and temporary (latest state, to resume the training) checkpoints of the experiment,
+    in trained_models/MoCo/<experiment_name>/<magnification>/<model_name>.
+    """
+    outputdir_results = Path(outputdir /
+                             cfg.dataset.magnification /
+                             cfg.model.model_name)
+
+    return (Path(outputdir_results / f"{cfg.experiment_name}.pt"),
+            Path(outputdir_results / f"{cfg.experiment_name}_temporary.pt"))
+
+
 def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess, cfg, outputdir):
     # Training
     logging.info("== Start training ==")
@@ -34,37 +54,65 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
     dataset_path = natsorted([i for i in datadir.rglob("*_densely_filtered_paths_v2.csv") 
                               if "Mask_PyHIST" in str(i) and "Mask_PyHIST_v1" not in str(i)])
 
-    number_patches = 0
-    path_patches = []
-    for wsi_patches in tqdm(dataset_path, desc="Selecting all patches for training"):
+    # Paths of all the patches in a compact index shared by the DataLoader workers
+    path_patches = PatchPathIndex.from_csv_files(dataset_path)
+    number_patches = len(path_patches)
 
-        csv_instances = pd.read_csv(wsi_patches).to_numpy()
-        
-        number_patches = number_patches + len(csv_instances)
-        path_patches.extend(csv_instances)
-
-    logging.info(f"Total number of patches {number_patches}")
+    logging.info(f"Total number of patches {number_patches} ({path_patches.nbytes() / 1024**2:.1f} MB index)")
     moco_m = cfg.training.moco_m
     temperature = cfg.training.temperature
     num_keys = cfg.training.num_keys
+    queue_chunk_size = cfg.training.get("queue_chunk_size", None)
     batch_size = cfg.dataloader.batch_size
     num_workers = cfg.dataloader.num_workers
     shuffle_bn = True
 
+    # Augmentation of uint8 batches on the device instead of per patch in the workers
+    batched_augmentation = cfg.data_augmentation.get("batched", False)
+
+    # Keys of the momentum encoder, preallocated once and kept for the whole run
+    queue = KeyQueue(num_keys, cfg.training.moco_dim, device=device)
+    queue_warmup_time = 0.0
+
+    # Checkpoints written in the background
+    checkpoint_writer = AsyncCheckpointWriter(cfg.training.get("checkpoints_in_flight", 2))
+
+    # Order of the patches saved in the checkpoints, with torchrun every process trains on
+    # its shard of the patches (batch_size per process)
+    sampler = Resumable_sampler(number_patches, seed=33, rank=get_rank(), world_size=get_world_size())
+    if is_distributed():
+        logging.info(f"== DistributedDataParallel with {get_world_size()} processes, "
+                     f"{len(sampler)} patches per process ==")
+
+    # Counters and random generators of the interrupted epoch
+    resume_state = None
+
+    # Create directories for the outputs
+    model_filename, model_temporary_filename = checkpoint_paths(outputdir, cfg)
+    model_filename.parent.mkdir(exist_ok=True, parents=True)
+
     if cfg.training.resume_training:
-        chkptdir = Path(thispath.parent.parent /
-                "trained_models" /
-                "MoCo" /
-                cfg.dataset.magnification /
-                cfg.model.model_name /
-                f"{cfg.experiment_name}_temporary.pt")
-        checkpoint = torch.load(chkptdir)
-        encoder.load_state_dict(checkpoint['encoder_state_dict'])
+        chkptdir = model_temporary_filename
+        checkpoint = torch.load(chkptdir, map_location=device)
+        unwrap_model(encoder).load_state_dict(checkpoint['encoder_state_dict'])
         momentum_encoder.load_state_dict(checkpoint['m_encoder_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
         epoch = checkpoint['epoch']
-        best_loss = checkpoint['loss']
+        best_loss = checkpoint.get('best_loss', checkpoint['loss'])
+        best_epoch = checkpoint.get('best_epoch', epoch)
+        best_total_iters = checkpoint.get('best_total_iters', 0)
+        if 'queue_state_dict' in checkpoint:
+            queue.load_state_dict(checkpoint['queue_state_dict'])
+            queue_warmup_time = checkpoint.get('queue_warmup_time', 0.0)
+            logging.info(f"== Queue with {len(queue)} keys restored from {chkptdir} ==")
+        if 'sampler_state_dict' in checkpoint:
+            sampler.load_state_dict(checkpoint['sampler_state_dict'])
+            resume_state = {'total_iters': checkpoint['total_iters'],
+                            'cont_iterations_tot': checkpoint['cont_iterations_tot'],
+                            'train_loss_moco': checkpoint['train_loss_moco'],
+                            'rng_states': checkpoint['rng_states']}
+            logging.info(f"== Resuming epoch {epoch} at iteration {checkpoint['total_iters']} ==")
     else:
         epoch = 0 
         best_loss = 100000.0
@@ -79,6 +127,15 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
     # wandb.watch(encoder, log="all", log_freq=1000, log_graph=True)
     # wandb.watch(momentum_encoder, log="all", log_freq=1000, log_graph=True)
 
+    if use_bf16(cfg):
+        inputs_benchmark = torch.randn((min(batch_size, 32), 3, 224, 224), device=device)
+        throughput = benchmark_precision(unwrap_model(encoder),
+                                         lambda model: model(inputs_benchmark).float().square().mean(),
+                                         iterations=3)
+        logging.info(f"== bf16 autocast: {throughput['bf16'] * len(inputs_benchmark):.1f} patches/s, "
+                     f"fp32: {throughput['fp32'] * len(inputs_benchmark):.1f} patches/s "
+                     f"({throughput['bf16'] / throughput['fp32']:.2f}x) ==")
+
     # Switch to train mode
     encoder.train()
     momentum_encoder.train()
@@ -92,32 +149,48 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
         #accumulator loss for the outputs
         train_loss_moco = 0.0
 
-        logging.info(f"== Initializing a queue with {num_keys} keys ==")
-        start_time_queue = time.time()
-        queue = []
-
         # dataloader_iterator = iter(dataloader_bag)
 
+        # Same order and augmentations of the patches for a given epoch
+        sampler.set_epoch(epoch)
+
         params_instance = {'batch_size': batch_size,
-                           'shuffle': True,
+                           'sampler': sampler,
                            'pin_memory': True,
                            'drop_last':True,
-                           'num_workers': num_workers}
+                           'num_workers': num_workers,
+                           'generator': torch.Generator().manual_seed(sampler.augmentation_seed())}
 
-        instances = Dataset_instance(path_patches, transform, preprocess)
+        if batched_augmentation:
+            instances = Dataset_instance(path_patches)
+        else:
+            instances = Dataset_instance(path_patches, transform, preprocess, seed=sampler.augmentation_seed())
         generator = DataLoader(instances, **params_instance)
 
-        with torch.no_grad():
-            for i, (_, img) in enumerate(generator):
-                key_feature = momentum_encoder(img.to(device, non_blocking=True))
-                key_feature = torch.nn.functional.normalize(key_feature, dim=1)
-                queue.append(key_feature)
+        # The queue is only filled once per run, then it is updated by every iteration
+        if queue.is_full():
+            message = timer(0, queue_warmup_time)
+            logging.info(f"== Queue with {len(queue)} keys kept from the previous epoch, {message} of warm-up saved ==")
+
+        else:
+            logging.info(f"== Initializing a queue with {num_keys} keys ==")
+            start_time_queue = time.time()
+            queue.reset()
 
-                if i == (num_keys / batch_size) - 1:
-                    break
-            queue = torch.cat(queue, dim=0)
-        message = timer(start_time_queue, time.time())
-        logging.info(f"== Queue done in {message} ==")
+            with torch.no_grad():
+                for i, (_, img) in enumerate(generator):
+                    if batched_augmentation:
+                        img = preprocess(transform(img.to(device, non_blocking=True)))
+                    with precision_autocast(cfg, device):
+                        key_feature = momentum_encoder(img.to(device, non_blocking=True))
+                    key_feature = torch.nn.functional.normalize(key_feature.float(), dim=1)
+                    queue.enqueue(concat_all_gather(key_feature))
+
+                    if queue.is_full():
+                        break
+            queue_warmup_time = time.time() - start_time_queue
+            message = timer(start_time_queue, time.time())
+            logging.info(f"== Queue done in {message} ==")
 
         # dataloader_iterator = iter(dataloader_bag)
 
@@ -134,6 +207,16 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
 
         j = 0
 
+        # Continue the interrupted epoch where its last checkpoint was saved
+        if resume_state is not None:
+            total_iters = resume_state['total_iters']
+            cont_iterations_tot = resume_state['cont_iterations_tot']
+            train_loss_moco = resume_state['train_loss_moco']
+            if len(resume_state['rng_states']) == get_world_size():
+                set_rng_state(resume_state['rng_states'][get_rank()])
+            resume_state = None
+        start_iters_epoch = total_iters
+
         for a, (x_k, x_q) in enumerate(generator):
         
             # p = float(cont_iterations_tot + epoch * tot_iterations) / training_arguments["epochs"] / tot_iterations
@@ -146,34 +229,43 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
             #encoder.train()
             #encoder.zero_grad()
 
-            # Shffled BN : shuffle x_k before distributing it among GPUs (Section. 3.3)
-            if shuffle_bn:
-                idx = torch.randperm(x_k.size(0))
-                x_k = x_k[idx]
+            # Query augmented on the device from the same uint8 patches
+            if batched_augmentation:
+                images = x_k.to(device, non_blocking=True)
+                x_q = preprocess(transform(images))
+                x_k = preprocess(images)
 
             # x_q, x_k : (N, 3, 64, 64)            
             x_q, x_k = x_q.to(device, non_blocking=True), x_k.to(device, non_blocking=True)
 
-            q = encoder(x_q) # q : (N, 128)
+            # Shffled BN : shuffle x_k before distributing it among GPUs (Section. 3.3),
+            # across all the processes with DistributedDataParallel
+            if shuffle_bn and is_distributed():
+                x_k, idx_unshuffle = batch_shuffle_ddp(x_k)
+            elif shuffle_bn:
+                x_k, idx_unshuffle = shuffle_batch(x_k)
 
-            with torch.no_grad():
-                k = momentum_encoder(x_k).detach() # k : (N, 128)
+            # Encoders in bf16 autocast with training.precision bf16, the loss in fp32
+            with precision_autocast(cfg, device):
+                q = encoder(x_q) # q : (N, 128)
+
+                with torch.no_grad():
+                    k = momentum_encoder(x_k).detach() # k : (N, 128)
     
             #q = torch.div(q,torch.norm(q,dim=1).reshape(-1,1))
             #k = torch.div(k,torch.norm(k,dim=1).reshape(-1,1))	
     
-            q = torch.nn.functional.normalize(q, dim=1)
-            k = torch.nn.functional.normalize(k, dim=1)
+            q = torch.nn.functional.normalize(q.float(), dim=1)
+            k = torch.nn.functional.normalize(k.float(), dim=1)
 
             #q = torch.nn.functional.normalize(q, dim=0)
             #k = torch.nn.functional.normalize(k, dim=0)
 
             # Shuffled BN : unshuffle k (Section. 3.3)
-            if shuffle_bn:
-                k_temp = torch.zeros_like(k)
-                for a, j in enumerate(idx):
-                    k_temp[j] = k[a]
-            k = k_temp
+            if shuffle_bn and is_distributed():
+                k = batch_unshuffle_ddp(k, idx_unshuffle)
+            elif shuffle_bn:
+                k = unshuffle_batch(k, idx_unshuffle)
             """
             # positive logits: Nx1
             l_pos = torch.einsum('nc,nc->n', [q, k]).unsqueeze(-1)
@@ -195,7 +287,7 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
             # Get loss and backprop
             loss_moco = criterion(logits, labels)
             """
-            loss_moco = contrastive_loss(q, k, queue, temperature)
+            loss_moco = contrastive_loss(q, k, queue.queue(), temperature, queue_chunk_size)
 
             loss = loss_moco #+ loss_domains
 
@@ -208,11 +300,11 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
             encoder.zero_grad(set_to_none=True)
 
             # Momentum encoder update
-            momentum_step(encoder, momentum_encoder, m=moco_m)
+            momentum_step(unwrap_model(encoder), momentum_encoder, m=moco_m)
 
-            # Update dictionary
+            # Update dictionary with the keys of all the processes, the same queue everywhere
             #queue = torch.cat([k, queue[:queue.size(0) - k.size(0)]], dim=0)
-            queue = update_queue(queue, k, num_keys)
+            queue.enqueue(concat_all_gather(k))
             #print(queue.shape)
 
             # Print a training status, save a loss value, and plot a loss graph.
@@ -220,19 +312,21 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
             train_loss_moco = train_loss_moco + ((1 / (total_iters+1)) * (loss_moco.item() - train_loss_moco)) 
             total_iters = total_iters + 1
             cont_iterations_tot = cont_iterations_tot + 1
+            sampler.advance(batch_size)
 
             logging.info(f"[Epoch : {epoch} / Total iters : {total_iters}] : loss_moco :{train_loss_moco:.4f}")
 
-            # Create directories for the outputs
-            outputdir_results = Path(outputdir /
-                                     cfg.dataset.magnification / 
-                                     cfg.model.model_name)
-            Path(outputdir_results).mkdir(exist_ok=True, parents=True)
+            if (total_iters%200==True):
+                # Same loss on every process, so they take the same decisions
+                train_loss_moco = reduce_mean(train_loss_moco)
 
-            model_filename = Path(outputdir_results / f"{cfg.experiment_name}.pt")
-            model_temporary_filename = Path(outputdir_results / f"{cfg.experiment_name}_temporary.pt")
+                # Position in the epoch and random generators of every process
+                training_state = {'sampler_state_dict': sampler.state_dict(),
+                                  'rng_states': all_gather_object(rng_state()),
+                                  'total_iters': total_iters,
+                                  'cont_iterations_tot': cont_iterations_tot,
+                                  'train_loss_moco': train_loss_moco}
 
-            if (total_iters%200==True):
                 wandb.log({"iterations": cont_iterations_tot})
                 wandb.define_metric("train/loss_iter", step_metric="iterations")
                 wandb.define_metric("train/lr_iter", step_metric="iterations")
@@ -248,43 +342,34 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
                     logging.info(f"Previous loss : {best_loss:.4f} New loss: {train_loss_moco:.4f}")
                     best_loss = train_loss_moco
 
-
-                    try:
-                        torch.save({'epoch': epoch,
-                                    'encoder_state_dict': encoder.state_dict(),
-                                    'm_encoder_state_dict': momentum_encoder.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'loss': best_loss},
-                                    model_filename,
-                                    _use_new_zipfile_serialization=False)
-                    except:
-                        torch.save({'epoch': epoch,
-                                    'encoder_state_dict': encoder.state_dict(),
-                                    'm_encoder_state_dict': momentum_encoder.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'loss': best_loss},
-                                    model_filename)
-                        
-                else:
-                    try:
-                        torch.save({'epoch': epoch,
-                                    'encoder_state_dict': encoder.state_dict(),
-                                    'm_encoder_state_dict': momentum_encoder.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'loss': train_loss_moco}, 
-                                    model_temporary_filename, 
-                                    _use_new_zipfile_serialization=False)
-                    except:
-                        torch.save({'epoch': epoch,
-                                    'encoder_state_dict': encoder.state_dict(),
-                                    'm_encoder_state_dict': momentum_encoder.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'loss': train_loss_moco}, 
-                                    model_temporary_filename)
+                    # Only the first process writes the checkpoints
+                    if is_main_process():
+                        checkpoint_writer.save({'epoch': epoch,
+                                                'encoder_state_dict': unwrap_model(encoder).state_dict(),
+                                                'm_encoder_state_dict': momentum_encoder.state_dict(),
+                                                'optimizer_state_dict': optimizer.state_dict(),
+                                                'scheduler_state_dict': scheduler.state_dict(),
+                                                'queue_state_dict': queue.state_dict(),
+                                                'queue_warmup_time': queue_warmup_time,
+                                                **training_state,
+                                                'loss': best_loss},
+                                                model_filename)
+
+                # The temporary checkpoint is always the latest state, to resume the training
+                if is_main_process():
+                    checkpoint_writer.save({'epoch': epoch,
+                                            'encoder_state_dict': unwrap_model(encoder).state_dict(),
+                                            'm_encoder_state_dict': momentum_encoder.state_dict(),
+                                            'optimizer_state_dict': optimizer.state_dict(),
+                                            'scheduler_state_dict': scheduler.state_dict(),
+                                            'queue_state_dict': queue.state_dict(),
+                                            'queue_warmup_time': queue_warmup_time,
+                                            **training_state,
+                                            'best_loss': best_loss,
+                                            'best_epoch': best_epoch,
+                                            'best_total_iters': best_total_iters,
+                                            'loss': train_loss_moco},
+                                            model_temporary_filename)
 
                 torch.cuda.empty_cache()
     
@@ -300,6 +385,8 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
         logging.info(f"Epoch {epoch} train loss: {train_loss_moco}")
         message = timer(start_time_epoch, time.time())
         logging.info(f"Time to complete epoch {epoch + 1} is {message}" )
+        patches_per_second = (total_iters - start_iters_epoch) * batch_size * get_world_size() / (time.time() - start_time_epoch)
+        logging.info(f"{patches_per_second:.1f} patches/s with {get_world_size()} processes")
 
         # print("evaluating validation")
         """
@@ -328,6 +415,8 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
         if (early_stop_cont == early_stop):
             logging.info("======== EARLY STOPPING ========")
 
+    checkpoint_writer.close()
+
     message = timer(start_time, time.time())
     logging.info(f"Training complete in {message}" )
     logging.info(f"Best loss: {best_loss} at {best_epoch + 1} and total iters {best_total_iters}")
@@ -345,6 +434,7 @@ def train(encoder, momentum_encoder, optimizer, scheduler, transform, preprocess
     help="Name of the config file without extension",
 )
 def main(config_file):
+    global device
 
     # Read the configuration file
     configdir = Path(thispath.parent / f"{config_file}.yml")
@@ -354,28 +444,39 @@ def main(config_file):
     outputdir = Path(thispath.parent.parent / "trained_models" / "MoCo" / f"{cfg.experiment_name}")
     Path(outputdir).mkdir(exist_ok=True, parents=True)
 
-    # wandb login
-    wandb.login()
-
-    if cfg.wandb.enable:
-            # key = os.environ.get("WANDB_API_KEY")
-            wandb_run = initialize_wandb(cfg, outputdir)
-            wandb_run.define_metric("epoch", summary="max")
-
-    # For logging
-    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s',
-                        encoding='utf-8',
-                        level=logging.INFO,
-                        handlers=[
-                            logging.FileHandler(outputdir / "debug.log"),
-                            logging.StreamHandler()
-                        ],
-                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    # One process per GPU (or per group of CPU cores) when launched with torchrun
+    rank, world_size, device = init_distributed(cfg.training.get("dist_backend", None))
+
+    if rank == 0:
+        # wandb login
+        wandb.login()
+
+        if cfg.wandb.enable:
+                # key = os.environ.get("WANDB_API_KEY")
+                wandb_run = initialize_wandb(cfg, outputdir)
+                wandb_run.define_metric("epoch", summary="max")
+
+        # For logging
+        logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s',
+                            encoding='utf-8',
+                            level=logging.INFO,
+                            handlers=[
+                                logging.FileHandler(outputdir / "debug.log"),
+                                logging.StreamHandler()
+                            ],
+                            datefmt='%m/%d/%Y %I:%M:%S %p')
+    else:
+        # Only the first process logs
+        wandb.init(mode="disabled")
+        logging.basicConfig(format=f'%(asctime)s %(levelname)s:[rank {rank}] %(message)s',
+                            level=logging.WARNING,
+                            handlers=[logging.StreamHandler()],
+                            datefmt='%m/%d/%Y %I:%M:%S %p')
     logging.info(f"CUDA current device {torch.device('cuda:0')}")
     logging.info(f"CUDA devices available {torch.cuda.device_count()}")
 
-    # Seed for reproducibility
-    seed = 33
+    # Seed for reproducibility, different augmentations on every process
+    seed = 33 + rank
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
@@ -464,6 +565,16 @@ def main(config_file):
         antialias=True)
     ])
 
+    # Batched equivalents, without the costly distortions
+    if cfg.data_augmentation.get("batched", False):
+        logging.info("== Batched augmentation on the device ==")
+        pipeline_transform = BatchAugmentation(prob_augmentation,
+                                               equalize_images=cfg.data_augmentation.get("equalize", True))
+        preprocess = lambda images: normalize_batch(images,
+                                                    cfg.dataset.mean,
+                                                    cfg.dataset.stddev,
+                                                    model.resize_param)
+
     # Dataset and Dataloader
     # Load CSV with WSI IDs
     # train_dataset = pd.read_csv(Path(datadir / "labels.csv"), index_col=0)
@@ -479,6 +590,13 @@ def main(config_file):
 
     # Optimizer
 
+    # Gradients averaged across the processes, the weights of the first process broadcast to the others.
+    # The fc layer of the backbone is not used by the encoder
+    if world_size > 1:
+        encoder = DistributedDataParallel(encoder,
+                                          device_ids=[device.index] if device.type == "cuda" else None,
+                                          find_unused_parameters=True)
+
     optimizer = getattr(torch.optim, cfg.training.optimizer)
     optimizer = optimizer(encoder.parameters(), **cfg.training.optimizer_args)
 
@@ -486,11 +604,12 @@ def main(config_file):
     scheduler = scheduler(optimizer, **cfg.training.lr_scheduler_args)
 
     # Initialize momentum_encoder with parameters of encoder.
-    momentum_step(encoder, momentum_encoder, m=0)
+    momentum_step(unwrap_model(encoder), momentum_encoder, m=0)
 
     # Save config parameters for experiment
-    with open(Path(f"{outputdir}/config_{cfg.experiment_name}.yml"), 'w') as yaml_file:
-        yaml.dump(edict2dict(cfg), yaml_file, default_flow_style=False)
+    if rank == 0:
+        with open(Path(f"{outputdir}/config_{cfg.experiment_name}.yml"), 'w') as yaml_file:
+            yaml.dump(edict2dict(cfg), yaml_file, default_flow_style=False)
 
     torch.backends.cudnn.benchmark=True
 
@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 from numpy.linalg import norm
 import torch
+from torch.utils.checkpoint import checkpoint
 from easydict import EasyDict as edict
 from typing import Optional, List
 import yaml
@@ -15,12 +16,13 @@ from torch.utils.data import DataLoader
 thispath = Path(__file__).resolve()
 
 
-def get_generator_instances(csv_patches_path, preprocess, batch_size, pipeline_transform, num_workers):
+def get_generator_instances(csv_patches_path, preprocess, batch_size, pipeline_transform, num_workers,
+                            shuffle=True):
 
     params_instance = {'batch_size': batch_size,
                     'num_workers': num_workers,
                     'pin_memory': True,
-                    'shuffle': True}
+                    'shuffle': shuffle}
 
     instances = Dataset_instance_MIL(csv_patches_path, pipeline_transform, preprocess)
     generator = DataLoader(instances, **params_instance)
@@ -114,43 +116,107 @@ def generate_list_instances(wsi_path):
     return good_patches_df
 
 
-def contrastive_loss(q, k, queue, temperature):
+def queue_logsumexp(q, queue, temperature):
 
-    batch_size = q.shape[0]
+    return torch.logsumexp(torch.mm(q, torch.t(queue)) / temperature, dim=1)
 
-    # dimension is the dimension of the representation
-    dimension = q.shape[1]
 
-    # BMM stands for batch matrix multiplication
-    # If mat1 is B × n × M tensor, then mat2 is B × m × P tensor,
-    # Then output a B × n × P tensor.
-    pos = torch.exp(torch.div(torch.bmm(q.view(batch_size, 1, dimension),
-                                        k.view(batch_size, dimension, 1)).view(batch_size, 1),
-                              temperature))
+def contrastive_loss(q, k, queue, temperature, chunk_size=None):
+    """
+    InfoNCE loss of MoCo, mean of -log(exp(q·k/T) / (exp(q·k/T) + sum exp(q·queue/T))),
+    computed as logsumexp(logits) - q·k/T in fp32 (also under autocast), so it does not
+    overflow for low temperatures or half precision features. With chunk_size the negatives
+    are processed in chunks of the queue, and every chunk is recomputed in the backward
+    (activation checkpointing), so the (N, num_keys) logits are never in memory at once.
 
-    # Matrix multiplication is performed between the query and the queue tensor
-    neg = torch.sum(torch.exp(torch.div(torch.mm(q.view(batch_size, dimension),
-                                                 torch.t(queue)), temperature)), dim=1)
+    It is the cross entropy of the logits [q·k, q·queue] / T with label 0, as in MoCo. The
+    previous implementation added pos (N, 1) to the sum of the negatives (N,), which
+    broadcasts to an (N, N) denominator pairing every positive with the negatives of every
+    query, so its values (and gradients) are slightly different.
 
-    # Sum up
-    denominator = neg + pos
+    Parameters
+    ----------
+    q (torch.Tensor): normalized queries (N, dim)
+    k (torch.Tensor): normalized positive keys (N, dim)
+    queue (torch.Tensor): normalized negative keys (num_keys, dim)
+    temperature (float): temperature T of the softmax
+    chunk_size (int): number of keys of the queue per chunk, None for the whole queue
 
-    return torch.mean(-torch.log(torch.div(pos, denominator)))
+    Returns
+    -------
+    loss (torch.Tensor): scalar loss
+    """
+    with torch.autocast(device_type=q.device.type, enabled=False):
+        q = q.float()
+        k = k.float()
+        queue = queue.float()
 
+        # Positive logits (N, 1)
+        pos = torch.sum(q * k, dim=1, keepdim=True) / temperature
 
-def momentum_step(encoder, momentum_encoder, m=1):
+        if chunk_size is None or chunk_size >= queue.shape[0]:
+            neg = queue_logsumexp(q, queue, temperature)[:, None]
+
+        else:
+            neg = []
+            for chunk in torch.split(queue, chunk_size, dim=0):
+                if torch.is_grad_enabled() and q.requires_grad:
+                    neg.append(checkpoint(queue_logsumexp, q, chunk, temperature, use_reentrant=False))
+                else:
+                    neg.append(queue_logsumexp(q, chunk, temperature))
+            neg = torch.stack(neg, dim=1)
+
+        # log(exp(pos) + sum exp(neg)) - pos
+        return torch.mean(torch.logsumexp(torch.cat([pos, neg], dim=1), dim=1) - pos[:, 0])
 
-    params_q = encoder.state_dict()
-    params_k = momentum_encoder.state_dict()
 
-    dict_params_k = dict(params_k)
+def momentum_tensors(module):
+    """
+    Parameters and buffers of a module in the order of their state dict entries, without
+    removing the tensors shared by several submodules (e.g. net and conv_layers).
+    """
+    return ([param for _, param in module.named_parameters(remove_duplicate=False)] +
+            [buffer for _, buffer in module.named_buffers(remove_duplicate=False)])
 
-    for name in params_q:
-        theta_k = dict_params_k[name]
-        theta_q = params_q[name].data
-        dict_params_k[name].data.copy_(m * theta_k + (1-m) * theta_q)
 
-    momentum_encoder.load_state_dict(dict_params_k)
+@torch.no_grad()
+def momentum_step(encoder, momentum_encoder, m=1):
+    """
+    In-place momentum update theta_k = m * theta_k + (1-m) * theta_q of the parameters and
+    buffers of the momentum encoder, with multi-tensor (foreach) ops on the floating point
+    tensors. Integer buffers (num_batches_tracked of BN) are updated with the same
+    expression and truncated. The result is identical to the update of every entry of the
+    state dict: tensors shared by several submodules (one entry per submodule) are updated
+    once per entry.
+    """
+    tensors_q = momentum_tensors(encoder)
+    tensors_k = momentum_tensors(momentum_encoder)
+
+    # Shared tensors are updated in successive passes, one per entry
+    passes = []
+    entries = {}
+    for theta_k, theta_q in zip(tensors_k, tensors_q):
+        key = (theta_k.data_ptr(), theta_k.shape)
+        entries[key] = entries.get(key, 0) + 1
+        if entries[key] > len(passes):
+            passes.append(([], [], []))
+
+        float_k, float_q, integer = passes[entries[key] - 1]
+        if theta_k.is_floating_point():
+            float_k.append(theta_k)
+            float_q.append(theta_q)
+        else:
+            integer.append((theta_k, theta_q))
+
+    for float_k, float_q, integer in passes:
+        if len(float_k) > 0:
+            # (1-m) * theta_q before updating theta_k in place, they can be the same tensor
+            update_q = torch._foreach_mul(float_q, 1 - m)
+            torch._foreach_mul_(float_k, m)
+            torch._foreach_add_(float_k, update_q)
+
+        for theta_k, theta_q in integer:
+            theta_k.copy_(m * theta_k + (1 - m) * theta_q)
 
 
 def update_lr(epoch, actual_lr, optimizer):
@@ -176,3 +242,21 @@ def update_queue(queue, k, num_keys):
     new_queue = new_queue[:num_keys]
 
     return new_queue
+
+
+def rng_state():
+    """
+    States of the torch random generators of this process (CPU and current CUDA device),
+    used by the augmentations on the device and the shuffled BN.
+    """
+    state = {"torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state(state["cuda"])
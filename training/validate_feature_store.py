@@ -0,0 +1,130 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from database import FeatureStore
+from training.mil import MIL_model
+from training.models import ModelOption, load_head_checkpoint
+from training.utils_trainig import yaml_load
+from natsort import natsorted
+import logging
+import click
+
+thispath = Path(__file__).resolve()
+
+device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+datadir = Path(thispath.parent.parent / "data")
+
+
+def compare_logits(net, featuresdir, store, wsis):
+    """
+    MIL logits of every WSI from the original features (<wsi>.npy in featuresdir) and from
+    the features of a (half precision and/or compressed) store.
+
+    Returns
+    -------
+    df_comparison (pandas.DataFrame): max absolute difference of the logits and of the sigmoid
+        outputs and if the thresholded predictions agree, for every WSI
+    """
+    rows = []
+    with torch.no_grad():
+        for wsi_id in wsis:
+            inputs_original = torch.tensor(np.load(featuresdir / f"{wsi_id}.npy")).float().to(device)
+            inputs_store = torch.tensor(store[wsi_id]).float().to(device)
+
+            logits_original, _ = net(None, inputs_original)
+            logits_store, _ = net(None, inputs_store)
+
+            sigmoid_original = torch.sigmoid(logits_original)
+            sigmoid_store = torch.sigmoid(logits_store)
+
+            rows.append({"wsi": wsi_id,
+                         "max_diff_logits": (logits_original - logits_store).abs().max().item(),
+                         "max_diff_sigmoid": (sigmoid_original - sigmoid_store).abs().max().item(),
+                         "same_prediction": bool(torch.equal(sigmoid_original > 0.5, sigmoid_store > 0.5))})
+
+    return pd.DataFrame(rows)
+
+
+@click.command()
+@click.option(
+    "--experiment_name",
+    default="MIL_resnet101_00025_2102030",
+    prompt="Name of the MIL experiment used to compare the logits",
+    help="Name of the MIL experiment used to compare the logits",
+)
+@click.option(
+    "--store_name",
+    default="feature_store",
+    prompt="Name of the store directory inside the features directory",
+    help="Name of the store directory inside the features directory",
+)
+@click.option(
+    "--featuresdir",
+    default=None,
+    help="Features directory inside data/Saved_features, by default the one of the experiment",
+)
+def main(experiment_name, store_name, featuresdir):
+    """
+    Compares the MIL logits computed from the features of a store (e.g. bfloat16 + zlib)
+    with the logits computed from the original per-WSI .npy features, for every fold.
+    """
+    modeldir = Path(thispath.parent.parent / "trained_models" / "MIL" / experiment_name)
+
+    subdirs = natsorted([e.stem for e in modeldir.iterdir() if e.is_dir() if "fold" in str(e)])
+
+    cfg = yaml_load(modeldir / f"config_{experiment_name}.yml")
+
+    if featuresdir is None:
+        featuresdir = cfg.data_augmentation.featuresdir
+    featuresdir = Path(datadir / "Saved_features" / featuresdir)
+
+    outputdir = Path(featuresdir / store_name)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s',
+                        encoding='utf-8',
+                        level=logging.INFO,
+                        handlers=[
+                            logging.FileHandler(outputdir / "validation.log"),
+                            logging.StreamHandler()
+                        ],
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    store = FeatureStore(featuresdir, store_name=store_name)
+    wsis = natsorted(store.index.keys())
+
+    logging.info(f"Comparing {len(wsis)} WSI of {store.storedir} ({store.storage}, "
+                 f"compression {store.compression}) with {featuresdir}")
+
+    for fold in subdirs:
+
+        bestdir = Path(modeldir / fold / cfg.dataset.magnification / cfg.model.model_name)
+        checkpoint = torch.load(bestdir / f"{experiment_name}.pt")
+
+        model = ModelOption(cfg.model.model_name,
+                    cfg.model.num_classes,
+                    freeze=cfg.model.freeze_weights,
+                    num_freezed_layers=cfg.model.num_frozen_layers,
+                    dropout=cfg.model.dropout,
+                    embedding_bool=cfg.model.embedding_bool,
+                    pool_algorithm=cfg.model.pool_algorithm,
+                    build_backbone=False
+                    )
+
+        net = MIL_model(model, cfg.model.hidden_space_len, cfg)
+        load_head_checkpoint(net, checkpoint["model_state_dict"])
+        net.to(device)
+        net.eval()
+
+        df_comparison = compare_logits(net, featuresdir, store, wsis)
+        df_comparison.to_csv(Path(outputdir / f"validation_{experiment_name}_{fold}.csv"), index=False)
+
+        logging.info(f"{fold}: max difference logits {df_comparison['max_diff_logits'].max():.6f}, "
+                     f"mean {df_comparison['max_diff_logits'].mean():.6f}, "
+                     f"max difference sigmoid {df_comparison['max_diff_sigmoid'].max():.6f}, "
+                     f"{df_comparison['same_prediction'].sum()} / {len(df_comparison)} same predictions")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
 from .global_functions import csv_writer, available_magnifications, check_corners, timer, create_folds
+from .slide_statistics import masked_slide_statistics, merge_statistics
+from .binarization_pyhist import binarize_mask, load_binary_mask
 
-__all__ = ["csv_writer", "available_magnifications", "check_corners", "timer", "create_folds"]
+__all__ = ["csv_writer", "available_magnifications", "check_corners", "timer", "create_folds",
+           "masked_slide_statistics", "merge_statistics", "binarize_mask", "load_binary_mask"]
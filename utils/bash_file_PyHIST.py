@@ -1,8 +1,8 @@
 import click 
 from pathlib import Path
 import pandas as pd
-import openslide
 from utils import available_magnifications
+from utils.slide_headers import slide_headers
 from tqdm import tqdm
 
 thispath = Path(__file__).resolve()
@@ -44,12 +44,14 @@ def bash_file(name_experiment):
             f"#!/bin/bash \n\n" 
         )
 
+        # Header values cached from previous runs, only new slides are opened
+        headers = slide_headers(he_svs_files)
+
         for file in tqdm(he_svs_files):
 
-            slide = openslide.OpenSlide(str(file))
-            mpp = slide.properties["openslide.mpp-x"]
+            mpp = headers.loc[str(file), "mpp"]
 
-            level_downsamples = slide.level_downsamples
+            level_downsamples = headers.loc[str(file), "level_downsamples"]
             mags = available_magnifications(mpp, level_downsamples)
             if mags[0] == 40:
                 downsample = 2
@@ -1,7 +1,7 @@
 import click 
 from pathlib import Path
-import openslide
 from utils import available_magnifications
+from utils.slide_headers import slide_headers
 from tqdm import tqdm
 
 thispath = Path(__file__).resolve()
@@ -35,9 +35,11 @@ def bash_file(name_experiment):
             f"#!/bin/bash \n\n" 
         )
         
+        # Header values cached from previous runs, only new slides are opened
+        headers = slide_headers(svs_files)
+
         for file in tqdm(svs_files):
-            slide = openslide.OpenSlide(str(file))
-            magnification = slide.properties["aperio.AppMag"]
+            magnification = headers.loc[str(file), "app_mag"]
             if magnification == "40":
                 downsample = 4
             elif magnification == "20":
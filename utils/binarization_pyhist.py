@@ -1,39 +1,109 @@
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import cv2 as cv
-from matplotlib import pyplot as plt
 from tqdm import tqdm
-import os
-from utils import check_corners
+import click
+from utils.global_functions import check_corners
 
 thispath = Path(__file__).resolve()
 
 
-def binary_mask_pyhist():
+def binarize_mask(color_mask):
+    """
+    Converts the coloured segmentation mask from PyHIST into a binary mask. Pixels with the
+    background colour (found in the corners) are 0 and the rest are 1.
 
-    maskdir = Path("/mnt/nas6/data/lung_tcga/Mask_PyHIST_tif")
+    Parameters
+    ----------
+    color_mask (numpy.ndarray): coloured mask (BGR) from PyHIST
 
-    colorful_masks = [i for i in maskdir.rglob("*.ppm")]
+    Returns
+    -------
+    binary_mask (numpy.ndarray): binary mask (uint8, 0 and 1) with the shape of the image
+    """
+    background = check_corners(color_mask)
+
+    return np.any(color_mask != background, axis=-1).view(np.uint8)
+
+
+def binary_path(mask):
+    return Path(mask.parent / f"binary_{mask.parent.stem}.png")
+
+
+def binarize_file(mask, overwrite=False):
+    """
+    Reads a PyHIST .ppm mask and saves its binary mask next to it as binary_<wsi>.png.
+    Masks already binarized are skipped unless overwrite is True.
+    """
+    outputpath = binary_path(mask)
+    if outputpath.exists() and not overwrite:
+        return outputpath
+
+    binary_mask = binarize_mask(cv.imread(str(mask)))
+    cv.imwrite(str(outputpath), binary_mask, [cv.IMWRITE_PNG_BILEVEL, 1])
+
+    return outputpath
 
-    for mask in tqdm(colorful_masks, desc=f"Saving binary masks in Mask_PyHIST"):
 
-        color_mask = cv.imread(str(mask))
+def load_binary_mask(resultdir):
+    """
+    Binary mask of a WSI with the layout of cv.imread (3 channels, 0 and 1). It is binarized
+    in memory from the PyHIST .ppm mask, so binary_<wsi>.png is only read when the .ppm is not
+    available.
 
-        # Mask from PyHIST to binary mask
-        copy = color_mask.copy()
+    Parameters
+    ----------
+    resultdir (Path from pathlib): PyHIST output directory of the WSI
 
-        most_frequent = check_corners(copy)
-        copy[(copy != most_frequent).any(axis=-1)] = 1
-        copy[(copy == most_frequent).all(axis=-1)] = 0
-        binary_mask = copy[:, :, 0]
+    Returns
+    -------
+    binary_mask (numpy.ndarray): binary mask of the WSI
+    """
+    color_masks = [i for i in resultdir.glob("*.ppm")]
 
-        cv.imwrite(f"{maskdir}/{mask.parent.parent.stem}/{mask.parent.stem}/binary_{mask.parent.stem}.png",
-                   binary_mask, [cv.IMWRITE_PNG_BILEVEL, 1])
+    if len(color_masks) > 0:
+        binary_mask = binarize_mask(cv.imread(str(color_masks[0])))
+        return cv.cvtColor(binary_mask, cv.COLOR_GRAY2BGR)
+
+    mask_file = Path(resultdir / f"binary_{resultdir.stem}.png")
+    binary_mask = cv.imread(str(mask_file))
+    if binary_mask is None:
+        raise FileNotFoundError(f"No PyHIST .ppm mask and no binary mask of the slide {resultdir.stem}: {mask_file}")
+    binary_mask[binary_mask == 255] = 1
+
+    return binary_mask
+
+
+def binary_mask_pyhist(maskdir, num_workers=8, overwrite=False):
+
+    colorful_masks = [i for i in maskdir.rglob("*.ppm")]
+    if not overwrite:
+        colorful_masks = [i for i in colorful_masks if not binary_path(i).exists()]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        list(tqdm(executor.map(partial(binarize_file, overwrite=overwrite), colorful_masks, chunksize=4),
+                  total=len(colorful_masks),
+                  desc=f"Saving binary masks in Mask_PyHIST"))
 
     print(f"Binary masks created from PyHIST and saved in {maskdir}")
 
 
-def main():
-    binary_mask_pyhist()
+@click.command()
+@click.option(
+    "--num_workers",
+    default=8,
+    help="Number of processes used to binarize the masks",
+)
+@click.option(
+    "--overwrite",
+    is_flag=True,
+    help="Binarize again the masks already saved",
+)
+def main(num_workers, overwrite):
+    maskdir = Path("/mnt/nas6/data/lung_tcga/Mask_PyHIST_tif")
+    binary_mask_pyhist(maskdir, num_workers, overwrite)
 
 
 if __name__ == "__main__":
@@ -67,12 +67,12 @@ def check_corners(img):
     -------
     background_pixel (numpy.ndarray): pixel value (BGR) for the background
     """
-    copy = img.copy()
-    width, height, _ = copy.shape
+    width, height, _ = img.shape
+    # Slicing only creates a view, the corners are read from the image itself
     if width > 15000 or height > 15000:
-        cropped_image = copy[600:width-600, 600:height-600]
+        cropped_image = img[600:width-600, 600:height-600]
     else:
-        cropped_image = copy[300:width-300, 300:height-300]
+        cropped_image = img[300:width-300, 300:height-300]
     width, height, _ = cropped_image.shape
     top_left = img[0, 0, :]
     top_right = img[width-1, 0, :]
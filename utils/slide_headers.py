@@ -0,0 +1,114 @@
+from pathlib import Path
+from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pandas as pd
+import openslide
+from tqdm import tqdm
+
+thispath = Path(__file__).resolve()
+
+HEADER_CACHE = Path(thispath.parent.parent / "data" / "slide_headers.csv")
+
+header_columns = ["size", "mtime_ns", "mpp", "app_mag", "level_dimensions", "level_downsamples"]
+
+
+def read_slide_header(svs_file):
+    """
+    Opens a WSI and reads the properties of its header needed by the pipeline.
+
+    Parameters
+    ----------
+    svs_file (Path from pathlib): path to the WSI
+
+    Returns
+    -------
+    header (dict): size and mtime (integer nanoseconds) of the file, mpp, aperio magnification, level dimensions
+        and level downsamples of the WSI
+    """
+    stat = os.stat(svs_file)
+    slide = openslide.OpenSlide(str(svs_file))
+    header = {"size": stat.st_size,
+              "mtime_ns": stat.st_mtime_ns,
+              "mpp": slide.properties.get("openslide.mpp-x"),
+              "app_mag": slide.properties.get("aperio.AppMag"),
+              "level_dimensions": slide.level_dimensions,
+              "level_downsamples": slide.level_downsamples}
+    slide.close()
+
+    return header
+
+
+def load_header_cache(cache_file=HEADER_CACHE):
+    if not Path(cache_file).exists():
+        return pd.DataFrame(columns=header_columns)
+
+    cache = pd.read_csv(cache_file,
+                        index_col=0,
+                        dtype={"path": str, "mpp": str, "app_mag": str,
+                               "size": "Int64", "mtime_ns": "Int64"},
+                        converters={"level_dimensions": literal_eval,
+                                    "level_downsamples": literal_eval})
+
+    # Cache written by an older version (float mtime), every header is read again
+    if any(i not in cache.columns for i in header_columns):
+        return pd.DataFrame(columns=header_columns)
+
+    return cache
+
+
+def is_up_to_date(table, key, column, value):
+    """
+    True if the table has a row key with the integer value in the column. A missing
+    column, row or value means the entry is stale.
+    """
+    if column not in table.columns or key not in table.index:
+        return False
+    cached = table.loc[key, column]
+
+    return not pd.isna(cached) and int(cached) == value
+
+
+def slide_headers(svs_files, cache_file=HEADER_CACHE, num_workers=8):
+    """
+    Returns the header of every WSI reusing the values cached in a previous run. Only the
+    slides that are new or whose size or modification time changed are opened, in parallel
+    with a thread pool, and the cache is rewritten once at the end.
+
+    Parameters
+    ----------
+    svs_files (list): paths of the WSIs
+    cache_file (Path from pathlib): .csv file with the cached headers
+    num_workers (int): number of threads used to open the slides
+
+    Returns
+    -------
+    headers (pandas.DataFrame): headers of the given WSIs indexed by their path as string
+    """
+    cache = load_header_cache(cache_file)
+
+    svs_files = list(dict.fromkeys(str(i) for i in svs_files))
+    to_read = []
+    for svs_file in svs_files:
+        if svs_file not in cache.index:
+            to_read.append(svs_file)
+            continue
+        stat = os.stat(svs_file)
+        if (not is_up_to_date(cache, svs_file, "size", stat.st_size) or
+                not is_up_to_date(cache, svs_file, "mtime_ns", stat.st_mtime_ns)):
+            to_read.append(svs_file)
+
+    if len(to_read) > 0:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            new_headers = list(tqdm(executor.map(read_slide_header, to_read),
+                                    total=len(to_read),
+                                    desc="Reading WSI headers"))
+
+        new_cache = pd.DataFrame(new_headers, index=to_read, columns=header_columns)
+        cache = pd.concat([cache.drop(index=to_read, errors="ignore"), new_cache])
+        cache.index.name = "path"
+
+        Path(cache_file).parent.mkdir(exist_ok=True, parents=True)
+        cache.to_csv(cache_file)
+
+    return cache.loc[svs_files]
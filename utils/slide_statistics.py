@@ -0,0 +1,103 @@
+import numpy as np
+from PIL import Image
+
+
+def merge_statistics(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """
+    Merges two sets of per-channel running statistics using Chan et al. parallel update.
+
+    Parameters
+    ----------
+    count_a (int): number of samples of the first set
+    mean_a (numpy.ndarray): per-channel mean of the first set
+    m2_a (numpy.ndarray): per-channel sum of squared differences of the first set
+    count_b (int): number of samples of the second set
+    mean_b (numpy.ndarray): per-channel mean of the second set
+    m2_b (numpy.ndarray): per-channel sum of squared differences of the second set
+
+    Returns
+    -------
+    count, mean, m2 of the union of both sets
+    """
+    count = count_a + count_b
+    if count_b == 0:
+        return count_a, mean_a, m2_a
+    if count_a == 0:
+        return count_b, mean_b, m2_b
+
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + delta**2 * (count_a * count_b / count)
+
+    return count, mean, m2
+
+
+def masked_slide_statistics(slide, binary_mask, level=0, tile_size=1024):
+    """
+    Computes the per-channel mean and standard deviation of the tissue of a WSI streaming
+    the slide tile by tile at the given level, so memory stays bounded by the tile size.
+
+    Parameters
+    ----------
+    slide (openslide.OpenSlide): WSI to analyse
+    binary_mask (numpy.ndarray): binary tissue mask (1 tissue, 0 background) at any resolution,
+        either 2D or with the channels on the last axis
+    level (int): pyramid level of the slide used to compute the statistics
+    tile_size (int): side of the square tiles read from the slide
+
+    Returns
+    -------
+    mean (numpy.ndarray): per-channel (RGB) mean within the mask
+    std (numpy.ndarray): per-channel (RGB) standard deviation within the mask
+    shape (tuple): shape (height, width, channels) of the slide at the given level
+    """
+    if binary_mask.ndim == 3:
+        binary_mask = binary_mask[:, :, 0]
+    binary_mask = binary_mask.astype(bool)
+
+    width, height = slide.level_dimensions[level]
+    downsample = slide.level_downsamples[level]
+    mask_height, mask_width = binary_mask.shape
+
+    # Nearest neighbour lookup from level coordinates to mask coordinates
+    mask_rows = (np.arange(height) * mask_height // height).astype(np.intp)
+    mask_cols = (np.arange(width) * mask_width // width).astype(np.intp)
+
+    background = "#" + slide.properties.get("openslide.background-color", "ffffff")
+
+    count = 0
+    mean = np.zeros(3, dtype=np.float64)
+    m2 = np.zeros(3, dtype=np.float64)
+
+    for y in range(0, height, tile_size):
+        tile_height = min(tile_size, height - y)
+        rows = mask_rows[y:y + tile_height]
+
+        for x in range(0, width, tile_size):
+            tile_width = min(tile_size, width - x)
+            tile_mask = binary_mask[rows[:, None], mask_cols[x:x + tile_width]]
+
+            if not tile_mask.any():
+                continue
+
+            # Same alpha compositing against the background colour as OpenSlide.get_thumbnail
+            region = slide.read_region((int(x * downsample), int(y * downsample)),
+                                       level,
+                                       (tile_width, tile_height))
+            tile = Image.new("RGB", region.size, background)
+            tile.paste(region, None, region)
+
+            pixels = np.asarray(tile)[tile_mask].astype(np.float64)
+
+            tile_count = pixels.shape[0]
+            tile_mean = pixels.mean(axis=0)
+            tile_m2 = ((pixels - tile_mean)**2).sum(axis=0)
+
+            count, mean, m2 = merge_statistics(count, mean, m2, tile_count, tile_mean, tile_m2)
+
+    if count == 0:
+        std = np.zeros(3, dtype=np.float64)
+    else:
+        std = np.sqrt(m2 / count)
+
+    return mean, std, (height, width, 3)